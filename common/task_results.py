@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import time
+
+from celery import current_app, states
+from django.db.models import Max
+from django_celery_results.models import TaskResult
+
+# 长任务执行中的自定义状态, result 为 {"done": 已完成字节, "total": 总字节}
+PROGRESS = 'PROGRESS'
+
+
+def load_task_results(task_ids):
+    """
+    一次 IN 查询读取多个任务的状态, 返回 {task_id: {"state": ..., "result": ...}}
+    表中没有记录的任务与 AsyncResult 一致, 视为 PENDING
+    :param task_ids: 任务id列表, 空值会被忽略
+    :return:
+    """
+    task_ids = set(x for x in task_ids if x)
+    results = {}
+    if not task_ids:
+        return results
+    backend = current_app.backend
+    queryset = TaskResult.objects.filter(task_id__in=task_ids).only(
+        'task_id', 'status', 'result', 'content_type', 'content_encoding')
+    for obj in queryset:
+        meta = backend.meta_from_decoded({
+            'status': obj.status,
+            'result': backend.decode_content(obj, obj.result),
+        })
+        results[obj.task_id] = {
+            "state": meta['status'],
+            "result": meta['result'],
+        }
+    for task_id in task_ids:
+        if task_id not in results:
+            results[task_id] = {
+                "state": states.PENDING,
+                "result": None,
+            }
+    return results
+
+
+def last_task_change_time(task_ids):
+    """
+    任务状态最后一次变化的时间, 可用于计算 ETag
+    :param task_ids: 任务id列表或 values('last_task_id') 子查询
+    :return:
+    """
+    return TaskResult.objects.filter(task_id__in=task_ids).aggregate(value=Max('date_done'))['value']
+
+
+def progress_reporter(task, interval=1):
+    """
+    返回 progress(done, total) 回调, 按间隔把进度写入任务状态, 不在 worker 中执行时返回 None
+    :param task: bind=True 的任务实例
+    :param interval: 两次写入的最小间隔秒数, 完成时总会写入
+    :return:
+    """
+    if not task.request.id:
+        return None
+    last = {"time": 0}
+
+    def progress(done, total):
+        now = time.time()
+        if done < total and now - last['time'] < interval:
+            return
+        last['time'] = now
+        task.update_state(state=PROGRESS, meta={"done": done, "total": total})
+
+    return progress
@@ -1,11 +1,20 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
 
+import six
 from django.db.models import Q
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 from rest_framework import exceptions
 from rest_framework import viewsets
 
 
+def make_etag(*parts):
+    value = u':'.join(six.text_type(x) for x in parts)
+    return quote_etag(hashlib.md5(value.encode('utf-8')).hexdigest())
+
+
 class BaseViewSet(viewsets.ModelViewSet):
     ordering_fields = '__all__'
     check_unique_fields = []
@@ -48,6 +57,23 @@ class BaseViewSet(viewsets.ModelViewSet):
         self._check_unique()
         return super(BaseViewSet, self).create(request, *args, **kwargs)
 
+    def get_list_etag(self, queryset):
+        """
+        列表接口的 ETag, 在序列化之前计算, 返回 None 时不处理条件请求
+        """
+        return None
+
+    def list(self, request, *args, **kwargs):
+        etag = self.get_list_etag(self.filter_queryset(self.get_queryset()))
+        if etag:
+            response = get_conditional_response(request, etag=etag)
+            if response is not None:
+                return response
+        response = super(BaseViewSet, self).list(request, *args, **kwargs)
+        if etag:
+            response['ETag'] = etag
+        return response
+
     def partial_update(self, request, *args, **kwargs):
         self._check_unique()
         return super(BaseViewSet, self).partial_update(request, *args,
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+bench_task_latency 命令使用的模拟任务, 不在 autodiscover 范围内,
+测量时 worker 需加上 -I host_manager.bench_tasks 启动
+"""
+from __future__ import unicode_literals
+
+import time
+
+from celery import shared_task
+
+
+@shared_task
+def bench_bulk_io(seconds):
+    """
+    模拟长时间磁盘复制
+    """
+    time.sleep(seconds)
+
+
+@shared_task
+def bench_interactive(sent_time):
+    """
+    模拟开关机等交互操作, 返回从发送到开始执行的秒数
+    """
+    return time.time() - sent_time
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from xml.etree import ElementTree as ET
+
+from django.conf import settings
+from django.core.cache import cache
+
+from host_manager.libvirt_pool import libvirt_connection
+from host_manager.models import CPU_MODE_LEGACY, CPU_MODE_CUSTOM, CPU_MODE_BASELINE, CPU_MODES
+
+BASELINE_CACHE_KEY = 'cpu_baseline'
+BASELINE_CACHE_TTL = 3600
+
+
+def host_cpu_mode(host):
+    return host.cpu_mode or settings.DEFAULT_CPU_MODE
+
+
+def usable_models(domain_caps):
+    """
+    :param domain_caps: conn.getDomainCapabilities() 的结果
+    :return: custom 模式下本节点可用的 CPU 型号
+    """
+    root = ET.fromstring(domain_caps)
+    return [x.text for x in root.findall("./cpu/mode[@name='custom']/model") if x.get('usable') != 'no']
+
+
+def mode_supported(domain_caps, mode):
+    node = ET.fromstring(domain_caps).find("./cpu/mode[@name='{}']".format(mode))
+    # 旧版本 libvirt 的 domain capabilities 没有 cpu 信息, 视为支持
+    return node is None or node.get('supported') != 'no'
+
+
+def check_cpu_mode(conn, mode, model=None):
+    """
+    :return: 本节点不支持该 CPU 配置时的错误信息, 支持时返回 None
+    """
+    if mode not in dict(CPU_MODES):
+        return "cpu_mode应为{}".format("/".join(x[0] for x in CPU_MODES))
+    if mode in (CPU_MODE_LEGACY, CPU_MODE_BASELINE):
+        return None
+    domain_caps = conn.getDomainCapabilities()
+    if mode == CPU_MODE_CUSTOM:
+        if not model:
+            return "custom 模式需要 cpu_model"
+        if model not in usable_models(domain_caps):
+            return "本节点不能使用 CPU 型号 {}".format(model)
+        return None
+    if not mode_supported(domain_caps, mode):
+        return "本节点不支持 {}".format(mode)
+    return None
+
+
+def baseline_cpu_xml():
+    """
+    CPU_BASELINE_URIS 中所有节点的 CPU 都支持的型号与特性, 虚拟机可以在这些节点之间迁移
+    节点的 CPU 不会变化, 结果缓存 BASELINE_CACHE_TTL 秒
+    :return: <cpu mode='custom'> 元素的 XML
+    """
+    xml = cache.get(BASELINE_CACHE_KEY)
+    if xml is None:
+        uris = settings.CPU_BASELINE_URIS or [settings.LIBVIRT_URI]
+        cpu_xmls = []
+        for uri in uris:
+            with libvirt_connection(uri) as conn:
+                cpu_xmls.append(ET.tostring(ET.fromstring(conn.getCapabilities()).find('./host/cpu')))
+        with libvirt_connection(uris[0]) as conn:
+            xml = conn.baselineCPU(cpu_xmls, 0)
+        cache.set(BASELINE_CACHE_KEY, xml, BASELINE_CACHE_TTL)
+    return xml
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import errno
+import fcntl
+import os
+from xml.etree import ElementTree as ET
+
+from django.conf import settings
+
+from host_manager import qemu_img
+from host_manager.models import HostStorage, DISK_PROFILE_THIN, DISK_PROFILE_METADATA_PREALLOC, \
+    DISK_PROFILE_FULL_FALLOC, DISK_PROFILE_LARGE_CLUSTER, DISK_CACHE_MODES, DISK_IO_MODES, DISK_DISCARD_MODES
+
+# linux/fs.h 中的 FICLONE, 以及 lseek 的 SEEK_DATA/SEEK_HOLE(python2 的 os 模块中没有)
+FICLONE = 0x40049409
+SEEK_DATA = 3
+SEEK_HOLE = 4
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# 新建空白硬盘时各配置对应的 qemu-img create -o 参数
+# lazy_refcounts 推迟引用计数的更新, 减少首次写入时的元数据写; falloc 预先分配空间但不写零
+DISK_PROFILE_OPTIONS = {
+    DISK_PROFILE_THIN: {},
+    DISK_PROFILE_METADATA_PREALLOC: {'preallocation': 'metadata', 'lazy_refcounts': 'on'},
+    DISK_PROFILE_FULL_FALLOC: {'preallocation': 'falloc', 'lazy_refcounts': 'on'},
+    DISK_PROFILE_LARGE_CLUSTER: {'cluster_size': '2M', 'lazy_refcounts': 'on'},
+}
+
+CLONE_MODE_FULL = 'full'
+CLONE_MODE_LINKED = 'linked'
+
+CLONE_MODES = (
+    (CLONE_MODE_FULL, '完整复制'),
+    (CLONE_MODE_LINKED, '链接克隆'),
+)
+
+
+def create_blank_disk(path, size, disk_profile=None):
+    """
+    :param size: 带单位的大小, 如 '10G'
+    :param disk_profile: 为空时使用 DEFAULT_DISK_PROFILE
+    """
+    qemu_img.create(path, size, options=DISK_PROFILE_OPTIONS[disk_profile or settings.DEFAULT_DISK_PROFILE])
+
+
+def create_linked_clone(base_path, path):
+    """
+    创建以基础镜像为 backing file 的 qcow2 增量磁盘, 不复制数据
+    基础镜像被引用后一旦改动, 所有基于它的虚拟机磁盘都会损坏, 覆盖和删除前需用 check_base_disk_replaceable 检查
+    """
+    qemu_img.create(path, backing_file=base_path)
+
+
+def flatten_image(path, target_path, compress=False, progress=None):
+    """
+    合并 backing chain 导出为独立的 qcow2 文件, 全零的簇不会写入
+    :param compress: 是否压缩数据簇
+    :param progress: 回调 progress(done, total)
+    """
+    qemu_img.convert(path, target_path, compress=compress, progress=progress)
+
+
+def version_number(major, minor, release=0):
+    """
+    与 getLibVersion/getVersion 返回值相同的版本号格式
+    """
+    return major * 1000000 + minor * 1000 + release
+
+
+def check_disk_tuning(conn, bus, cache, io, discard, iothread):
+    """
+    检查硬盘的 cache/io/discard/iothread 组合是否有效, 以及本机 libvirt 与 qemu 是否支持
+    :return: 错误信息, 没有问题时返回 None
+    """
+    for name, value, choices in (('cache', cache, DISK_CACHE_MODES), ('io', io, DISK_IO_MODES),
+                                 ('discard', discard, DISK_DISCARD_MODES)):
+        if value and value not in dict(choices):
+            return "{}应为{}".format(name, "/".join(x[0] for x in choices))
+    if io == 'native' and cache not in ('none', 'directsync'):
+        return "io=native 需要 cache=none 或 directsync"
+    if iothread and bus != 'virtio':
+        return "只有 virtio 硬盘可以使用独立的 IOThread"
+    lib_version = conn.getLibVersion()
+    qemu_version = conn.getVersion()
+    if io == 'io_uring' and (lib_version < version_number(6, 3) or qemu_version < version_number(5, 0)):
+        return "io=io_uring 需要 libvirt 6.3 及 qemu 5.0 以上"
+    if discard and (lib_version < version_number(1, 0, 6) or qemu_version < version_number(1, 5)):
+        return "discard 需要 libvirt 1.0.6 及 qemu 1.5 以上"
+    if iothread:
+        if lib_version < version_number(1, 2, 8) or qemu_version < version_number(2, 1):
+            return "IOThread 需要 libvirt 1.2.8 及 qemu 2.1 以上"
+        supported = ET.fromstring(conn.getDomainCapabilities()).find('./iothreads')
+        if supported is not None and supported.get('supported') == 'no':
+            return "本机 qemu 不支持 IOThread"
+    return None
+
+
+def base_disks_in_use():
+    """
+    :return: 仍被未删除磁盘作为 backing file 使用的基础镜像路径集合
+    """
+    return set(HostStorage.objects.filter(is_delete=False, backing_path__isnull=False).values_list(
+        'backing_path', flat=True).distinct())
+
+
+def check_base_disk_replaceable(path):
+    """
+    :return: 基础镜像仍被链接克隆引用时的错误信息, 可以覆盖或删除时返回 None
+    """
+    if path in base_disks_in_use():
+        return "基础镜像 {} 正被链接克隆的虚拟机使用, 不能覆盖或删除".format(os.path.basename(path))
+    return None
+
+
+def data_segments(fd, size):
+    """
+    按 SEEK_DATA/SEEK_HOLE 列出文件中有数据的区间, 文件系统不支持时整个文件视为一个区间
+    :return: [(start, end), ...]
+    """
+    segments = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as ex:
+            if ex.errno == errno.ENXIO:
+                break
+            if ex.errno == errno.EINVAL and offset == 0:
+                return [(0, size)]
+            raise
+        end = min(os.lseek(fd, start, SEEK_HOLE), size)
+        segments.append((start, end))
+        offset = end
+    return segments
+
+
+def _sparse_copy(src_fd, dst_fd, total, progress=None):
+    for start, end in data_segments(src_fd, total):
+        os.lseek(src_fd, start, os.SEEK_SET)
+        os.lseek(dst_fd, start, os.SEEK_SET)
+        offset = start
+        while offset < end:
+            buf = os.read(src_fd, min(COPY_BUFFER_SIZE, end - offset))
+            if not buf:
+                break
+            view = memoryview(buf)
+            while view:
+                view = view[os.write(dst_fd, view):]
+            offset += len(buf)
+            if progress:
+                progress(offset, total)
+    os.ftruncate(dst_fd, total)
+
+
+def copy_file(src, dst, progress=None):
+    """
+    复制磁盘文件: 优先 reflink(FICLONE) 共享数据块, 文件系统不支持时只复制数据区间, 空洞保持稀疏
+    :param progress: 回调 progress(done, total), 单位字节
+    :return:
+    """
+    total = os.path.getsize(src)
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            except (IOError, OSError):
+                _sparse_copy(src_fd, dst_fd, total, progress)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+    if progress:
+        progress(total, total)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+
+import libvirt
+from django.conf import settings
+from django.core.cache import cache
+
+from common.utils import common_except_log, create_immediate_task
+from host_manager.fleet import load_network_leases
+from host_manager.libvirt_pool import libvirt_connection, start_event_loop
+from host_manager.models import Host
+
+# 监听由 manage.py run_event_listener 单独启动, 每个 libvirt 节点一个进程;
+# web/worker 进程需与其配置共享的 CACHES(如 redis/memcached), 否则读不到
+# 每台虚拟机的状态单独一个 key, 更新时不需要读-改-写整个字典
+DOMAIN_STATE_KEY = 'libvirt_domain_state:{}'
+NETWORK_LEASES_KEY = 'libvirt_network_leases'
+STATE_GENERATION_KEY = 'libvirt_state_generation'
+LISTENER_KEY = 'libvirt_event_listener'
+
+LIFECYCLE_STATES = {
+    libvirt.VIR_DOMAIN_EVENT_STARTED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_SUSPENDED: libvirt.VIR_DOMAIN_PAUSED,
+    libvirt.VIR_DOMAIN_EVENT_RESUMED: libvirt.VIR_DOMAIN_RUNNING,
+    libvirt.VIR_DOMAIN_EVENT_STOPPED: libvirt.VIR_DOMAIN_SHUTOFF,
+    libvirt.VIR_DOMAIN_EVENT_SHUTDOWN: libvirt.VIR_DOMAIN_SHUTDOWN,
+    libvirt.VIR_DOMAIN_EVENT_PMSUSPENDED: libvirt.VIR_DOMAIN_PMSUSPENDED,
+    libvirt.VIR_DOMAIN_EVENT_CRASHED: libvirt.VIR_DOMAIN_CRASHED,
+}
+
+
+def get_domain_states(instance_uuids):
+    """
+    :return: {instance_uuid: libvirt 状态码}, 不含缓存中没有的虚拟机
+    """
+    keys = dict((DOMAIN_STATE_KEY.format(x), x) for x in instance_uuids)
+    return dict((keys[key], state) for key, state in cache.get_many(keys.keys()).items())
+
+
+def get_domain_state(instance_uuid):
+    return cache.get(DOMAIN_STATE_KEY.format(instance_uuid))
+
+
+def get_network_leases():
+    return cache.get(NETWORK_LEASES_KEY) or {}
+
+
+def get_state_generation():
+    """
+    每次虚拟机状态、设备或 DHCP 租约变化都会加一, 可作为状态缓存的版本号
+    """
+    return cache.get(STATE_GENERATION_KEY) or 0
+
+
+def is_listening():
+    return bool(cache.get(LISTENER_KEY))
+
+
+def bump_state_generation():
+    try:
+        return cache.incr(STATE_GENERATION_KEY)
+    except ValueError:
+        cache.add(STATE_GENERATION_KEY, 0, timeout=None)
+        return cache.incr(STATE_GENERATION_KEY)
+
+
+def refresh_host_xml(uri, instance_uuid):
+    with libvirt_connection(uri) as conn:
+        try:
+            domain = conn.lookupByUUIDString(instance_uuid)
+        except libvirt.libvirtError:
+            return
+        xml = domain.XMLDesc(0)
+    Host.objects.filter(instance_uuid=instance_uuid, is_delete=False).update(xml=xml)
+
+
+class DomainEventListener(object):
+    """
+    监听 libvirt 生命周期/重启/设备增删事件, 在缓存中维护每台虚拟机的状态
+    读取方(HostSerializer 等)在 is_listening() 为真时直接读缓存, 不再访问 libvirt
+    """
+
+    def __init__(self, uri=None, heartbeat_interval=5):
+        self.uri = uri or settings.LIBVIRT_URI
+        self.heartbeat_interval = heartbeat_interval
+        self.conn = None
+        self.callback_ids = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        start_event_loop()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='libvirt-domain-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.conn is None or not self.conn.isAlive():
+                    self._disconnect()
+                    self._connect()
+                leases = load_network_leases(self.conn)
+                if leases != get_network_leases():
+                    cache.set(NETWORK_LEASES_KEY, leases, timeout=None)
+                    bump_state_generation()
+                cache.set(LISTENER_KEY, self.uri, timeout=self.heartbeat_interval * 3)
+            except Exception:
+                common_except_log()
+                self._disconnect()
+            self._stop.wait(self.heartbeat_interval)
+        self._disconnect()
+        cache.delete(LISTENER_KEY)
+
+    def _connect(self):
+        # 使用独立连接, 避免连接池中的连接断开重连后丢失事件注册
+        self.conn = libvirt.open(self.uri)
+        try:
+            self.conn.setKeepAlive(self.heartbeat_interval, 3)
+        except libvirt.libvirtError:
+            pass
+        self.callback_ids = [
+            self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                             self._on_lifecycle, None),
+            self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_REBOOT,
+                                             self._on_reboot, None),
+            self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_ADDED,
+                                             self._on_device_changed, None),
+            self.conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED,
+                                             self._on_device_changed, None),
+        ]
+        # 注册完成后再全量同步一次, 保证断线期间的变化不会丢失
+        states = {}
+        for domain, record in self.conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE):
+            states[domain.UUIDString()] = record.get('state.state', 0)
+        cache.set_many(dict((DOMAIN_STATE_KEY.format(x), state) for x, state in states.items()), timeout=None)
+        # 断线期间被删除的虚拟机
+        removed = Host.objects.exclude(instance_uuid__in=states.keys()).values_list('instance_uuid', flat=True)
+        cache.delete_many([DOMAIN_STATE_KEY.format(x) for x in removed])
+        bump_state_generation()
+
+    def _disconnect(self):
+        conn = self.conn
+        self.conn = None
+        if conn is None:
+            return
+        for callback_id in self.callback_ids:
+            try:
+                conn.domainEventDeregisterAny(callback_id)
+            except libvirt.libvirtError:
+                pass
+        self.callback_ids = []
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+    def _set_state(self, instance_uuid, state):
+        if state is None:
+            cache.delete(DOMAIN_STATE_KEY.format(instance_uuid))
+        else:
+            cache.set(DOMAIN_STATE_KEY.format(instance_uuid), state, timeout=None)
+        bump_state_generation()
+
+    def _on_lifecycle(self, conn, domain, event, detail, opaque):
+        instance_uuid = domain.UUIDString()
+        current = get_domain_state(instance_uuid)
+        if event == libvirt.VIR_DOMAIN_EVENT_DEFINED:
+            self._set_state(instance_uuid, libvirt.VIR_DOMAIN_SHUTOFF if current is None else current)
+            create_immediate_task(refresh_host_xml, args=(self.uri, instance_uuid))
+        elif event == libvirt.VIR_DOMAIN_EVENT_UNDEFINED:
+            if current in (None, libvirt.VIR_DOMAIN_SHUTOFF):
+                self._set_state(instance_uuid, None)
+        elif event in LIFECYCLE_STATES:
+            self._set_state(instance_uuid, LIFECYCLE_STATES[event])
+
+    def _on_reboot(self, conn, domain, opaque):
+        self._set_state(domain.UUIDString(), libvirt.VIR_DOMAIN_RUNNING)
+
+    def _on_device_changed(self, conn, domain, dev_alias, opaque):
+        create_immediate_task(refresh_host_xml, args=(self.uri, domain.UUIDString()))
+        bump_state_generation()
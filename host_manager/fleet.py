@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from xml.etree import ElementTree as ET
+
+import libvirt
+
+
+def load_network_leases(conn):
+    """
+    读取所有网络的 DHCP 租约
+    :return: {"<网络名>/<mac>": ip}
+    """
+    lease_map = {}
+    for net in conn.listAllNetworks():
+        net_name = net.name()
+        try:
+            leases = net.DHCPLeases()
+        except libvirt.libvirtError:
+            continue
+        for lease in leases:
+            key = "{}/{}".format(net_name, lease.get("mac"))
+            lease_map[key] = lease.get("ipaddr")
+    return lease_map
+
+
+def parse_interfaces(xml):
+    """
+    从虚拟机 XML 中解析网卡
+    :return: [(网络名, mac)]
+    """
+    interfaces = []
+    root = ET.fromstring(xml)
+    for xml_node in root.findall("./devices/interface"):
+        source = xml_node.find("./source")
+        mac = xml_node.find("./mac")
+        if source is None or mac is None:
+            continue
+        interfaces.append((source.get("network"), mac.get("address")))
+    return interfaces
+
+
+class FleetSnapshot(object):
+    """
+    一次读取得到的虚拟机状态及IP地址, 供列表接口的每一行读取
+    网卡从数据库中保存的虚拟机 XML 解析, 不逐台调用 XMLDesc
+    """
+
+    def __init__(self, states=None, leases=None):
+        self.states = states or {}
+        self.leases = leases or {}
+
+    @classmethod
+    def load(cls, conn, instance_uuid=None):
+        """
+        :param instance_uuid: 只查询这一台虚拟机(详情等单台接口), 为空时一次读取所有虚拟机的状态
+        """
+        states = {}
+        if instance_uuid:
+            try:
+                states[instance_uuid] = conn.lookupByUUIDString(instance_uuid).state()[0]
+            except libvirt.libvirtError:
+                pass
+        else:
+            for domain, record in conn.getAllDomainStats(libvirt.VIR_DOMAIN_STATS_STATE):
+                states[domain.UUIDString()] = record.get('state.state', 0)
+        return cls(states, load_network_leases(conn))
+
+    def get(self, instance_uuid, xml=None):
+        state = self.states.get(instance_uuid)
+        if state is None:
+            return None
+        ipaddrs = []
+        for net_name, mac in parse_interfaces(xml) if xml else []:
+            ip = self.leases.get("{}/{}".format(net_name, mac))
+            if ip:
+                ipaddrs.append(ip)
+        return {
+            "state": state,
+            "ipaddrs": ipaddrs,
+        }
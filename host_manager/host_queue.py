@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import contextlib
+import datetime
+import threading
+import time
+
+from celery import Task, states as task_states
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from common.task_results import load_task_results
+from common.utils import gen_uuid
+from host_manager.models import HostTask
+
+
+def add_entry(host_id, task_id, name):
+    HostTask.objects.create(host_id=host_id, task_id=task_id, name=name)
+
+
+def enqueue(host_id, task, *args):
+    """
+    把任务排入虚拟机的队列并发送, 用法同 task.delay
+    :return: AsyncResult
+    """
+    task_id = gen_uuid()
+    add_entry(host_id, task_id, task.name)
+    return task.apply_async(args, task_id=task_id)
+
+
+def enqueue_on_commit(host_id, task, *args):
+    """
+    在事务中排队, 事务提交后才发送, worker 不会读到未提交的记录; 回滚时排队记录一并回滚
+    :return: 任务id
+    """
+    task_id = gen_uuid()
+    add_entry(host_id, task_id, task.name)
+    transaction.on_commit(lambda: task.apply_async(args, task_id=task_id))
+    return task_id
+
+
+def finish(task_id):
+    HostTask.objects.filter(task_id=task_id).delete()
+
+
+def is_turn(task_id):
+    """
+    任务是否已排到所属虚拟机队列的最前面, 不在队列中的任务直接执行
+    排在前面的记录在以下情况下被清除:
+    - 任务已结束(结果为 READY 状态)
+    - 任务开始执行后心跳超过 HOST_QUEUE_HEARTBEAT_TIMEOUT 没有更新(worker 异常退出)
+    - 任务从未开始执行且创建超过 HOST_QUEUE_ENTRY_TIMEOUT(如消息丢失)
+    """
+    entry = HostTask.objects.filter(task_id=task_id).first()
+    if not entry:
+        return True
+    ahead = {x[0]: x[1:] for x in HostTask.objects.filter(host_id=entry.host_id).filter(
+        Q(create_time__lt=entry.create_time) | Q(create_time=entry.create_time, id__lt=entry.id)).values_list(
+        'task_id', 'create_time', 'heartbeat_time')}
+    if not ahead:
+        return True
+    now = timezone.now()
+    entry_expire = now - datetime.timedelta(seconds=settings.HOST_QUEUE_ENTRY_TIMEOUT)
+    heartbeat_expire = now - datetime.timedelta(seconds=settings.HOST_QUEUE_HEARTBEAT_TIMEOUT)
+
+    def is_dead(create_time, heartbeat_time):
+        if heartbeat_time:
+            return heartbeat_time < heartbeat_expire
+        return create_time < entry_expire
+
+    stale = [x for x, result in load_task_results(ahead.keys()).items()
+             if result['state'] in task_states.READY_STATES or is_dead(*ahead[x])]
+    if stale:
+        HostTask.objects.filter(task_id__in=stale).delete()
+    return len(stale) == len(ahead)
+
+
+@contextlib.contextmanager
+def heartbeat(task_id):
+    """
+    任务执行期间每 HOST_QUEUE_HEARTBEAT_INTERVAL 秒更新一次队列记录的心跳时间
+    """
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while True:
+                HostTask.objects.filter(task_id=task_id).update(heartbeat_time=timezone.now())
+                if stopped.wait(settings.HOST_QUEUE_HEARTBEAT_INTERVAL):
+                    break
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def wait_for_turn(task_id):
+    while not is_turn(task_id):
+        time.sleep(settings.HOST_QUEUE_RETRY_DELAY)
+
+
+def queue_depth(host_id):
+    return HostTask.objects.filter(host_id=host_id).count()
+
+
+class HostQueueTask(Task):
+    """
+    通过 enqueue 发送的任务在轮到自己之前不执行, 稍后重试, 不同虚拟机的任务互不影响
+    在其它任务中直接调用(没有任务id)时不排队
+    """
+
+    def __call__(self, *args, **kwargs):
+        task_id = self.request.id
+        if not task_id:
+            return super(HostQueueTask, self).__call__(*args, **kwargs)
+        if not is_turn(task_id):
+            raise self.retry(countdown=settings.HOST_QUEUE_RETRY_DELAY, max_retries=None)
+        try:
+            # worker 已经压入了带任务id的 request, Task.__call__ 会再压入一个不带id的, 因此直接调用 run
+            with heartbeat(task_id):
+                return self.run(*args, **kwargs)
+        finally:
+            finish(task_id)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from xml.etree import ElementTree as ET
+
+import libvirt
+
+
+def required_pages(mem_size_kb, page_size_kb):
+    return (mem_size_kb + page_size_kb - 1) // page_size_kb
+
+
+def free_pages(conn, page_size_kb, nodes=None):
+    """
+    宿主机空闲的大页数量, libvirt 不支持 getFreePages 时用 capabilities 中的大页总数代替
+    :param nodes: 只统计这些 NUMA 节点, 为空时统计全部
+    """
+    cell_count = max(conn.getInfo()[4], 1)
+    try:
+        pages = conn.getFreePages([page_size_kb], 0, cell_count)
+    except (libvirt.libvirtError, AttributeError):
+        pages = {}
+        for cell in ET.fromstring(conn.getCapabilities()).findall('./host/topology/cells/cell'):
+            for page in cell.findall('./pages'):
+                if int(page.get('size')) == page_size_kb:
+                    pages[int(cell.get('id'))] = {page_size_kb: int(page.text)}
+    return sum(counts.get(page_size_kb, 0) for cell, counts in pages.items() if not nodes or cell in nodes)
+
+
+def check_hugepages(conn, mem_size_kb, page_size_kb, nodes=None):
+    """
+    :return: 空闲大页不足时的错误信息, 足够时返回 None
+    """
+    required = required_pages(mem_size_kb, page_size_kb)
+    free = free_pages(conn, page_size_kb, nodes)
+    if free < required:
+        return "空闲的 {}KiB 大页不足: 需要 {} 页, 空闲 {} 页".format(page_size_kb, required, free)
+    return None
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import contextlib
+import logging
+import os
+import threading
+import time
+
+import libvirt
+from django.conf import settings
+
+logger = logging.getLogger('default')
+
+# 出现这些错误说明连接已不可用(如 libvirtd 重启), 丢弃后下次使用时重连
+CONNECTION_ERROR_CODES = (
+    libvirt.VIR_ERR_SYSTEM_ERROR,
+    libvirt.VIR_ERR_RPC,
+    libvirt.VIR_ERR_NO_CONNECT,
+    libvirt.VIR_ERR_INVALID_CONN,
+)
+
+
+class LibvirtConnectionPool(object):
+    """
+    进程内按 URI 复用 libvirt 连接, libvirt 连接本身可在多线程间共享
+    """
+
+    def __init__(self, keepalive_interval=5, keepalive_count=3, check_interval=10):
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._checked = {}
+        self._pid = os.getpid()
+
+    def get(self, uri=None):
+        uri = uri or settings.LIBVIRT_URI
+        if self._pid != os.getpid():
+            # celery prefork 的子进程不能使用父进程打开的连接
+            self._lock = threading.Lock()
+            self._connections = {}
+            self._checked = {}
+            self._pid = os.getpid()
+        with self._lock:
+            conn = self._connections.get(uri)
+            if conn is not None and not self._is_alive(uri, conn):
+                self._close(uri, conn)
+                conn = None
+            if conn is None:
+                conn = libvirt.open(uri)
+                self._setup(conn)
+                self._connections[uri] = conn
+                self._checked[uri] = time.time()
+            return conn
+
+    def discard(self, uri, conn):
+        uri = uri or settings.LIBVIRT_URI
+        with self._lock:
+            if self._connections.get(uri) is conn:
+                self._close(uri, conn)
+
+    def close_all(self):
+        with self._lock:
+            for uri, conn in list(self._connections.items()):
+                self._close(uri, conn)
+
+    def _setup(self, conn):
+        # keepalive 依赖事件循环处理心跳, 没有运行事件循环的进程(如 celery 子进程)不开启
+        if not is_event_loop_running():
+            return
+        try:
+            conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        except libvirt.libvirtError:
+            pass
+
+    def _is_alive(self, uri, conn):
+        try:
+            if not conn.isAlive():
+                return False
+            now = time.time()
+            if now - self._checked.get(uri, 0) >= self.check_interval:
+                # 未开启 keepalive 时 isAlive 无法发现服务端已断开, 定期用一次轻量调用确认
+                conn.getLibVersion()
+                self._checked[uri] = now
+            return True
+        except libvirt.libvirtError:
+            return False
+
+    def _close(self, uri, conn):
+        self._connections.pop(uri, None)
+        self._checked.pop(uri, None)
+        try:
+            conn.close()
+        except libvirt.libvirtError:
+            pass
+
+
+pool = LibvirtConnectionPool()
+
+_event_loop = {
+    'pid': None,
+    'thread': None,
+}
+_event_loop_lock = threading.Lock()
+
+
+def _run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def is_event_loop_running():
+    thread = _event_loop['thread']
+    return _event_loop['pid'] == os.getpid() and thread is not None and thread.is_alive()
+
+
+def start_event_loop():
+    """
+    注册 libvirt 默认事件循环并在后台线程中运行, 每个进程只启动一次
+    事件循环需在打开连接前启动, 之后打开的连接才能收到事件并开启 keepalive
+    :return:
+    """
+    with _event_loop_lock:
+        if is_event_loop_running():
+            return
+        if _event_loop['pid'] is None:
+            libvirt.virEventRegisterDefaultImpl()
+        thread = threading.Thread(target=_run_event_loop, name='libvirt-event-loop')
+        thread.daemon = True
+        thread.start()
+        _event_loop['pid'] = os.getpid()
+        _event_loop['thread'] = thread
+
+
+@contextlib.contextmanager
+def libvirt_connection(uri=None):
+    """
+    从连接池获取连接, 用法与 `with libvirt.open(uri) as conn` 相同, 但退出时不关闭连接
+    :param uri: 默认为 settings.LIBVIRT_URI
+    :return:
+    """
+    conn = pool.get(uri)
+    try:
+        yield conn
+    except libvirt.libvirtError as ex:
+        if ex.get_error_code() in CONNECTION_ERROR_CODES:
+            logger.warning('drop libvirt connection: %s', ex)
+            pool.discard(uri, conn)
+        raise
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from host_manager.disks import DISK_PROFILE_OPTIONS, create_blank_disk
+
+
+class Command(BaseCommand):
+    help = '测试各硬盘配置首次写入的速度, 使用 qemu-io 直接读写镜像, 不需要 fio 和虚拟机'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help='存放测试镜像的目录, 应与虚拟机硬盘在同一文件系统, 默认为临时目录')
+        parser.add_argument('--size-mb', type=int, default=1024, help='顺序写入的大小')
+        parser.add_argument('--block-kb', type=int, default=64, help='随机写入的块大小')
+        parser.add_argument('--blocks', type=int, default=512, help='随机写入的块数')
+        parser.add_argument('--profiles', nargs='*', default=sorted(DISK_PROFILE_OPTIONS.keys()))
+
+    def qemu_io(self, path, commands):
+        args = ['qemu-io', '-f', 'qcow2', '-t', 'none']
+        for command in commands:
+            args += ['-c', command]
+        with open(os.devnull, 'w') as devnull:
+            start = time.time()
+            subprocess.check_call(args + [path], stdout=devnull)
+            return time.time() - start
+
+    def handle(self, *args, **options):
+        work_dir = tempfile.mkdtemp(dir=options['dir'])
+        size = options['size_mb'] * 1024 * 1024
+        block = options['block_kb'] * 1024
+        # 块在整个镜像内分散, 每块都落在未分配的簇上
+        stride = max(block, size // options['blocks'] // block * block)
+        random_writes = ['write -q {} {}'.format(i * stride, block) for i in range(options['blocks'])]
+        try:
+            for profile in options['profiles']:
+                path = os.path.join(work_dir, '{}.qcow2'.format(profile))
+                start = time.time()
+                create_blank_disk(path, '{}M'.format(options['size_mb']), profile)
+                create_seconds = time.time() - start
+                sequential = self.qemu_io(path, ['write -q 0 {}'.format(size)])
+                os.remove(path)
+
+                create_blank_disk(path, '{}M'.format(options['size_mb']), profile)
+                scattered = self.qemu_io(path, random_writes)
+                os.remove(path)
+                self.stdout.write("{:<18} create={:.2f}s sequential={:.1f}MB/s scattered {}K={:.0f}IOPS".format(
+                    profile, create_seconds, options['size_mb'] / sequential, options['block_kb'],
+                    options['blocks'] / scattered))
+        finally:
+            shutil.rmtree(work_dir)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import time
+from xml.etree import ElementTree as ET
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from common.utils import gen_uuid, new_mac
+from host_manager.models import Host, HostStorage, HostNetwork, HOST_STORAGE_DEVICE_DISK
+from host_manager.xml_templates import TEMPLATE_DIR, render_domain_xml
+
+
+def render_from_files(host, storages, networks):
+    """
+    旧的生成方式: 每台虚拟机及每个设备都重新读取并解析模板文件, 作为对照
+    """
+    template_dir = os.path.join(settings.BASE_DIR, TEMPLATE_DIR)
+    with open(os.path.join(template_dir, 'host.xml'), 'r') as f:
+        host_root = ET.fromstring(f.read())
+    host_root.find("./uuid").text = host.instance_uuid
+    host_root.find("./name").text = host.instance_name
+    host_root.find("./memory").text = str(host.mem_size_kb)
+    host_root.find("./currentMemory").text = str(host.mem_size_kb)
+    host_root.find("./vcpu").text = str(host.cpu_core)
+    host_root.find("./devices/graphics").attrib['port'] = str(host.vnc_port)
+    for storage in storages:
+        with open(os.path.join(template_dir, 'storage/disk.xml'), 'r') as f:
+            disk_root = ET.fromstring(f.read())
+        disk_root.find("./source").attrib['file'] = storage.path
+        disk_root.find("./target").attrib['dev'] = storage.dev
+        disk_root.find("./target").attrib['bus'] = storage.bus
+        host_root.find("./devices").append(disk_root)
+    for network in networks:
+        with open(os.path.join(template_dir, 'network.xml'), 'r') as f:
+            network_root = ET.fromstring(f.read())
+        network_root.find("./mac").attrib['address'] = network.mac
+        network_root.find("./source").attrib['network'] = network.network_name
+        host_root.find("./devices").append(network_root)
+    return ET.tostring(host_root)
+
+
+class Command(BaseCommand):
+    help = '测试生成虚拟机 XML 的速度(次/秒), 不访问数据库和 libvirt'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--disks', type=int, default=8)
+        parser.add_argument('--nics', type=int, default=4)
+        parser.add_argument('--seconds', type=float, default=3)
+
+    def measure(self, func, args, seconds):
+        count = 0
+        start = time.time()
+        while time.time() - start < seconds:
+            func(*args)
+            count += 1
+        return count / (time.time() - start)
+
+    def handle(self, *args, **options):
+        instance_uuid = gen_uuid()
+        host = Host(instance_uuid=instance_uuid, instance_name='instance_' + instance_uuid,
+                    cpu_core=4, mem_size_kb=4 * 1024 * 1024, vnc_port=5900)
+        storages = []
+        for i in range(options['disks']):
+            storages.append(HostStorage(device=HOST_STORAGE_DEVICE_DISK, dev="vd{}".format(chr(0x61 + i)),
+                                        bus='virtio', path='/data/disk{}.qcow2'.format(i)))
+        networks = [HostNetwork(mac=new_mac(), network_name='default') for i in range(options['nics'])]
+        render_args = (host, storages, networks)
+
+        for name, func in (('files', render_from_files), ('cached', render_domain_xml)):
+            rate = self.measure(func, render_args, options['seconds'])
+            self.stdout.write("{:<8} disks={} nics={}: {:.0f} renders/s".format(
+                name, options['disks'], options['nics'], rate))
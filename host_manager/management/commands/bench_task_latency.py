@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from host_manager.bench_tasks import bench_bulk_io, bench_interactive
+from vm_manager.celery import DEFAULT_QUEUE, route_task
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+class Command(BaseCommand):
+    help = '在长时间磁盘任务运行时测量交互任务的排队延迟, 需要以 -I host_manager.bench_tasks 启动的 worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bulk', type=int, default=8, help='同时提交的长任务数')
+        parser.add_argument('--bulk-seconds', type=float, default=30, help='每个长任务的秒数')
+        parser.add_argument('--samples', type=int, default=20, help='交互任务的采样次数')
+        parser.add_argument('--interval', type=float, default=0.5)
+        parser.add_argument('--timeout', type=float, default=300)
+        parser.add_argument('--single-queue', action='store_true', help='全部发送到默认队列, 作为对照')
+
+    def handle(self, *args, **options):
+        # 按真实任务的路由发送, 对照组全部发送到默认队列
+        if options['single_queue']:
+            bulk_route = interactive_route = {'queue': DEFAULT_QUEUE}
+        else:
+            bulk_route = route_task('host_manager.tasks.save_disk_to_base', (), {}, {})
+            interactive_route = route_task('host_manager.tasks.host_action', (), {}, {})
+        bulk_results = [bench_bulk_io.apply_async((options['bulk_seconds'],), **bulk_route)
+                        for i in range(options['bulk'])]
+        time.sleep(1)
+
+        waits = []
+        round_trips = []
+        try:
+            for i in range(options['samples']):
+                sent_time = time.time()
+                result = bench_interactive.apply_async((sent_time,), **interactive_route)
+                waits.append(result.get(timeout=options['timeout']))
+                round_trips.append(time.time() - sent_time)
+                time.sleep(options['interval'])
+        finally:
+            for result in bulk_results:
+                result.revoke()
+
+        for name, values in (('wait', waits), ('round trip', round_trips)):
+            self.stdout.write("{:<10} p50={:.3f}s p95={:.3f}s max={:.3f}s".format(
+                name, percentile(values, 50), percentile(values, 95), max(values)))
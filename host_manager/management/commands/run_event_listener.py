@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from host_manager.events import DomainEventListener
+
+
+class Command(BaseCommand):
+    help = '监听 libvirt 事件维护虚拟机状态缓存, 每个 libvirt 节点只运行一个, 不要在 web/worker 进程内启动'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--uri', default=None, help='默认为 LIBVIRT_URI')
+        parser.add_argument('--heartbeat-interval', type=int, default=5)
+
+    def handle(self, *args, **options):
+        listener = DomainEventListener(options['uri'], options['heartbeat_interval'])
+        listener.start()
+        self.stdout.write("listening on {}".format(listener.uri))
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.stop()
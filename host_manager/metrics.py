@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals, division
+
+import bisect
+import json
+import struct
+from array import array
+
+import libvirt
+from django.conf import settings
+
+METRIC_FIELDS = (
+    'cpu_percent',
+    'mem_kb',
+    'disk_read_bps',
+    'disk_write_bps',
+    'net_rx_bps',
+    'net_tx_bps',
+)
+
+COLLECT_STATS = (libvirt.VIR_DOMAIN_STATS_STATE | libvirt.VIR_DOMAIN_STATS_CPU_TOTAL |
+                 libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU |
+                 libvirt.VIR_DOMAIN_STATS_INTERFACE | libvirt.VIR_DOMAIN_STATS_BLOCK)
+
+# (名称, 每个点的秒数), 按粒度从细到粗排列
+RESOLUTIONS = (
+    ('raw', 0),
+    ('minute', 60),
+    ('hour', 3600),
+)
+
+
+def _to_bytes(data):
+    if hasattr(data, 'tobytes'):
+        return data.tobytes()
+    return data.tostring()
+
+
+def _from_bytes(data, raw):
+    if hasattr(data, 'frombytes'):
+        data.frombytes(raw)
+    else:
+        data.fromstring(raw)
+
+
+class RingBuffer(object):
+    """
+    定长环形缓冲区, 所有点按行存放在一个 array('d') 中: [时间戳, 字段1, 字段2, ...]
+    写满后覆盖最旧的点, 序列化后为定长二进制, 读取时不需要逐行查询数据库
+    """
+    header = struct.Struct(str('<IIII'))
+
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.head = 0
+        self.size = 0
+        self.data = array(str('d'), [0.0]) * (capacity * (width + 1))
+
+    def __len__(self):
+        return self.size
+
+    def _offset(self, index):
+        """
+        逻辑下标(0 为最旧的点)转换为 array 中的偏移
+        """
+        return ((self.head - self.size + index) % self.capacity) * (self.width + 1)
+
+    def append(self, timestamp, values):
+        offset = self.head * (self.width + 1)
+        self.data[offset] = timestamp
+        for i, value in enumerate(values):
+            self.data[offset + 1 + i] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def timestamp(self, index):
+        return self.data[self._offset(index)]
+
+    def rows(self, since=None):
+        start = 0
+        if since is not None:
+            timestamps = _TimestampView(self)
+            start = bisect.bisect_left(timestamps, since)
+        for index in range(start, self.size):
+            offset = self._offset(index)
+            yield self.data[offset], self.data[offset + 1:offset + 1 + self.width]
+
+    def to_bytes(self):
+        return self.header.pack(self.capacity, self.width, self.head, self.size) + _to_bytes(self.data)
+
+    @classmethod
+    def from_bytes(cls, raw, capacity, width):
+        buf = cls(capacity, width)
+        if not raw:
+            return buf
+        raw = bytes(raw)
+        old_capacity, old_width, head, size = cls.header.unpack_from(raw)
+        if old_capacity == capacity and old_width == width:
+            buf.data = array(str('d'))
+            _from_bytes(buf.data, raw[cls.header.size:])
+            buf.head = head
+            buf.size = size
+            return buf
+        # 容量或字段数变化时按旧数据重新写入
+        old = cls(old_capacity, old_width)
+        old.data = array(str('d'))
+        _from_bytes(old.data, raw[cls.header.size:])
+        old.head = head
+        old.size = size
+        for timestamp, values in old.rows():
+            values = list(values[:width]) + [0.0] * max(0, width - old_width)
+            buf.append(timestamp, values)
+        return buf
+
+
+class _TimestampView(object):
+    """
+    供 bisect 使用的只读时间戳序列
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.buf)
+
+    def __getitem__(self, index):
+        return self.buf.timestamp(index)
+
+
+def read_counters(record):
+    """
+    从 getAllDomainStats 的一条记录中读取累计计数器
+    """
+    counters = {
+        'cpu_time': record.get('cpu.time', 0),
+        'vcpus': record.get('vcpu.current', 1) or 1,
+        'mem_kb': record.get('balloon.rss', record.get('balloon.current', 0)),
+        'rd_bytes': 0,
+        'wr_bytes': 0,
+        'rx_bytes': 0,
+        'tx_bytes': 0,
+    }
+    for i in range(record.get('block.count', 0)):
+        counters['rd_bytes'] += record.get('block.{}.rd.bytes'.format(i), 0)
+        counters['wr_bytes'] += record.get('block.{}.wr.bytes'.format(i), 0)
+    for i in range(record.get('net.count', 0)):
+        counters['rx_bytes'] += record.get('net.{}.rx.bytes'.format(i), 0)
+        counters['tx_bytes'] += record.get('net.{}.tx.bytes'.format(i), 0)
+    return counters
+
+
+def derive_rates(previous, current, seconds):
+    """
+    由两次计数器的差值计算速率, 计数器回退(虚拟机重启)时返回 None
+    """
+    if seconds <= 0:
+        return None
+    deltas = {}
+    for key in ('cpu_time', 'rd_bytes', 'wr_bytes', 'rx_bytes', 'tx_bytes'):
+        delta = current[key] - previous.get(key, 0)
+        if delta < 0:
+            return None
+        deltas[key] = delta
+    return [
+        deltas['cpu_time'] / (seconds * 1e9 * current['vcpus']) * 100,
+        current['mem_kb'],
+        deltas['rd_bytes'] / seconds,
+        deltas['wr_bytes'] / seconds,
+        deltas['rx_bytes'] / seconds,
+        deltas['tx_bytes'] / seconds,
+    ]
+
+
+class MetricSeries(object):
+    """
+    包装 HostMetrics 记录, 负责原始点写入以及分钟/小时汇总
+    """
+
+    def __init__(self, instance):
+        self.instance = instance
+        width = len(METRIC_FIELDS)
+        capacities = settings.METRICS_CAPACITY
+        self.buffers = {}
+        for name, step in RESOLUTIONS:
+            raw = getattr(instance, '{}_data'.format(name))
+            self.buffers[name] = RingBuffer.from_bytes(raw, capacities[name], width)
+        self.state = json.loads(instance.state) if instance.state else {}
+        # 有新点的缓冲区, 保存时只写入这些字段
+        self.dirty = set()
+
+    def record(self, timestamp, counters, max_gap=None):
+        previous = self.state.get('counters')
+        previous_time = self.state.get('time')
+        self.state['counters'] = counters
+        self.state['time'] = timestamp
+        if not previous:
+            return
+        if max_gap and timestamp - previous_time > max_gap:
+            # 中间有缺失(采集停止或虚拟机关机), 不用跨度过大的差值计算速率
+            return
+        values = derive_rates(previous, counters, timestamp - previous_time)
+        if values is None:
+            return
+        self.buffers['raw'].append(timestamp, values)
+        self.dirty.add('raw')
+        rollups = self.state.setdefault('rollups', {})
+        for name, step in RESOLUTIONS:
+            if not step:
+                continue
+            bucket = timestamp - timestamp % step
+            pending = rollups.get(name)
+            if pending and pending['start'] != bucket:
+                averages = [x / pending['count'] for x in pending['sums']]
+                self.buffers[name].append(pending['start'], averages)
+                self.dirty.add(name)
+                pending = None
+            if not pending:
+                pending = {'start': bucket, 'count': 0, 'sums': [0.0] * len(values)}
+            pending['count'] += 1
+            pending['sums'] = [x + y for x, y in zip(pending['sums'], values)]
+            rollups[name] = pending
+
+    def save(self):
+        """
+        分钟和小时缓冲区每分钟/每小时才有新点, 已有记录只更新变化的字段
+        """
+        adding = self.instance._state.adding
+        names = [name for name, step in RESOLUTIONS if adding or name in self.dirty]
+        for name in names:
+            setattr(self.instance, '{}_data'.format(name), self.buffers[name].to_bytes())
+        self.instance.state = json.dumps(self.state)
+        if adding:
+            self.instance.save()
+        else:
+            self.instance.save(update_fields=['state', 'modify_time'] + ['{}_data'.format(x) for x in names])
+        self.dirty.clear()
+
+    def select_resolution(self, since=None, step=None):
+        """
+        指定 step 时选择不超过 step 的最粗粒度, 否则选择能覆盖 since 的最细粒度
+        """
+        if step:
+            selected = RESOLUTIONS[0][0]
+            for name, seconds in RESOLUTIONS:
+                if seconds <= step:
+                    selected = name
+            return selected
+        for name, seconds in RESOLUTIONS:
+            buf = self.buffers[name]
+            if len(buf) and (since is None or buf.timestamp(0) <= since):
+                return name
+        return RESOLUTIONS[0][0]
+
+    def series(self, since=None, step=None):
+        name = self.select_resolution(since, step)
+        data = {
+            "resolution": name,
+            "timestamps": [],
+        }
+        for field in METRIC_FIELDS:
+            data[field] = []
+        for timestamp, values in self.buffers[name].rows(since):
+            data['timestamps'].append(int(timestamp))
+            for field, value in zip(METRIC_FIELDS, values):
+                data[field].append(round(value, 2))
+        return data
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:00
+from __future__ import unicode_literals
+
+import common.utils
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0005_auto_20191211_1354'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HostMetrics',
+            fields=[
+                ('id', models.CharField(default=common.utils.gen_uuid, max_length=50, primary_key=True, serialize=False, verbose_name='uuid \u552f\u4e00\u6807\u793a\u7b26')),
+                ('create_time', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='\u521b\u5efa\u65f6\u95f4')),
+                ('modify_time', models.DateTimeField(auto_now=True, db_index=True, null=True, verbose_name='\u4fee\u6539\u65f6\u95f4')),
+                ('is_delete', models.BooleanField(db_index=True, default=False, verbose_name='\u5220\u9664\u6807\u8bb0')),
+                ('delete_time', models.DateTimeField(db_index=True, null=True, verbose_name='\u5220\u9664\u65f6\u95f4')),
+                ('raw_data', models.BinaryField(null=True)),
+                ('minute_data', models.BinaryField(null=True)),
+                ('hour_data', models.BinaryField(null=True)),
+                ('state', models.TextField(null=True)),
+                ('host', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, to='host_manager.Host')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0006_hostmetrics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hoststorage',
+            name='backing_path',
+            field=models.CharField(max_length=300, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:06
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0007_hoststorage_backing_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='batch_id',
+            field=models.CharField(db_index=True, max_length=50, null=True),
+        ),
+    ]
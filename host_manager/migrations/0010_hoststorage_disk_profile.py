@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0009_hosttask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hoststorage',
+            name='disk_profile',
+            field=models.CharField(choices=[('thin', '\u7cbe\u7b80\u7f6e\u5907'), ('metadata-prealloc', '\u9884\u5206\u914d\u5143\u6570\u636e'), ('full-falloc', '\u9884\u5206\u914d\u7a7a\u95f4'), ('large-cluster', '\u5927\u7c07')], max_length=20, null=True),
+        ),
+    ]
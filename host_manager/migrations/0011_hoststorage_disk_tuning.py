@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0010_hoststorage_disk_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='hoststorage',
+            name='cache',
+            field=models.CharField(choices=[('none', 'none'), ('writethrough', 'writethrough'), ('writeback', 'writeback'), ('directsync', 'directsync'), ('unsafe', 'unsafe')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='hoststorage',
+            name='discard',
+            field=models.CharField(choices=[('unmap', 'unmap'), ('ignore', 'ignore')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='hoststorage',
+            name='io',
+            field=models.CharField(choices=[('native', 'native'), ('threads', 'threads'), ('io_uring', 'io_uring')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='hoststorage',
+            name='iothread',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:13
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0011_hoststorage_disk_tuning'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='cpuset',
+            field=models.CharField(max_length=200, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='numa_nodes',
+            field=models.CharField(max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:15
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0012_host_placement'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='hugepage_size_kb',
+            field=models.IntegerField(blank=True, choices=[(2048, '2M'), (1048576, '1G')], null=True),
+        ),
+    ]
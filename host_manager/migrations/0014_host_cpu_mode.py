@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:16
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0013_host_hugepage_size_kb'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='cpu_mode',
+            field=models.CharField(blank=True, choices=[('legacy', '\u517c\u5bb9\u6a21\u5f0f(IvyBridge)'), ('host-passthrough', '\u76f4\u901a\u5bbf\u4e3b\u673aCPU'), ('host-model', '\u5bbf\u4e3b\u673aCPU\u578b\u53f7'), ('custom', '\u6307\u5b9a\u578b\u53f7'), ('baseline', '\u6240\u6709\u8282\u70b9\u7684\u516c\u5171\u578b\u53f7')], max_length=20, null=True),
+        ),
+        migrations.AddField(
+            model_name='host',
+            name='cpu_model',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0014_host_cpu_mode'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='host',
+            name='spare_pool',
+            field=models.CharField(db_index=True, max_length=200, null=True),
+        ),
+    ]
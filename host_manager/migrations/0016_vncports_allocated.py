@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.23 on 2026-10-18 19:20
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def mark_allocated(apps, schema_editor):
+    # 之前只为已分配的端口保存记录
+    apps.get_model('host_manager', 'VncPorts').objects.update(allocated=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('host_manager', '0015_host_spare_pool'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vncports',
+            name='allocated',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.RunPython(mark_allocated, migrations.RunPython.noop),
+    ]
@@ -1,31 +1,41 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-import django
 from django.db import models
 
 from common.models import BaseModel
 
 
 class VncPorts(models.Model):
+    """
+    VNC 端口的空闲列表, 分配与释放见 host_manager.vnc_ports
+    """
     value = models.IntegerField(unique=True)
+    allocated = models.BooleanField(default=False, db_index=True)
 
     class Meta:
         ordering = ['-value']
 
 
-def new_vnc_port():
-    while True:
-        port = VncPorts.objects.all().first()
-        if port:
-            new_port = port.value + 1
-        else:
-            new_port = 5900
-        try:
-            VncPorts.objects.create(value=new_port)
-            return new_port
-        except django.db.IntegrityError:
-            continue
+HUGEPAGE_SIZES = (
+    (2048, '2M'),
+    (1048576, '1G'),
+)
+
+
+CPU_MODE_LEGACY = 'legacy'
+CPU_MODE_HOST_PASSTHROUGH = 'host-passthrough'
+CPU_MODE_HOST_MODEL = 'host-model'
+CPU_MODE_CUSTOM = 'custom'
+CPU_MODE_BASELINE = 'baseline'
+
+CPU_MODES = (
+    (CPU_MODE_LEGACY, '兼容模式(IvyBridge)'),
+    (CPU_MODE_HOST_PASSTHROUGH, '直通宿主机CPU'),
+    (CPU_MODE_HOST_MODEL, '宿主机CPU型号'),
+    (CPU_MODE_CUSTOM, '指定型号'),
+    (CPU_MODE_BASELINE, '所有节点的公共型号'),
+)
 
 
 class Host(BaseModel):
@@ -39,6 +49,17 @@ class Host(BaseModel):
     xml = models.TextField(null=True)
     last_task_id = models.CharField(max_length=50, null=True)
     last_task_name = models.CharField(max_length=100, null=True)
+    batch_id = models.CharField(max_length=50, null=True, db_index=True)
+    # 绑定的 pCPU 与 NUMA 节点, 如 '0-3' 和 '0', 见 host_manager.numa
+    cpuset = models.CharField(max_length=200, null=True)
+    numa_nodes = models.CharField(max_length=50, null=True)
+    # 使用大页时的页大小(KiB), 为空时使用普通内存页
+    hugepage_size_kb = models.IntegerField(choices=HUGEPAGE_SIZES, null=True, blank=True)
+    # 为空时使用 DEFAULT_CPU_MODE, cpu_model 仅在 custom 模式下使用
+    cpu_mode = models.CharField(choices=CPU_MODES, max_length=20, null=True, blank=True)
+    cpu_model = models.CharField(max_length=50, null=True, blank=True)
+    # 备用虚拟机所属的池, 见 host_manager.spare_pool, 领用后置空; 不为空时不在列表中显示
+    spare_pool = models.CharField(max_length=200, null=True, db_index=True)
 
     class Meta:
         ordering = ['-create_time']
@@ -53,12 +74,53 @@ HOST_STORAGE_DEVICES = (
 )
 
 
+DISK_PROFILE_THIN = 'thin'
+DISK_PROFILE_METADATA_PREALLOC = 'metadata-prealloc'
+DISK_PROFILE_FULL_FALLOC = 'full-falloc'
+DISK_PROFILE_LARGE_CLUSTER = 'large-cluster'
+
+DISK_PROFILES = (
+    (DISK_PROFILE_THIN, '精简置备'),
+    (DISK_PROFILE_METADATA_PREALLOC, '预分配元数据'),
+    (DISK_PROFILE_FULL_FALLOC, '预分配空间'),
+    (DISK_PROFILE_LARGE_CLUSTER, '大簇'),
+)
+
+
+DISK_CACHE_MODES = (
+    ('none', 'none'),
+    ('writethrough', 'writethrough'),
+    ('writeback', 'writeback'),
+    ('directsync', 'directsync'),
+    ('unsafe', 'unsafe'),
+)
+
+DISK_IO_MODES = (
+    ('native', 'native'),
+    ('threads', 'threads'),
+    ('io_uring', 'io_uring'),
+)
+
+DISK_DISCARD_MODES = (
+    ('unmap', 'unmap'),
+    ('ignore', 'ignore'),
+)
+
+
 class HostStorage(BaseModel):
     host = models.ForeignKey(Host)
     device = models.CharField(choices=HOST_STORAGE_DEVICES, max_length=10)
     dev = models.CharField(max_length=20)
     bus = models.CharField(max_length=20)
     path = models.CharField(max_length=300)
+    backing_path = models.CharField(max_length=300, null=True)
+    disk_profile = models.CharField(choices=DISK_PROFILES, max_length=20, null=True)
+    # 以下为空时使用模板中的默认配置
+    cache = models.CharField(choices=DISK_CACHE_MODES, max_length=20, null=True)
+    io = models.CharField(choices=DISK_IO_MODES, max_length=20, null=True)
+    discard = models.CharField(choices=DISK_DISCARD_MODES, max_length=20, null=True)
+    # 是否为该硬盘分配独立的 IOThread
+    iothread = models.BooleanField(default=False)
 
     class Meta:
         ordering = ['create_time']
@@ -86,3 +148,28 @@ class HostSnapshot(BaseModel):
 
     class Meta:
         ordering = ['-create_time']
+
+
+class HostMetrics(BaseModel):
+    """
+    每台虚拟机一条记录, 各粒度的监控数据以环形缓冲区的二进制形式保存, 见 host_manager.metrics
+    """
+    host = models.OneToOneField(Host)
+    raw_data = models.BinaryField(null=True)
+    minute_data = models.BinaryField(null=True)
+    hour_data = models.BinaryField(null=True)
+    state = models.TextField(null=True)
+
+
+class HostTask(BaseModel):
+    """
+    虚拟机的任务队列, 同一台虚拟机的任务按创建顺序依次执行, 见 host_manager.host_queue
+    """
+    host = models.ForeignKey(Host)
+    task_id = models.CharField(max_length=50, unique=True)
+    name = models.CharField(max_length=100)
+    # 开始执行后定期更新, 为空表示尚未开始执行
+    heartbeat_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['create_time', 'id']
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from xml.etree import ElementTree as ET
+
+from django.db import transaction
+
+from host_manager.models import Host
+
+
+def parse_cpuset(value):
+    """
+    '0-3,8,10-11' -> [0, 1, 2, 3, 8, 10, 11]
+    """
+    cpus = set()
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpuset(cpus):
+    """
+    [0, 1, 2, 3, 8] -> '0-3,8'
+    """
+    parts = []
+    cpus = sorted(set(cpus))
+    index = 0
+    while index < len(cpus):
+        end = index
+        while end + 1 < len(cpus) and cpus[end + 1] == cpus[end] + 1:
+            end += 1
+        if end == index:
+            parts.append(str(cpus[index]))
+        else:
+            parts.append('{}-{}'.format(cpus[index], cpus[end]))
+        index = end + 1
+    return ','.join(parts)
+
+
+class Cell(object):
+    def __init__(self, cell_id, memory_kb, cores):
+        """
+        :param cores: 按物理核分组的 pCPU, [[0, 8], [1, 9], ...], 同组为超线程兄弟
+        """
+        self.id = cell_id
+        self.memory_kb = memory_kb
+        self.cores = cores
+
+    @property
+    def cpus(self):
+        return sorted(x for core in self.cores for x in core)
+
+
+class NodeTopology(object):
+    """
+    宿主机的 NUMA 拓扑, 来自 conn.getCapabilities() 的 host/topology
+    """
+
+    def __init__(self, cells):
+        self.cells = cells
+
+    @classmethod
+    def from_capabilities(cls, xml):
+        root = ET.fromstring(xml)
+        cells = []
+        for cell in root.findall('./host/topology/cells/cell'):
+            memory = cell.find('./memory')
+            memory_kb = int(memory.text) if memory is not None else 0
+            cores = []
+            seen = set()
+            for cpu in cell.findall('./cpus/cpu'):
+                cpu_id = int(cpu.get('id'))
+                if cpu_id in seen:
+                    continue
+                # 旧版本 libvirt 没有 siblings 属性, 每个 pCPU 视为一个核
+                siblings = parse_cpuset(cpu.get('siblings')) or [cpu_id]
+                seen.update(siblings)
+                cores.append(siblings)
+            cells.append(Cell(int(cell.get('id')), memory_kb, cores))
+        return cls(cells)
+
+    @property
+    def cpus(self):
+        return sorted(x for cell in self.cells for x in cell.cpus)
+
+
+class Placement(object):
+    def __init__(self, cpus, nodes):
+        """
+        :param cpus: 分配的 pCPU, 排序后依次绑定到 vCPU 0, 1, ...
+        :param nodes: 使用的 NUMA 节点
+        """
+        self.cpus = sorted(cpus)
+        self.nodes = sorted(nodes)
+
+    @property
+    def cpuset(self):
+        return format_cpuset(self.cpus)
+
+    @property
+    def nodeset(self):
+        return format_cpuset(self.nodes)
+
+
+def take_cpus(cores, used, count):
+    """
+    优先占用整个物理核, 让同一虚拟机的 vCPU 落在超线程兄弟上, 不与其它虚拟机共享物理核
+    """
+    free_cores = [[x for x in core if x not in used] for core in cores]
+    free_cores = [x for x in free_cores if x]
+    free_cores.sort(key=lambda x: -len(x))
+    cpus = []
+    for core in free_cores:
+        for cpu in core:
+            if len(cpus) == count:
+                return cpus
+            cpus.append(cpu)
+    return cpus
+
+
+def place(topology, vcpus, mem_size_kb, allocations):
+    """
+    为虚拟机选择 pCPU 和 NUMA 节点, 只依赖参数, 可离线测试
+    优先放进单个 NUMA 节点(空闲 pCPU 足够且剩余内存最多的节点), 否则跨节点, pCPU 不足时返回 None 不绑定
+    :param allocations: 其它虚拟机已占用的 [(cpus, nodes, mem_size_kb), ...]
+    :return: Placement 或 None
+    """
+    used = set()
+    node_memory = dict((cell.id, cell.memory_kb) for cell in topology.cells)
+    for cpus, nodes, mem in allocations:
+        used.update(cpus)
+        for node in nodes:
+            if node in node_memory:
+                node_memory[node] -= mem / len(nodes)
+
+    candidates = []
+    for cell in topology.cells:
+        free = len([x for x in cell.cpus if x not in used])
+        if free >= vcpus and node_memory[cell.id] >= mem_size_kb:
+            candidates.append((node_memory[cell.id], free, cell))
+    if candidates:
+        candidates.sort(key=lambda x: (-x[0], -x[1], x[2].id))
+        cell = candidates[0][2]
+        return Placement(take_cpus(cell.cores, used, vcpus), [cell.id])
+
+    cpus = []
+    nodes = []
+    cells = sorted(topology.cells, key=lambda x: -len([c for c in x.cpus if c not in used]))
+    for cell in cells:
+        if len(cpus) == vcpus:
+            break
+        taken = take_cpus(cell.cores, used, vcpus - len(cpus))
+        if taken:
+            cpus.extend(taken)
+            nodes.append(cell.id)
+    if len(cpus) < vcpus:
+        return None
+    return Placement(cpus, sorted(nodes))
+
+
+def host_placement(host):
+    if not host.cpuset:
+        return None
+    return Placement(parse_cpuset(host.cpuset), parse_cpuset(host.numa_nodes))
+
+
+def assign_placement(host, topology):
+    """
+    为虚拟机分配并保存 pCPU 与 NUMA 节点, 已有且仍然有效的分配保持不变
+    锁定所有虚拟机记录, 避免并发定义的虚拟机分到同样的 pCPU
+    :return: Placement 或 None
+    """
+    with transaction.atomic():
+        others = list(Host.objects.select_for_update().filter(is_delete=False).exclude(id=host.id).values_list(
+            'cpuset', 'numa_nodes', 'mem_size_kb'))
+        allocations = [(parse_cpuset(cpus), parse_cpuset(nodes), mem) for cpus, nodes, mem in others if cpus]
+        current = host_placement(host)
+        if current:
+            used = set(x for cpus, nodes, mem in allocations for x in cpus)
+            if len(current.cpus) == host.cpu_core and not used.intersection(current.cpus) and \
+                    set(current.cpus).issubset(topology.cpus):
+                return current
+        placement = place(topology, host.cpu_core, host.mem_size_kb, allocations)
+        host.cpuset = placement.cpuset if placement else None
+        host.numa_nodes = placement.nodeset if placement else None
+        Host.objects.filter(id=host.id).update(cpuset=host.cpuset, numa_nodes=host.numa_nodes)
+        return placement
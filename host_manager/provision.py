@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+
+from django.conf import settings
+
+from common.utils import new_mac
+from host_manager.disks import CLONE_MODE_LINKED, copy_file, create_blank_disk, create_linked_clone
+from host_manager.models import HostStorage, HOST_STORAGE_DEVICE_DISK, HOST_STORAGE_DEVICE_CDROM, HostNetwork
+
+
+def vm_data_dir(host):
+    path = os.path.join(settings.VM_DATA_DIR, host.instance_name)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def build_storages(host, is_from_iso, base_disk_name, iso_names, clone_mode=None, disk_profile=None):
+    """
+    生成新虚拟机的硬盘和光驱记录(未保存), 第一个为系统盘 vda
+    :param disk_profile: 从光盘安装时新建系统盘的配置
+    :return:
+    """
+    data_dir = os.path.join(settings.VM_DATA_DIR, host.instance_name)
+    backing_path = None
+    if not is_from_iso:
+        disk_profile = None
+        disk_path = os.path.join(data_dir, base_disk_name)
+        if (clone_mode or settings.DEFAULT_CLONE_MODE) == CLONE_MODE_LINKED:
+            disk_path = os.path.splitext(disk_path)[0] + '.qcow2'
+            backing_path = os.path.join(settings.VM_BASE_DISKS_DIR, base_disk_name)
+    else:
+        disk_profile = disk_profile or settings.DEFAULT_DISK_PROFILE
+        disk_path = ""
+        for i in range(100):
+            disk_path = os.path.join(data_dir, "root_disk{}.qcow2".format(i))
+            if not os.path.exists(disk_path):
+                break
+
+    storages = [HostStorage(host=host, device=HOST_STORAGE_DEVICE_DISK, path=disk_path, backing_path=backing_path,
+                            disk_profile=disk_profile, dev='vda', bus='virtio')]
+    if is_from_iso:
+        for index, item in enumerate(iso_names):
+            storages.append(HostStorage(host=host, device=HOST_STORAGE_DEVICE_CDROM,
+                                        path=os.path.join(settings.VM_ISO_DIR, item),
+                                        dev="hd{}".format(chr(0x61 + index)), bus='ide'))
+    return storages
+
+
+def build_networks(host, network_names):
+    return [HostNetwork(host=host, mac=new_mac(), network_name=x) for x in network_names]
+
+
+def is_full_copy(storage, is_from_iso):
+    """
+    系统盘是否需要完整复制基础镜像; 链接克隆和新建空白硬盘只写少量元数据
+    """
+    return bool(storage) and not is_from_iso and not storage.backing_path
+
+
+def create_root_disk(storage, is_from_iso, base_disk_name, init_disk_size_gb, progress=None):
+    """
+    创建系统盘文件: 链接克隆、完整复制基础镜像或新建空白硬盘
+    :param storage: build_storages 生成的系统盘
+    :param progress: 完整复制时的进度回调 progress(done, total)
+    :return:
+    """
+    vm_data_dir(storage.host)
+    if not is_from_iso:
+        base_path = os.path.join(settings.VM_BASE_DISKS_DIR, base_disk_name)
+        if storage.backing_path:
+            create_linked_clone(base_path, storage.path)
+        else:
+            copy_file(base_path, storage.path, progress)
+    else:
+        create_blank_disk(storage.path, '{}G'.format(init_disk_size_gb), storage.disk_profile)
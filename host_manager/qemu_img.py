@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+import subprocess
+import threading
+
+from concurrent import futures
+from django.conf import settings
+
+PROGRESS_RE = re.compile(r'\(([\d.]+)/100%\)')
+
+
+class QemuImgError(Exception):
+    def __init__(self, args, returncode, stderr):
+        self.command = args
+        self.returncode = returncode
+        self.stderr = stderr
+        super(QemuImgError, self).__init__("qemu-img {} 失败({}): {}".format(
+            args[1] if len(args) > 1 else '', returncode, (stderr or '').strip()))
+
+
+class QemuImgTimeout(QemuImgError):
+    """
+    超过 timeout 秒被结束的 qemu-img
+    """
+    def __init__(self, args, returncode, stderr, timeout):
+        self.command = args
+        self.returncode = returncode
+        self.stderr = stderr
+        self.timeout = timeout
+        super(QemuImgError, self).__init__("qemu-img {} 超时, 已在 {} 秒后结束".format(
+            args[1] if len(args) > 1 else '', timeout))
+
+
+def _kill(process, killed):
+    killed.set()
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+
+def run(args, timeout=None, on_output=None):
+    """
+    执行 qemu-img, 超时后结束进程并抛出 QemuImgTimeout
+    :param args: qemu-img 之后的参数列表
+    :param timeout: 秒数, None 时使用 QEMU_IMG_TIMEOUT, 0 表示不限制
+    :param on_output: 逐段读取标准输出的回调, 用于解析进度
+    :return: 标准输出
+    """
+    args = ['qemu-img'] + [str(x) for x in args]
+    timeout = settings.QEMU_IMG_TIMEOUT if timeout is None else timeout
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    timer = None
+    killed = threading.Event()
+    if timeout:
+        timer = threading.Timer(timeout, _kill, (process, killed))
+        timer.daemon = True
+        timer.start()
+    try:
+        if on_output:
+            chunks = []
+            stderr = []
+            # stderr 单独读取, 避免管道写满后 qemu-img 阻塞
+            reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()))
+            reader.daemon = True
+            reader.start()
+            # os.read 读到多少返回多少, 进度可以及时更新
+            for chunk in iter(lambda: os.read(process.stdout.fileno(), 1024), b''):
+                chunk = chunk.decode('utf-8', 'replace')
+                chunks.append(chunk)
+                on_output(chunk)
+            process.wait()
+            reader.join()
+            stdout, stderr = ''.join(chunks), ''.join(stderr)
+        else:
+            stdout, stderr = process.communicate()
+    finally:
+        if timer:
+            timer.cancel()
+    if process.returncode != 0:
+        if killed.is_set():
+            raise QemuImgTimeout(args, process.returncode, stderr, timeout)
+        raise QemuImgError(args, process.returncode, stderr)
+    return stdout
+
+
+def info(path, backing_chain=False):
+    """
+    :return: qemu-img info --output=json 的结果, backing_chain 为 True 时返回整条链的列表
+    """
+    args = ['info', '--output=json']
+    if backing_chain:
+        args.append('--backing-chain')
+    return json.loads(run(args + [path]))
+
+
+def check(path):
+    """
+    :return: qemu-img check --output=json 的结果
+    """
+    return json.loads(run(['check', '--output=json', path]))
+
+
+def create(path, size=None, fmt='qcow2', backing_file=None, backing_fmt=None, options=None):
+    """
+    :param size: 字节数或带单位的字符串如 '10G', 有 backing_file 时可省略
+    :param options: -o 参数, 如 {'preallocation': 'metadata'}
+    """
+    args = ['create', '-f', fmt]
+    if backing_file:
+        args += ['-b', backing_file, '-F', backing_fmt or info(backing_file)['format']]
+    if options:
+        args += ['-o', ','.join('{}={}'.format(k, v) for k, v in sorted(options.items()))]
+    args.append(path)
+    if size is not None:
+        args.append(size)
+    run(args)
+
+
+def convert(path, target_path, out_fmt='qcow2', compress=False, options=None, progress=None, timeout=0):
+    """
+    转换/合并镜像, 输出中不写入全零的簇
+    :param progress: 回调 progress(done, total), 按源镜像的虚拟大小换算成字节
+    :param timeout: 默认不限制
+    """
+    args = ['convert', '-O', out_fmt]
+    if compress:
+        args.append('-c')
+    if options:
+        args += ['-o', ','.join('{}={}'.format(k, v) for k, v in sorted(options.items()))]
+    on_output = None
+    if progress:
+        total = info(path)['virtual-size']
+        args.append('-p')
+
+        def on_output(chunk):
+            matches = PROGRESS_RE.findall(chunk)
+            if matches:
+                progress(int(total * float(matches[-1]) / 100), total)
+
+    run(args + [path, target_path], timeout=timeout, on_output=on_output)
+
+
+def run_batch(calls, max_workers=None):
+    """
+    用线程池同时执行多个镜像操作
+    :param calls: [(func, args), ...], 如 [(create, (path, '10G')), ...]
+    :return: 与 calls 顺序对应的 (结果, 异常) 列表, 单个失败不影响其它
+    """
+    max_workers = max_workers or settings.QEMU_IMG_BATCH_WORKERS
+    executor = futures.ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(calls))))
+    try:
+        submitted = [executor.submit(func, *args) for func, args in calls]
+        results = []
+        for future in submitted:
+            try:
+                results.append((future.result(), None))
+            except Exception as ex:
+                results.append((None, ex))
+        return results
+    finally:
+        executor.shutdown()
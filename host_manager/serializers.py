@@ -1,14 +1,20 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import libvirt
-from celery.result import AsyncResult
 from django.conf import settings
-from django.db import transaction
+from django.db import models, transaction
 from rest_framework import serializers
-from xml.etree import ElementTree as ET
 
+from common.task_results import PROGRESS, load_task_results
 from common.utils import new_mac
-from host_manager.models import Host, HostSnapshot, HostNetwork
+from host_manager import events
+from host_manager.cpu_models import check_cpu_mode
+from host_manager.disks import CLONE_MODES
+from host_manager.fleet import FleetSnapshot
+from host_manager.host_queue import enqueue, queue_depth
+from host_manager.hugepages import check_hugepages
+from host_manager.libvirt_pool import libvirt_connection
+from host_manager.models import Host, HostSnapshot, HostNetwork, DISK_PROFILES
+from host_manager.numa import parse_cpuset
 from host_manager.tasks import create_host, define_host, snapshot_create
 
 status_map = {
@@ -24,23 +30,64 @@ status_map = {
 }
 
 
-class HostSerializer(serializers.ModelSerializer):
+class TaskResultListSerializer(serializers.ListSerializer):
+    """
+    序列化列表前一次性读取本页所有 last_task_id 的任务状态
+    """
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, models.Manager) else data
+        iterable = list(iterable)
+        self.context['task_results'] = load_task_results([x.last_task_id for x in iterable])
+        return super(TaskResultListSerializer, self).to_representation(iterable)
+
+
+class HostListSerializer(TaskResultListSerializer):
+    """
+    同时记录本页虚拟机的 instance_uuid, 状态缓存中只读取这些虚拟机
+    """
+
+    def to_representation(self, data):
+        iterable = list(data.all() if isinstance(data, models.Manager) else data)
+        self.context['instance_uuids'] = [x.instance_uuid for x in iterable]
+        return super(HostListSerializer, self).to_representation(iterable)
+
+
+class TaskResultMixin(object):
+    def get_task_result(self, task_id):
+        task_results = self.context.get('task_results')
+        if task_results is None or task_id not in task_results:
+            task_results = load_task_results([task_id])
+        return task_results[task_id]
+
+
+class HostSerializer(TaskResultMixin, serializers.ModelSerializer):
     info = serializers.SerializerMethodField()
     disks = serializers.SerializerMethodField()
     networks = serializers.SerializerMethodField()
     last_task = serializers.SerializerMethodField()
     network_names = serializers.SerializerMethodField()
+    queue_depth = serializers.SerializerMethodField()
+
+    # 列表接口已按 is_delete=False 预取 hoststorage_set/hostnetwork_set, 这里用 all() 读取预取结果
+    def get_active_storages(self, obj):
+        return [i for i in obj.hoststorage_set.all() if not i.is_delete]
+
+    def get_active_networks(self, obj):
+        return [i for i in obj.hostnetwork_set.all() if not i.is_delete]
 
     def get_network_names(self, obj):
         result = []
-        for i in obj.hostnetwork_set.filter(is_delete=False):
+        for i in self.get_active_networks(obj):
             result.append(i.network_name)
         return result
 
     def get_disks(self, obj):
         result = []
-        for i in obj.hoststorage_set.filter(is_delete=False):
-            result.append({'id': i.id, "dev": i.dev, 'file': i.path, 'device': i.device})
+        for i in self.get_active_storages(obj):
+            result.append({'id': i.id, "dev": i.dev, 'file': i.path, 'device': i.device,
+                           'disk_profile': i.disk_profile, 'cache': i.cache, 'io': i.io, 'discard': i.discard,
+                           'iothread': i.iothread})
         return result
 
     def get_last_task(self, obj):
@@ -73,54 +120,55 @@ class HostSerializer(serializers.ModelSerializer):
         """
         last_task_id = obj.last_task_id
         if last_task_id:
-            result = AsyncResult(last_task_id)
+            result = self.get_task_result(last_task_id)
             data = {
-                "state": result.state,
+                "state": result['state'],
                 "name": obj.last_task_name
             }
-            if result.state == 'SUCCESS':
+            if result['state'] == 'SUCCESS':
                 return None
-            elif result.state == 'FAILURE':
-                data['result'] = str(result.result)
+            elif result['state'] == 'FAILURE':
+                data['result'] = str(result['result'])
+            elif result['state'] == PROGRESS:
+                data['progress'] = result['result']
             return data
 
+    def get_queue_depth(self, obj):
+        """
+        排队中(含正在执行)的任务数, 列表接口已在查询中统计
+        """
+        if hasattr(obj, 'queue_depth'):
+            return obj.queue_depth
+        return queue_depth(obj.id)
+
     def get_networks(self, obj):
         result = []
-        for i in obj.hostnetwork_set.filter(is_delete=False):
+        for i in self.get_active_networks(obj):
             result.append({"mac": i.mac, 'network_name': i.network_name, 'ip': i.ip})
         return result
 
+    def get_fleet_snapshot(self, obj):
+        snapshot = self.context.get("fleet_snapshot")
+        if snapshot is None:
+            # 列表接口由 HostListSerializer 记录本页的 instance_uuids, 单台接口只查询这一台
+            instance_uuids = self.context.get("instance_uuids")
+            if events.is_listening():
+                snapshot = FleetSnapshot(events.get_domain_states(instance_uuids or [obj.instance_uuid]),
+                                         events.get_network_leases())
+            else:
+                with libvirt_connection() as conn:
+                    snapshot = FleetSnapshot.load(conn, None if instance_uuids is not None else obj.instance_uuid)
+            self.context["fleet_snapshot"] = snapshot
+        return snapshot
+
     def get_info(self, obj):
-        instance_uuid = obj.instance_uuid
-        with libvirt.open(settings.LIBVIRT_URI) as conn:
-            net_map = {}
-            for net in conn.listAllNetworks():
-                net_name = net.name()
-                for i in net.DHCPLeases():
-                    mac = i.get("mac")
-                    ipaddr = i.get("ipaddr")
-                    key = "{}/{}".format(net_name, mac)
-                    net_map[key] = ipaddr
-            try:
-                domain = conn.lookupByUUIDString(instance_uuid)
-            except libvirt.libvirtError:
-                return {}
-            vmXml = domain.XMLDesc(0)
-            root = ET.fromstring(vmXml)
-            interface_xml = root.findall("./devices/interface")
-            ipaddrs = []
-            for xml_node in interface_xml:
-                net_name = xml_node.find("./source").get("network")
-                mac = xml_node.find("./mac").get("address")
-                key = "{}/{}".format(net_name, mac)
-                ip = net_map.get(key)
-                if ip:
-                    ipaddrs.append(ip)
-            info = domain.info()
-            return {
-                "state": status_map[info[0]],
-                "ipaddrs": ipaddrs,
-            }
+        info = self.get_fleet_snapshot(obj).get(obj.instance_uuid, obj.xml)
+        if not info:
+            return {}
+        return {
+            "state": status_map[info["state"]],
+            "ipaddrs": info["ipaddrs"],
+        }
 
     def create(self, validated_data):
         instance = super(HostSerializer, self).create(validated_data)
@@ -134,7 +182,10 @@ class HostSerializer(serializers.ModelSerializer):
             network_names = [x for x in network_names if x]
             iso_names = data.get("iso_names")
             init_disk_size_gb = data.get("init_disk_size_gb")
-            task = create_host.delay(host_id, is_from_iso, base_disk_name, iso_names, init_disk_size_gb, network_names)
+            clone_mode = data.get("clone_mode")
+            disk_profile = data.get("disk_profile")
+            task = enqueue(host_id, create_host, host_id, is_from_iso, base_disk_name, iso_names, init_disk_size_gb,
+                           network_names, clone_mode, disk_profile)
             instance.last_task_id = task.id
             instance.last_task_name = "创建虚拟机"
             instance.save()
@@ -142,6 +193,28 @@ class HostSerializer(serializers.ModelSerializer):
         transaction.on_commit(callback)
         return instance
 
+    def validate(self, attrs):
+        page_size_kb = attrs.get('hugepage_size_kb', self.instance.hugepage_size_kb if self.instance else None)
+        mem_size_kb = attrs.get('mem_size_kb', self.instance.mem_size_kb if self.instance else None)
+        changed = not self.instance or 'hugepage_size_kb' in attrs or 'mem_size_kb' in attrs
+        if page_size_kb and mem_size_kb and changed:
+            if mem_size_kb % page_size_kb:
+                raise serializers.ValidationError("内存大小应为大页大小的整数倍")
+            # 运行中的虚拟机自身占用的大页不计入空闲数量, 检查偏保守
+            nodes = parse_cpuset(self.instance.numa_nodes) if self.instance else None
+            with libvirt_connection() as conn:
+                error = check_hugepages(conn, mem_size_kb, page_size_kb, nodes)
+            if error:
+                raise serializers.ValidationError(error)
+        if 'cpu_mode' in attrs or 'cpu_model' in attrs:
+            cpu_mode = attrs.get('cpu_mode', self.instance.cpu_mode if self.instance else None)
+            cpu_model = attrs.get('cpu_model', self.instance.cpu_model if self.instance else None)
+            with libvirt_connection() as conn:
+                error = check_cpu_mode(conn, cpu_mode or settings.DEFAULT_CPU_MODE, cpu_model)
+            if error:
+                raise serializers.ValidationError(error)
+        return attrs
+
     def update(self, instance, validated_data):
         if 'network_names' in self.initial_data:
             network_names = self.initial_data.get("network_names")
@@ -158,11 +231,12 @@ class HostSerializer(serializers.ModelSerializer):
                 host_net.network_name = net_name
                 host_net.is_delete = False
                 host_net.save()
-        if 'cpu_core' in validated_data or 'mem_size_kb' in validated_data or 'network_names' in self.initial_data:
+        if set(validated_data).intersection(['cpu_core', 'mem_size_kb', 'hugepage_size_kb', 'cpu_mode', 'cpu_model']) \
+                or 'network_names' in self.initial_data:
             def callback():
-                task = define_host.delay(instance.id)
+                task = enqueue(instance.id, define_host, instance.id)
                 instance.last_task_id = task.id
-                instance.last_task_name = "修改配额"
+                instance.last_task_name = self.context.get("task_name") or "修改配额"
                 instance.save()
 
             transaction.on_commit(callback)
@@ -171,6 +245,7 @@ class HostSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Host
+        list_serializer_class = HostListSerializer
         exclude = ('is_delete',)
         extra_kwargs = {
             'create_time': {'read_only': True},
@@ -179,12 +254,13 @@ class HostSerializer(serializers.ModelSerializer):
         }
 
 
-class SnapshotSerializer(serializers.ModelSerializer):
+class SnapshotSerializer(TaskResultMixin, serializers.ModelSerializer):
     parent = serializers.SerializerMethodField()
     last_task = serializers.SerializerMethodField()
 
     class Meta:
         model = HostSnapshot
+        list_serializer_class = TaskResultListSerializer
         exclude = ('is_delete',)
         extra_kwargs = {
             'create_time': {'read_only': True},
@@ -222,20 +298,25 @@ class SnapshotSerializer(serializers.ModelSerializer):
         """
         last_task_id = obj.last_task_id
         if last_task_id:
-            result = AsyncResult(last_task_id)
+            result = self.get_task_result(last_task_id)
             data = {
-                "state": result.state,
+                "state": result['state'],
                 "name": obj.last_task_name
             }
-            if result.state == 'SUCCESS':
+            if result['state'] == 'SUCCESS':
                 return None
-            elif result.state == 'FAILURE':
-                data['result'] = str(result.result)
+            elif result['state'] == 'FAILURE':
+                data['result'] = str(result['result'])
+            elif result['state'] == PROGRESS:
+                data['progress'] = result['result']
             return data
 
     def get_parent(self, obj):
+        if hasattr(obj, 'parent_name'):
+            return obj.parent_name
         if obj.parent_instance_name:
-            parent = HostSnapshot.objects.filter(is_delete=False, instance_name=obj.parent_instance_name)
+            parent = HostSnapshot.objects.filter(is_delete=False, host_id=obj.host_id,
+                                                 instance_name=obj.parent_instance_name).first()
             if parent:
                 return parent.name
 
@@ -244,7 +325,7 @@ class SnapshotSerializer(serializers.ModelSerializer):
         host_id = instance.host_id
 
         def callback():
-            task = snapshot_create.delay(instance.id)
+            task = enqueue(host_id, snapshot_create, instance.id)
             host_instance = Host.objects.filter(id=host_id).first()
             host_instance.last_task_id = task.id
             host_instance.last_task_name = "创建快照"
@@ -255,3 +336,45 @@ class SnapshotSerializer(serializers.ModelSerializer):
 
         transaction.on_commit(callback)
         return instance
+
+
+class BulkHostSerializer(serializers.Serializer):
+    """
+    批量创建虚拟机的规格, name 中的 {index} 会替换为从 1 开始的序号, 没有时在末尾追加 -序号
+    """
+    name = serializers.CharField(max_length=90)
+    count = serializers.IntegerField(min_value=1)
+    desc = serializers.CharField(max_length=200, required=False, allow_blank=True, allow_null=True)
+    cpu_core = serializers.IntegerField(min_value=1)
+    mem_size_kb = serializers.IntegerField(min_value=1)
+    is_from_iso = serializers.BooleanField(default=False)
+    base_disk_name = serializers.CharField(required=False)
+    iso_names = serializers.ListField(child=serializers.CharField(), required=False, default=list)
+    init_disk_size_gb = serializers.IntegerField(min_value=1, required=False)
+    network_names = serializers.ListField(child=serializers.CharField(allow_blank=True), required=False, default=list)
+    clone_mode = serializers.ChoiceField(choices=CLONE_MODES, required=False, allow_null=True)
+    disk_profile = serializers.ChoiceField(choices=DISK_PROFILES, required=False, allow_null=True)
+    parallelism = serializers.IntegerField(min_value=1, required=False)
+
+    def validate_count(self, value):
+        if value > settings.BULK_CREATE_MAX_COUNT:
+            raise serializers.ValidationError("一次最多创建{}台".format(settings.BULK_CREATE_MAX_COUNT))
+        return value
+
+    def validate(self, attrs):
+        if attrs['is_from_iso']:
+            if not attrs.get('init_disk_size_gb'):
+                raise serializers.ValidationError("从光盘创建需要 init_disk_size_gb")
+        elif not attrs.get('base_disk_name'):
+            raise serializers.ValidationError("需要 base_disk_name")
+        name = attrs['name']
+        if '{index}' not in name:
+            name += '-{index}'
+        attrs['names'] = [name.replace('{index}', str(i + 1)) for i in range(attrs['count'])]
+        exists = Host.objects.filter(is_delete=False, name__in=attrs['names']).values_list('name', flat=True)[:1]
+        if exists:
+            raise serializers.ValidationError("名称{}已存在".format(exists[0]))
+        attrs['network_names'] = [x for x in attrs['network_names'] if x]
+        parallelism = attrs.get('parallelism') or settings.BULK_CREATE_PARALLELISM
+        attrs['parallelism'] = min(parallelism, settings.BULK_CREATE_PARALLELISM, attrs['count'])
+        return attrs
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import uuid
+
+from django.conf import settings
+from django.utils import timezone
+
+from host_manager.models import Host
+from host_manager.vnc_ports import new_vnc_port
+
+
+def pool_key(base_disk_name, clone_mode=None):
+    """
+    备用虚拟机按基础镜像和磁盘方式分池, 规格与网络在领用时修改
+    """
+    return '{}/{}'.format(base_disk_name, clone_mode or settings.DEFAULT_CLONE_MODE)
+
+
+def pool_entries():
+    """
+    :return: SPARE_POOL 配置, 补全 clone_mode 与 network_names
+    """
+    for entry in settings.SPARE_POOL:
+        entry = dict(entry)
+        entry['clone_mode'] = entry.get('clone_mode') or settings.DEFAULT_CLONE_MODE
+        entry['network_names'] = entry.get('network_names') or []
+        yield entry
+
+
+def new_spare(entry):
+    """
+    写入一台备用虚拟机的记录, 磁盘与定义由 create_host 任务完成
+    """
+    instance_uuid = str(uuid.uuid4())
+    return Host.objects.create(name='spare-' + instance_uuid[:8], cpu_core=entry['cpu_core'],
+                               mem_size_kb=entry['mem_size_kb'], vnc_port=new_vnc_port(),
+                               instance_uuid=instance_uuid, instance_name='instance_' + instance_uuid,
+                               spare_pool=pool_key(entry['base_disk_name'], entry['clone_mode']))
+
+
+def claim_spare(base_disk_name, clone_mode, cpu_core, mem_size_kb):
+    """
+    领用一台已定义好的备用虚拟机(xml 不为空), 规格相同的优先
+    用带条件的 update 领用, 并发请求不会领到同一台; 应在事务中调用, 后续修改失败时一并回滚
+    领用时创建时间改为当前时间, 按创建时间排序时与新建的虚拟机一致
+    :return: Host 或 None
+    """
+    key = pool_key(base_disk_name, clone_mode)
+    now = timezone.now()
+    ready = Host.objects.filter(is_delete=False, spare_pool=key, xml__isnull=False).order_by('create_time')
+    host_ids = list(ready.filter(cpu_core=cpu_core, mem_size_kb=mem_size_kb).values_list('id', flat=True)[:5])
+    host_ids += list(ready.values_list('id', flat=True)[:5])
+    for host_id in host_ids:
+        if Host.objects.filter(id=host_id, spare_pool=key).update(spare_pool=None, create_time=now, modify_time=now):
+            return Host.objects.get(id=host_id)
+    return None
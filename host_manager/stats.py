@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import libvirt
+
+RESOURCE_STATS = libvirt.VIR_DOMAIN_STATS_BALLOON | libvirt.VIR_DOMAIN_STATS_VCPU | libvirt.VIR_DOMAIN_STATS_BLOCK
+OVERVIEW_STATS = libvirt.VIR_DOMAIN_STATS_STATE | RESOURCE_STATS
+
+
+def sum_block_stats(record, name):
+    total = 0
+    for i in range(record.get('block.count', 0)):
+        total += record.get('block.{}.{}'.format(i, name), 0)
+    return total
+
+
+def build_overview(conn, status_map, load_states=None):
+    """
+    通过一次 getAllDomainStats 调用汇总所有虚拟机的资源
+    :param status_map: 状态码到状态名称的映射, 用于 state_counts
+    :param load_states: load_states(instance_uuids) 返回 {instance_uuid: 状态码}, 如事件监听维护的缓存,
+        提供时状态从这里读取, 不再向 libvirt 查询; 缓存中没有的虚拟机按状态 0 统计
+    :return:
+    """
+    data = {
+        "vm_count": 0,
+        "total_cpu": 0,
+        "total_mem": 0,
+        "vm_running_count": 0,
+        "balloon_mem": 0,
+        "rss_mem": 0,
+        "disk_allocation": 0,
+        "disk_capacity": 0,
+        "state_counts": dict((name, 0) for name in status_map.values()),
+    }
+    records = conn.getAllDomainStats(RESOURCE_STATS if load_states else OVERVIEW_STATS)
+    states = load_states([domain.UUIDString() for domain, record in records]) if load_states else {}
+    for domain, record in records:
+        if load_states:
+            state = states.get(domain.UUIDString(), 0)
+        else:
+            state = record.get('state.state', 0)
+        data['vm_count'] += 1
+        if state == libvirt.VIR_DOMAIN_RUNNING:
+            data['vm_running_count'] += 1
+        if state in status_map:
+            data['state_counts'][status_map[state]] += 1
+        data['total_cpu'] += record.get('vcpu.current', 0)
+        data['total_mem'] += record.get('balloon.maximum', 0)
+        data['balloon_mem'] += record.get('balloon.current', 0)
+        data['rss_mem'] += record.get('balloon.rss', 0)
+        data['disk_allocation'] += sum_block_stats(record, 'allocation')
+        data['disk_capacity'] += sum_block_stats(record, 'capacity')
+    return data
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import time
+
+from celery import states as task_states
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count, Max
+
+from common.task_results import PROGRESS, last_task_change_time, load_task_results
+from host_manager import events
+from host_manager.models import Host
+
+
+def format_event(event, data):
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+def event_stream(status_map, task_ids=None, timeout=None, interval=None):
+    """
+    Server-Sent Events 生成器, 推送任务状态变化(task)与虚拟机状态变化(domain)
+    首轮推送当前状态, 之后只推送变化, 超时或事件监听停止后结束, 由客户端按 retry 重新连接
+    虚拟机状态只读取 run_event_listener 维护的缓存; 每轮先比较虚拟机记录与任务结果的最后修改时间
+    以及状态版本号, 都没有变化时不重新读取虚拟机和任务结果
+    :param status_map: 虚拟机状态码到名称的映射
+    :param task_ids: 只关注这些任务, 为空时关注所有虚拟机的 last_task_id
+    :return:
+    """
+    timeout = timeout or settings.EVENT_STREAM_TIMEOUT
+    interval = interval or settings.EVENT_STREAM_INTERVAL
+    deadline = time.time() + timeout
+    sent_tasks = {}
+    sent_domains = {}
+    change_key = None
+    generation = None
+    hosts = []
+    yield "retry: 3000\n\n"
+    while time.time() < deadline and events.is_listening():
+        queryset = Host.objects.filter(is_delete=False, spare_pool__isnull=True)
+        summary = queryset.aggregate(count=Count('id'), modify_time=Max('modify_time'))
+        current_key = (summary['count'], summary['modify_time'],
+                       last_task_change_time(task_ids or queryset.values('last_task_id')))
+        hosts_changed = current_key != change_key
+        if hosts_changed:
+            change_key = current_key
+            hosts = list(queryset.values_list('id', 'instance_uuid', 'last_task_id', 'last_task_name'))
+            for event in task_events(hosts, task_ids, sent_tasks):
+                yield event
+
+        current_generation = events.get_state_generation()
+        if hosts_changed or current_generation != generation:
+            generation = current_generation
+            domain_states = events.get_domain_states([x[1] for x in hosts])
+            for host_id, instance_uuid, last_task_id, last_task_name in hosts:
+                state = domain_states.get(instance_uuid)
+                if state is None or sent_domains.get(instance_uuid) == state:
+                    continue
+                sent_domains[instance_uuid] = state
+                yield format_event('domain', {
+                    "host_id": host_id,
+                    "instance_uuid": instance_uuid,
+                    "state": status_map.get(state),
+                })
+        yield ": keepalive\n\n"
+        # 等待期间不占用数据库连接
+        connection.close()
+        time.sleep(interval)
+
+
+def task_events(hosts, task_ids, sent_tasks):
+    """
+    :param sent_tasks: 已推送的 {task_id: (state, progress)}, 只推送有变化的任务
+    """
+    task_hosts = {}
+    task_names = {}
+    for host_id, instance_uuid, last_task_id, last_task_name in hosts:
+        if last_task_id:
+            task_hosts.setdefault(last_task_id, []).append(host_id)
+            task_names[last_task_id] = last_task_name
+    watched = task_ids or task_hosts.keys()
+    for task_id, result in load_task_results(watched).items():
+        state = result['state']
+        progress = result['result'] if state == PROGRESS else None
+        if sent_tasks.get(task_id) == (state, progress):
+            continue
+        sent_tasks[task_id] = (state, progress)
+        data = {
+            "task_id": task_id,
+            "name": task_names.get(task_id),
+            "host_ids": task_hosts.get(task_id, []),
+            "state": state,
+        }
+        if state == task_states.FAILURE:
+            data['result'] = str(result['result'])
+        elif progress:
+            data['progress'] = progress
+        yield format_event('task', data)
@@ -3,129 +3,162 @@ from __future__ import absolute_import, unicode_literals
 
 import datetime
 import os
-import shutil
+import threading
+import time
+import traceback
 from xml.etree import ElementTree as ET
 
 import libvirt
-from celery import shared_task
+from celery import shared_task, states as task_states
+from concurrent import futures
 from django.conf import settings
+from django.db import connection, transaction
 
-from common.utils import new_mac
+from common.task_results import PROGRESS, progress_reporter
+from common.utils import common_except_log
+from host_manager import qemu_img
+from host_manager.cpu_models import baseline_cpu_xml, check_cpu_mode, host_cpu_mode
+from host_manager.disks import check_base_disk_replaceable, copy_file, create_blank_disk, flatten_image
+from host_manager.host_queue import HostQueueTask, enqueue, enqueue_on_commit, finish, heartbeat, \
+    wait_for_turn
+from host_manager.libvirt_pool import libvirt_connection
+from host_manager.metrics import COLLECT_STATS, MetricSeries, read_counters
 from host_manager.models import Host, HostStorage, HOST_STORAGE_DEVICE_DISK, HOST_STORAGE_DEVICE_CDROM, HostNetwork, \
-    HostSnapshot, VncPorts
+    HostSnapshot, HostMetrics, CPU_MODE_LEGACY, CPU_MODE_BASELINE
+from host_manager.hugepages import check_hugepages
+from host_manager.numa import NodeTopology, assign_placement, parse_cpuset
+from host_manager.provision import build_networks, build_storages, create_root_disk, is_full_copy
+from host_manager.spare_pool import new_spare, pool_entries, pool_key
+from host_manager.vnc_ports import release_vnc_port
+from host_manager.xml_templates import assign_iothreads, build_cpu_element, render_domain_xml, \
+    render_export_snapshot_xml, render_snapshot_xml, render_storage_xml
 
 
 class TaskError(Exception):
     pass
 
 
-@shared_task
+@shared_task(base=HostQueueTask)
 def define_host(host_id):
     host = Host.objects.filter(id=host_id, is_delete=False).first()
     if not host:
         raise TaskError("not found host")
-    host_xml_path = os.path.join(settings.BASE_DIR, 'assets/xml_templete/host.xml')
-    disk_xml_path = os.path.join(settings.BASE_DIR, 'assets/xml_templete/storage/disk.xml')
-    cdrom_disk_xml_path = os.path.join(settings.BASE_DIR, 'assets/xml_templete/storage/cdrom.xml')
-    network_xml_path = os.path.join(settings.BASE_DIR, 'assets/xml_templete/network.xml')
-
-    with open(host_xml_path, 'r') as f:
-        host_root = ET.fromstring(f.read())
-    host_root.find("./uuid").text = host.instance_uuid
-    host_root.find("./name").text = host.instance_name
-    host_root.find("./memory").attrib['unit'] = 'KiB'
-    host_root.find("./memory").text = str(host.mem_size_kb)
-    host_root.find("./currentMemory").attrib['unit'] = 'KiB'
-    host_root.find("./currentMemory").text = str(host.mem_size_kb)
-    host_root.find("./vcpu").text = str(host.cpu_core)
-    host_root.find("./devices/graphics").attrib['port'] = str(host.vnc_port)
-    for storage in HostStorage.objects.filter(host=host, is_delete=False):
-        if storage.device == HOST_STORAGE_DEVICE_DISK:
-            with open(disk_xml_path, 'r') as f:
-                disk_root = ET.fromstring(f.read())
-                disk_root.find("./source").attrib['file'] = storage.path
-                disk_root.find("./target").attrib['dev'] = storage.dev
-                disk_root.find("./target").attrib['bus'] = storage.bus
-                host_root.find("./devices").append(disk_root)
-        elif storage.device == HOST_STORAGE_DEVICE_CDROM:
-            with open(cdrom_disk_xml_path, 'r') as f:
-                disk_root = ET.fromstring(f.read())
-                disk_root.find("./source").attrib['file'] = storage.path
-                disk_root.find("./target").attrib['dev'] = storage.dev
-                disk_root.find("./target").attrib['bus'] = storage.bus
-                host_root.find("./devices").append(disk_root)
-    for network in HostNetwork.objects.filter(host=host, is_delete=False):
-        with open(network_xml_path, 'r') as f:
-            network_root = ET.fromstring(f.read())
-            network_root.find("./mac").attrib['address'] = network.mac
-            network_root.find("./source").attrib['network'] = network.network_name
-            host_root.find("./devices").append(network_root)
-    host_xml = ET.tostring(host_root)
-    with libvirt.open(settings.LIBVIRT_URI) as conn:
+    storages = HostStorage.objects.filter(host=host, is_delete=False)
+    networks = HostNetwork.objects.filter(host=host, is_delete=False)
+    with libvirt_connection() as conn:
+        placement = None
+        if settings.NUMA_PLACEMENT_ENABLED:
+            placement = assign_placement(host, NodeTopology.from_capabilities(conn.getCapabilities()))
+        cpu_mode = host_cpu_mode(host)
+        error = check_cpu_mode(conn, cpu_mode, host.cpu_model)
+        if error:
+            raise TaskError(error)
+        cpu = None
+        if cpu_mode != CPU_MODE_LEGACY:
+            cpu = build_cpu_element(cpu_mode, host.cpu_model,
+                                    baseline_cpu_xml() if cpu_mode == CPU_MODE_BASELINE else None)
+        host_xml = render_domain_xml(host, storages, networks, placement, cpu)
         conn.defineXML(host_xml)
         domain = conn.lookupByUUIDString(host.instance_uuid)
         host.xml = domain.XMLDesc(0)
         host.save()
 
 
-@shared_task
-def create_host(host_id, is_from_iso, base_disk_name, iso_names, init_disk_size_gb, network_names):
+@shared_task(base=HostQueueTask, bind=True)
+def create_host(self, host_id, is_from_iso, base_disk_name, iso_names, init_disk_size_gb, network_names,
+                clone_mode=None, disk_profile=None):
     host = Host.objects.filter(id=host_id, is_delete=False).first()
     if not host:
         raise TaskError("not found host")
+    storages = build_storages(host, is_from_iso, base_disk_name, iso_names, clone_mode, disk_profile)
+    create_root_disk(storages[0], is_from_iso, base_disk_name, init_disk_size_gb, progress_reporter(self))
+    for storage in storages:
+        storage.save()
+    for network in build_networks(host, network_names):
+        network.save()
+    define_host(host_id)
 
-    vm_data_dir = os.path.join(settings.VM_DATA_DIR, host.instance_name)
-    if not os.path.exists(vm_data_dir):
-        os.makedirs(vm_data_dir)
-    if not is_from_iso:
-        disk_path = os.path.join(vm_data_dir, base_disk_name)
-        shutil.copyfile(os.path.join(settings.VM_BASE_DISKS_DIR, base_disk_name), disk_path)
-    else:
-        disk_path = ""
-        for i in range(100):
-            disk_path = os.path.join(vm_data_dir,
-                                     "root_disk{}.qcow2".format(i))
-            if not os.path.exists(disk_path):
-                break
-        os.system(
-            "qemu-img create -f qcow2 '{}' {}G".format(disk_path, init_disk_size_gb))
-
-    host_disk = HostStorage()
-    host_disk.host_id = host_id
-    host_disk.device = HOST_STORAGE_DEVICE_DISK
-    host_disk.path = disk_path
-    host_disk.dev = 'vda'
-    host_disk.bus = 'virtio'
-    host_disk.save()
-
-    if is_from_iso:
-        for index, item in enumerate(iso_names):
-            dev = "hd{}".format(chr(0x61 + index))
-            host_cdrom = HostStorage()
-            host_cdrom.host_id = host_id
-            host_cdrom.device = HOST_STORAGE_DEVICE_CDROM
-            host_cdrom.path = os.path.join(settings.VM_ISO_DIR, item)
-            host_cdrom.dev = dev
-            host_cdrom.bus = 'ide'
-            host_cdrom.save()
-    for net_name in network_names:
-        host_net = HostNetwork()
-        host_net.host_id = host_id
-        host_net.mac = new_mac()
-        host_net.network_name = net_name
-        host_net.save()
+
+def provision_root_disk(root_disk, is_from_iso, base_disk_name, init_disk_size_gb):
+    if not root_disk:
+        raise TaskError("not found disk")
+    create_root_disk(root_disk, is_from_iso, base_disk_name, init_disk_size_gb)
+
+
+def provision_host(host_id, error):
+    """
+    :param error: 创建系统盘时的异常
+    """
+    if error:
+        raise error
+    define_host(host_id)
+
+
+def provision_copied_host(host_id, root_disk, base_disk_name):
+    provision_root_disk(root_disk, False, base_disk_name, None)
     define_host(host_id)
 
 
+@shared_task(bind=True)
+def provision_hosts(self, host_ids, is_from_iso, base_disk_name, init_disk_size_gb):
+    """
+    批量创建中的一路: 依次为已写入数据库的虚拟机创建系统盘并定义,
+    每台虚拟机的结果记录在其预先分配的 last_task_id 上, 单台失败不影响其它
+    """
+    hosts = dict((x.id, x) for x in Host.objects.filter(id__in=host_ids, is_delete=False))
+    root_disks = dict((x.host_id, x) for x in HostStorage.objects.filter(
+        host_id__in=host_ids, device=HOST_STORAGE_DEVICE_DISK, dev='vda', is_delete=False))
+    host_ids = [x for x in host_ids if x in hosts]
+    for host_id in host_ids:
+        if host_id in root_disks:
+            root_disks[host_id].host = hosts[host_id]
+    # 链接克隆和新建空白硬盘用线程池同时执行后逐台定义; 完整复制在本路内逐台执行,
+    # 同时进行的复制数不超过 BULK_CREATE_PARALLELISM
+    copied = [x for x in host_ids if is_full_copy(root_disks.get(x), is_from_iso)]
+    batched = [x for x in host_ids if x not in copied]
+    created = dict(zip(batched, qemu_img.run_batch([
+        (provision_root_disk, (root_disks.get(x), is_from_iso, base_disk_name, init_disk_size_gb)) for x in batched
+    ])))
+    for host_id in batched:
+        run_recorded(self.backend, hosts[host_id].last_task_id, provision_host, host_id, created[host_id][1])
+    for host_id in copied:
+        run_recorded(self.backend, hosts[host_id].last_task_id, provision_copied_host, host_id,
+                     root_disks[host_id], base_disk_name)
+
+
 @shared_task
-def host_action(host_id, action):
+def refill_spare_pool():
+    """
+    按 SPARE_POOL 补足每个池的备用虚拟机; 创建超时的以及已从配置中移除的池中的备用虚拟机删除
+    """
+    stale_before = datetime.datetime.now() - datetime.timedelta(seconds=settings.SPARE_BUILD_TIMEOUT)
+    entries = list(pool_entries())
+    keys = [pool_key(x['base_disk_name'], x['clone_mode']) for x in entries]
+    spares = Host.objects.filter(is_delete=False, spare_pool__isnull=False)
+    removed = spares.exclude(spare_pool__in=keys) | spares.filter(xml__isnull=True, create_time__lt=stale_before)
+    for host_id in removed.values_list('id', flat=True):
+        # 先标记删除, 不再计数和领用; 排在仍未结束的创建任务之后执行
+        if Host.objects.filter(id=host_id, is_delete=False, spare_pool__isnull=False).update(
+                is_delete=True, delete_time=datetime.datetime.now()):
+            enqueue(host_id, host_action, host_id, 'delete')
+    for entry, key in zip(entries, keys):
+        for _ in range(entry['count'] - spares.filter(spare_pool=key).count()):
+            # 写入失败时回滚, 端口不会被占用
+            with transaction.atomic():
+                host = new_spare(entry)
+                task_id = enqueue_on_commit(host.id, create_host, host.id, False, entry['base_disk_name'], [], None,
+                                            entry['network_names'], entry['clone_mode'])
+                Host.objects.filter(id=host.id).update(last_task_id=task_id, last_task_name="创建备用虚拟机")
+
+
+def run_host_action(host_id, action):
     if action == 'sync':
         define_host(host_id)
         return
     host = Host.objects.filter(id=host_id).first()
     if not host:
         raise TaskError("not found host")
-    with libvirt.open(settings.LIBVIRT_URI) as conn:
+    with libvirt_connection() as conn:
         try:
             domain = conn.lookupByUUIDString(host.instance_uuid)
         except libvirt.libvirtError:
@@ -155,20 +188,142 @@ def host_action(host_id, action):
             host.is_delete = True
             host.delete_time = datetime.datetime.now()
             host.save()
-            VncPorts.objects.filter(value=host.vnc_port).delete()
+            release_vnc_port(host.vnc_port)
+            HostMetrics.objects.filter(host=host).delete()
 
         elif action == 'reboot':
             domain.reboot()
         elif action == 'start':
+            if host.hugepage_size_kb:
+                error = check_hugepages(conn, host.mem_size_kb, host.hugepage_size_kb, parse_cpuset(host.numa_nodes))
+                if error:
+                    raise TaskError(error)
             domain.create()
 
 
-@shared_task
-def attach_disk(host_id, disk_size_gb):
+@shared_task(base=HostQueueTask)
+def host_action(host_id, action):
+    run_host_action(host_id, action)
+
+
+def run_recorded(backend, task_id, func, *args):
+    """
+    在当前任务内执行 func, 结果记录到预先分配的任务id上
+    :return: (状态, 失败时的错误信息)
+    """
+    backend.store_result(task_id, None, task_states.STARTED)
+    try:
+        func(*args)
+    except Exception as ex:
+        backend.mark_as_failure(task_id, ex, traceback.format_exc())
+        return task_states.FAILURE, str(ex)
+    backend.mark_as_done(task_id, None)
+    return task_states.SUCCESS, None
+
+
+class StartGate(object):
+    """
+    多个线程共用, 相邻两次 wait() 返回的时间至少间隔 interval 秒
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def run_bulk_action(backend, host_tasks, func, max_in_flight, delay=0, on_progress=None):
+    """
+    批量执行 func(host_id), 同时最多 max_in_flight 台, 相邻两台开始执行的时间至少间隔 delay 秒,
+    避免大量虚拟机同时启动造成磁盘 IO 风暴; 每台的结果记录在预先分配的任务id上
+    :param host_tasks: [(host_id, 预先分配的任务id), ...]
+    :param on_progress: 每台结束后调用 on_progress(outcomes)
+    :return: {host_id: {"state": ..., "result": 失败时的错误信息}}
+    """
+    outcomes = {}
+    lock = threading.Lock()
+    gate = StartGate(delay)
+
+    def run_queued(host_id, task_id):
+        wait_for_turn(task_id)
+        try:
+            with heartbeat(task_id):
+                gate.wait()
+                return run_recorded(backend, task_id, func, host_id)
+        finally:
+            finish(task_id)
+
+    def run(host_id, task_id):
+        try:
+            state, error = run_queued(host_id, task_id)
+        except Exception as ex:
+            # 排队或读写数据库出错时同样记为该台失败, 不影响其它虚拟机
+            state, error = task_states.FAILURE, str(ex)
+            try:
+                backend.mark_as_failure(task_id, ex, traceback.format_exc())
+            except Exception:
+                common_except_log()
+        finally:
+            connection.close()
+        with lock:
+            outcomes[host_id] = {"state": state, "result": error}
+            if on_progress:
+                on_progress(outcomes)
+
+    executor = futures.ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        for future in [executor.submit(run, host_id, task_id) for host_id, task_id in host_tasks]:
+            future.result()
+    finally:
+        executor.shutdown()
+    return outcomes
+
+
+@shared_task(bind=True)
+def bulk_host_action(self, host_tasks, action, max_in_flight, delay=0):
+    """
+    批量执行开关机等操作, 见 run_bulk_action
+    :return: 每台虚拟机的执行结果
+    """
+    total = len(host_tasks)
+
+    def on_progress(outcomes):
+        if self.request.id:
+            self.update_state(state=PROGRESS, meta={"done": len(outcomes), "total": total, "hosts": outcomes})
+
+    outcomes = run_bulk_action(self.backend, host_tasks, lambda host_id: run_host_action(host_id, action),
+                               max_in_flight, delay, on_progress)
+    states = {}
+    for outcome in outcomes.values():
+        states[outcome['state']] = states.get(outcome['state'], 0) + 1
+    return {"total": total, "states": states, "hosts": outcomes}
+
+
+def hotplug_disk(domain, storage, storages):
+    """
+    把新硬盘挂载到运行中的虚拟机, IOThread 编号与重新定义后一致, 运行中没有该 IOThread 时先添加
+    :param storages: 虚拟机已有的硬盘和光驱
+    """
+    iothread_id = assign_iothreads(list(storages) + [storage]).get(storage.dev)
+    if iothread_id and iothread_id not in [x[0] for x in domain.ioThreadInfo()]:
+        domain.addIOThread(iothread_id, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+    domain.attachDevice(render_storage_xml(storage, iothread_id))
+
+
+@shared_task(base=HostQueueTask)
+def attach_disk(host_id, disk_size_gb, disk_profile=None, iothread=False):
     host = Host.objects.filter(id=host_id, is_delete=False).first()
     if not host:
         raise TaskError("not found host")
-    with libvirt.open(settings.LIBVIRT_URI) as conn:
+    with libvirt_connection() as conn:
         try:
             domain = conn.lookupByUUIDString(host.instance_uuid)
         except libvirt.libvirtError:
@@ -180,36 +335,31 @@ def attach_disk(host_id, disk_size_gb):
             disk_path = os.path.join(vm_data_dir, "disk{}.qcow2".format(i))
             if not os.path.exists(disk_path):
                 break
-        os.system("qemu-img create -f qcow2 '{}' {}G".format(disk_path, disk_size_gb))
-        disk_xml_path = os.path.join(settings.BASE_DIR, 'assets/xml_templete/storage/disk.xml')
+        create_blank_disk(disk_path, '{}G'.format(disk_size_gb), disk_profile)
         info = domain.info()
         state = info[0]
-        devs = HostStorage.objects.filter(host=host, is_delete=False).values_list('dev', flat=True)
-        devs = list(devs)
+        storages = list(HostStorage.objects.filter(host=host, is_delete=False))
+        devs = [x.dev for x in storages]
         for i in range(26):
             new_dev = "vd{}".format(chr(0x61 + i))
             if new_dev not in devs:
                 break
 
+        host_storage = HostStorage()
+        host_storage.host_id = host_id
+        host_storage.path = disk_path
+        host_storage.disk_profile = disk_profile or settings.DEFAULT_DISK_PROFILE
+        host_storage.device = HOST_STORAGE_DEVICE_DISK
+        host_storage.dev = new_dev
+        host_storage.bus = 'virtio'
+        host_storage.iothread = bool(iothread)
         if state == 1:
-            with open(disk_xml_path, 'r') as f:
-                disk_node = ET.fromstring(f.read())
-
-                disk_node.find("./source").attrib['file'] = disk_path
-                disk_node.find("./target").attrib['dev'] = new_dev
-                disk_node.find("./target").attrib['bus'] = 'virtio'
-            domain.attachDevice(ET.tostring(disk_node))
-    host_storage = HostStorage()
-    host_storage.host_id = host_id
-    host_storage.path = disk_path
-    host_storage.device = HOST_STORAGE_DEVICE_DISK
-    host_storage.dev = new_dev
-    host_storage.bus = 'virtio'
+            hotplug_disk(domain, host_storage, storages)
     host_storage.save()
     define_host(host_id)
 
 
-@shared_task
+@shared_task(base=HostQueueTask)
 def detach_disk(host_id, disk_id):
     host = Host.objects.filter(id=host_id, is_delete=False).first()
     if not host:
@@ -217,7 +367,7 @@ def detach_disk(host_id, disk_id):
     disk_obj = HostStorage.objects.filter(host_id=host_id, id=disk_id).first()
     if not disk_obj:
         raise TaskError("not found disk")
-    with libvirt.open(settings.LIBVIRT_URI) as conn:
+    with libvirt_connection() as conn:
         try:
             domain = conn.lookupByUUIDString(host.instance_uuid)
         except libvirt.libvirtError:
@@ -245,71 +395,103 @@ def detach_disk(host_id, disk_id):
     define_host(host_id)
 
 
-@shared_task
-def save_disk_to_base(host_id, disk_id, name):
+def wait_block_job_ready(domain, dev, timeout):
+    """
+    等待块任务进入可切换(cur == end)状态
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        info = domain.blockJobInfo(dev, 0)
+        if not info:
+            raise TaskError("block job of {} not found".format(dev))
+        if info['end'] and info['cur'] == info['end']:
+            return
+        time.sleep(0.2)
+    raise TaskError("block job of {} timeout".format(dev))
+
+
+def export_running_disk(domain, host, disk_obj, export):
+    """
+    运行中的虚拟机导出硬盘: 先做外部磁盘快照把写入转到 overlay, 复制已不再变化的原文件,
+    再用 active block commit 把 overlay 合并回原文件并切换, 整个过程虚拟机无需暂停
+    :param export: 导出函数, 参数为不再变化的原硬盘路径
+    :return:
+    """
+    overlay_path = "{}.export-{}".format(disk_obj.path, int(time.time()))
+    storages = HostStorage.objects.filter(host=host, device=HOST_STORAGE_DEVICE_DISK, is_delete=False)
+    snapshot_xml = render_export_snapshot_xml(os.path.basename(overlay_path), storages, disk_obj, overlay_path)
+    domain.snapshotCreateXML(snapshot_xml, libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
+                             libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA |
+                             libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC)
+    try:
+        export(disk_obj.path)
+    finally:
+        # SHALLOW 只合并到 overlay 的直接 backing file(原硬盘), 否则链接克隆时会写入共享的基础镜像
+        domain.blockCommit(disk_obj.dev, None, None, 0,
+                           libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE | libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW)
+        wait_block_job_ready(domain, disk_obj.dev, settings.BLOCK_COMMIT_TIMEOUT)
+        domain.blockJobAbort(disk_obj.dev, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+        if os.path.exists(overlay_path):
+            os.remove(overlay_path)
+
+
+@shared_task(base=HostQueueTask, bind=True)
+def save_disk_to_base(self, host_id, disk_id, name, compress=False):
+    """
+    :param compress: 是否导出为压缩的 qcow2
+    """
     host = Host.objects.filter(id=host_id, is_delete=False).first()
     if not host:
         raise TaskError("not found host")
     disk_obj = HostStorage.objects.filter(host_id=host_id, id=disk_id).first()
     if not disk_obj:
         raise TaskError("not found disk")
-    with libvirt.open(settings.LIBVIRT_URI) as conn:
+    with libvirt_connection() as conn:
         try:
             domain = conn.lookupByUUIDString(host.instance_uuid)
         except libvirt.libvirtError:
             raise TaskError("not found domain")
         name = os.path.splitext(name)[0] + ".qcow2"
         path = os.path.join(settings.VM_BASE_DISKS_DIR, name)
+        error = check_base_disk_replaceable(path)
+        if error:
+            raise TaskError(error)
         if os.path.exists(path):
             raise TaskError("文件已存在")
+
+        def export(disk_path):
+            if compress or disk_obj.backing_path:
+                flatten_image(disk_path, path, compress, progress_reporter(self))
+            else:
+                copy_file(disk_path, path, progress_reporter(self))
+
         info = domain.info()
         state = info[0]
         if state == 1:
-            is_running = True
+            export_running_disk(domain, host, disk_obj, export)
         else:
-            is_running = False
-        if is_running:
-            domain.suspend()
-        try:
-            shutil.copyfile(disk_obj.path, path)
-        finally:
-            if is_running:
-                domain.resume()
+            export(disk_obj.path)
+    if state == 1:
+        define_host(host_id)
 
 
-@shared_task
+@shared_task(base=HostQueueTask)
 def snapshot_create(snapshot_id):
     snapshot_obj = HostSnapshot.objects.filter(id=snapshot_id).first()
     if not snapshot_obj:
         raise TaskError("not found snapshot")
     host = snapshot_obj.host
     try:
-        with libvirt.open(settings.LIBVIRT_URI) as conn:
+        with libvirt_connection() as conn:
             try:
                 domain = conn.lookupByUUIDString(host.instance_uuid)
             except libvirt.libvirtError:
                 raise TaskError("not found domain")
-            snapshot_xml_path = os.path.join(settings.BASE_DIR, 'assets/xml_templete/snapshot/snapshot.xml')
-            snapshot_disk_xml_path = os.path.join(settings.BASE_DIR, 'assets/xml_templete/snapshot/disk.xml')
-            with open(snapshot_xml_path, 'r') as f:
-                snapshot_root = ET.fromstring(f.read())
             info = domain.info()
             state = info[0]
-            if state == 1:
-                snapshot_root.find("./memory").attrib['snapshot'] = 'internal'
-            else:
-                snapshot_root.find("./memory").attrib['snapshot'] = 'no'
-            snapshot_root.find("./name").text = snapshot_obj.instance_name
-            snapshot_root.find("./description").text = snapshot_obj.desc
-            for storage in HostStorage.objects.filter(host=host, device=HOST_STORAGE_DEVICE_DISK, is_delete=False):
-                with open(snapshot_disk_xml_path, 'r') as f:
-                    disk_root = ET.fromstring(f.read())
-                    disk_root.attrib['name'] = storage.dev
-                    # path_args = os.path.splitext(storage.path)
-                    # new_path = "{}_snapshot_{}{}".format(path_args[0], snapshot_obj.instance_name, path_args[1])
-                    # disk_root.find("./source").attrib['file'] = new_path
-                    snapshot_root.find("./disks").append(disk_root)
-            new_snapshot = domain.snapshotCreateXML(ET.tostring(snapshot_root))
+            storages = HostStorage.objects.filter(host=host, device=HOST_STORAGE_DEVICE_DISK, is_delete=False)
+            snapshot_xml = render_snapshot_xml(snapshot_obj, storages, state == 1)
+            new_snapshot = domain.snapshotCreateXML(snapshot_xml)
             new_xml = new_snapshot.getXMLDesc()
             new_xml_root = ET.fromstring(new_xml)
             parent = new_xml_root.find("./parent/name")
@@ -324,13 +506,13 @@ def snapshot_create(snapshot_id):
         raise
 
 
-@shared_task
+@shared_task(base=HostQueueTask)
 def snapshot_revert(snapshot_id):
     snapshot_obj = HostSnapshot.objects.filter(id=snapshot_id).first()
     if not snapshot_obj:
         raise TaskError("not found snapshot")
     host = snapshot_obj.host
-    with libvirt.open(settings.LIBVIRT_URI) as conn:
+    with libvirt_connection() as conn:
         try:
             domain = conn.lookupByUUIDString(host.instance_uuid)
         except libvirt.libvirtError:
@@ -339,13 +521,13 @@ def snapshot_revert(snapshot_id):
         domain.revertToSnapshot(snap)
 
 
-@shared_task
+@shared_task(base=HostQueueTask)
 def snapshot_delete(snapshot_id):
     snapshot_obj = HostSnapshot.objects.filter(id=snapshot_id).first()
     if not snapshot_obj:
         raise TaskError("not found snapshot")
     host = snapshot_obj.host
-    with libvirt.open(settings.LIBVIRT_URI) as conn:
+    with libvirt_connection() as conn:
         try:
             domain = conn.lookupByUUIDString(host.instance_uuid)
         except libvirt.libvirtError:
@@ -354,3 +536,20 @@ def snapshot_delete(snapshot_id):
         snap.delete()
     snapshot_obj.is_delete = True
     snapshot_obj.save()
+
+
+@shared_task
+def collect_metrics():
+    hosts = dict((x.instance_uuid, x) for x in Host.objects.filter(is_delete=False))
+    with libvirt_connection() as conn:
+        records = conn.getAllDomainStats(COLLECT_STATS)
+    now = time.time()
+    metrics_map = dict((x.host_id, x) for x in HostMetrics.objects.filter(host__in=hosts.values()))
+    for domain, record in records:
+        host = hosts.get(domain.UUIDString())
+        if not host or record.get('state.state') != libvirt.VIR_DOMAIN_RUNNING:
+            continue
+        instance = metrics_map.get(host.id) or HostMetrics(host=host)
+        series = MetricSeries(instance)
+        series.record(now, read_counters(record), max_gap=settings.METRICS_INTERVAL * 3)
+        series.save()
@@ -1,6 +1,1435 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.test import TestCase
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from distutils.spawn import find_executable
+from xml.etree import ElementTree as ET
 
-# Create your tests here.
+import libvirt
+from celery import current_app, states as task_states
+from celery.exceptions import Retry
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from common.task_results import load_task_results
+from common.utils import BaseTest, gen_uuid, new_mac
+from host_manager import events, qemu_img, tasks
+from host_manager.disks import _sparse_copy, check_disk_tuning, copy_file, create_blank_disk, create_linked_clone, \
+    data_segments, version_number
+from host_manager.libvirt_pool import CONNECTION_ERROR_CODES, LibvirtConnectionPool, libvirt_connection, pool
+from host_manager.cpu_models import check_cpu_mode
+from host_manager.host_queue import finish, heartbeat, is_turn, queue_depth
+from host_manager.fleet import FleetSnapshot
+from host_manager.hugepages import check_hugepages
+from host_manager.metrics import MetricSeries, RingBuffer, derive_rates
+from host_manager.models import HostMetrics, Host, HostStorage, HostNetwork, HostSnapshot, HostTask, VncPorts, \
+    DISK_PROFILE_FULL_FALLOC, DISK_PROFILE_LARGE_CLUSTER, DISK_PROFILE_METADATA_PREALLOC, DISK_PROFILE_THIN, \
+    HOST_STORAGE_DEVICE_CDROM, HOST_STORAGE_DEVICE_DISK
+from host_manager.provision import build_networks, build_storages, is_full_copy
+from host_manager.numa import NodeTopology, assign_placement, format_cpuset, parse_cpuset, place
+from host_manager.tasks import export_running_disk, hotplug_disk, run_bulk_action
+from host_manager.serializers import status_map
+from host_manager.spare_pool import claim_spare, pool_key
+from host_manager.stats import OVERVIEW_STATS, RESOURCE_STATS, build_overview
+from host_manager.stream import event_stream
+from host_manager.views import HostViewSet, OverviewView, SnapshotViewSet
+from host_manager.vnc_ports import VncPortsExhausted, new_vnc_port, release_vnc_port
+from host_manager.xml_templates import assign_iothreads, build_cpu_element, render_domain_xml
+from vm_manager.celery import BULK_IO_QUEUE, INTERACTIVE_QUEUE, MAX_PRIORITY, route_task
+
+
+def load_test_data(name):
+    with open(os.path.join(os.path.dirname(__file__), 'test_data', name), 'r') as f:
+        return f.read()
+
+
+@contextlib.contextmanager
+def replace_attr(obj, name, value):
+    """
+    临时替换模块或对象的属性
+    """
+    original = getattr(obj, name)
+    setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        setattr(obj, name, original)
+
+
+@override_settings(LIBVIRT_URI='test:///default')
+class ListQueryCountTest(BaseTest):
+    def setUp(self):
+        user = User.objects.create_user('tester', password='123456')
+        self.client.force_login(user)
+        self.vnc_port = 5900
+
+    def create_hosts(self, count):
+        hosts = []
+        for i in range(count):
+            instance_uuid = gen_uuid()
+            self.vnc_port += 1
+            host = Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid,
+                                       instance_name='instance_' + instance_uuid, cpu_core=1,
+                                       vnc_port=self.vnc_port, mem_size_kb=1024 * 1024)
+            HostStorage.objects.create(host=host, device=HOST_STORAGE_DEVICE_DISK, dev='vda', bus='virtio',
+                                       path='/tmp/{}.qcow2'.format(instance_uuid))
+            HostNetwork.objects.create(host=host, mac=new_mac(), network_name='default', ip='')
+            HostNetwork.objects.create(host=host, mac=new_mac(), network_name='old', ip='', is_delete=True)
+            hosts.append(host)
+        return hosts
+
+    def create_snapshots(self, host, count):
+        parent = None
+        for i in range(count):
+            instance_name = gen_uuid()
+            HostSnapshot.objects.create(host=host, name=instance_name, instance_name=instance_name,
+                                        parent_instance_name=parent)
+            parent = instance_name
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response.json()
+
+    def test_host_list(self):
+        self.create_hosts(2)
+        small_count, _ = self.count_queries('/host/host/')
+        self.create_hosts(10)
+        large_count, data = self.count_queries('/host/host/')
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(len(data), 12)
+        for item in data:
+            self.assertEqual(item['network_names'], ['default'])
+            self.assertEqual(len(item['disks']), 1)
+
+    def test_snapshot_list(self):
+        host = self.create_hosts(1)[0]
+        url = '/host/host/{}/snapshot/'.format(host.id)
+        self.create_snapshots(host, 2)
+        small_count, _ = self.count_queries(url)
+        self.create_snapshots(host, 10)
+        large_count, data = self.count_queries(url)
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(len([x for x in data if x['parent']]), 10)
+
+
+class ListEtagTest(BaseTest):
+    def setUp(self):
+        user = User.objects.create_user('tester', password='123456')
+        self.client.force_login(user)
+        instance_uuid = gen_uuid()
+        self.task_id = gen_uuid()
+        self.host = Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                        cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024,
+                                        last_task_id=self.task_id, last_task_name='开机')
+        HostStorage.objects.create(host=self.host, device=HOST_STORAGE_DEVICE_DISK, dev='vda', bus='virtio',
+                                   path='/tmp/{}.qcow2'.format(instance_uuid))
+        current_app.backend.store_result(self.task_id, None, task_states.STARTED)
+        # 虚拟机列表只在监听事件时返回 ETag
+        cache.set(events.LISTENER_KEY, 'test:///default', timeout=60)
+
+    def tearDown(self):
+        cache.delete(events.LISTENER_KEY)
+
+    def get_etag(self, url):
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+        return response['ETag']
+
+    def assert_not_modified(self, url, etag, viewset):
+        # 304 在序列化之前返回, 去掉 serializer_class 后序列化会直接报错
+        with replace_attr(viewset, 'serializer_class', None):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def assert_changed(self, url, etag):
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_host_list(self):
+        url = '/host/host/'
+        etag = self.get_etag(url)
+        self.assert_not_modified(url, etag, HostViewSet)
+
+        self.host.save()
+        etag = self.assert_changed(url, etag)
+        current_app.backend.store_result(self.task_id, None, task_states.SUCCESS)
+        etag = self.assert_changed(url, etag)
+        HostTask.objects.create(host=self.host, task_id=gen_uuid(), name='关机')
+        etag = self.assert_changed(url, etag)
+        events.bump_state_generation()
+        etag = self.assert_changed(url, etag)
+        self.assert_not_modified(url, etag, HostViewSet)
+
+    def test_host_list_without_listener(self):
+        cache.delete(events.LISTENER_KEY)
+        self.assertIsNone(HostViewSet().get_list_etag(Host.objects.all()))
+
+    def test_snapshot_list(self):
+        url = '/host/host/{}/snapshot/'.format(self.host.id)
+        snapshot = HostSnapshot.objects.create(host=self.host, name='snap', instance_name=gen_uuid(),
+                                               last_task_id=self.task_id)
+        etag = self.get_etag(url)
+        self.assert_not_modified(url, etag, SnapshotViewSet)
+
+        snapshot.save()
+        etag = self.assert_changed(url, etag)
+        current_app.backend.store_result(self.task_id, None, task_states.SUCCESS)
+        etag = self.assert_changed(url, etag)
+        HostSnapshot.objects.create(host=self.host, name='snap2', instance_name=gen_uuid())
+        etag = self.assert_changed(url, etag)
+        self.assert_not_modified(url, etag, SnapshotViewSet)
+
+
+class FakeFleetDomain(object):
+    def __init__(self, instance_uuid, state):
+        self.instance_uuid = instance_uuid
+        self.state_code = state
+
+    def UUIDString(self):
+        return self.instance_uuid
+
+    def state(self):
+        return [self.state_code, 0]
+
+
+class FakeFleetNetwork(object):
+    def name(self):
+        return 'default'
+
+    def DHCPLeases(self):
+        return [{"mac": "52:54:00:00:00:01", "ipaddr": "192.168.122.10"}]
+
+
+class FakeFleetConnection(object):
+    def __init__(self, domains):
+        self.domains = dict((x.instance_uuid, x) for x in domains)
+        self.calls = []
+
+    def getAllDomainStats(self, stats):
+        self.calls.append('getAllDomainStats')
+        return [(x, {'state.state': x.state_code}) for x in self.domains.values()]
+
+    def lookupByUUIDString(self, instance_uuid):
+        self.calls.append('lookupByUUIDString')
+        if instance_uuid not in self.domains:
+            raise libvirt.libvirtError('domain not found')
+        return self.domains[instance_uuid]
+
+    def listAllNetworks(self):
+        return [FakeFleetNetwork()]
+
+
+class FleetSnapshotTest(SimpleTestCase):
+    xml = ("<domain><devices><interface type='network'><source network='default'/>"
+           "<mac address='52:54:00:00:00:01'/></interface></devices></domain>")
+
+    def test_load_all(self):
+        conn = FakeFleetConnection([FakeFleetDomain('a', libvirt.VIR_DOMAIN_RUNNING), FakeFleetDomain('b', 5)])
+        snapshot = FleetSnapshot.load(conn)
+        self.assertEqual(conn.calls, ['getAllDomainStats'])
+        # 网卡从保存的 XML 解析
+        self.assertEqual(snapshot.get('a', self.xml), {"state": libvirt.VIR_DOMAIN_RUNNING,
+                                                       "ipaddrs": ['192.168.122.10']})
+        self.assertEqual(snapshot.get('b'), {"state": 5, "ipaddrs": []})
+        self.assertIsNone(snapshot.get('c', self.xml))
+
+    def test_load_one(self):
+        conn = FakeFleetConnection([FakeFleetDomain('a', libvirt.VIR_DOMAIN_RUNNING), FakeFleetDomain('b', 5)])
+        snapshot = FleetSnapshot.load(conn, 'b')
+        self.assertEqual(conn.calls, ['lookupByUUIDString'])
+        self.assertEqual(snapshot.states, {'b': 5})
+        # 已不存在的虚拟机不报错
+        self.assertEqual(FleetSnapshot.load(conn, 'gone').states, {})
+
+
+class FakeOverviewConnection(object):
+    def __init__(self, records):
+        self.records = records
+        self.flags = []
+
+    def getAllDomainStats(self, stats):
+        self.flags.append(stats)
+        return self.records
+
+
+class OverviewTest(SimpleTestCase):
+    def setUp(self):
+        running = {'state.state': libvirt.VIR_DOMAIN_RUNNING, 'vcpu.current': 2, 'balloon.maximum': 4096,
+                   'balloon.current': 2048, 'balloon.rss': 1024, 'block.count': 2,
+                   'block.0.allocation': 10, 'block.0.capacity': 100, 'block.1.allocation': 5, 'block.1.capacity': 50}
+        stopped = {'state.state': 5, 'vcpu.current': 1, 'balloon.maximum': 1024, 'block.count': 1,
+                   'block.0.allocation': 1, 'block.0.capacity': 20}
+        self.conn = FakeOverviewConnection([(FakeFleetDomain('a', 1), running), (FakeFleetDomain('b', 5), stopped)])
+
+    def test_totals(self):
+        data = build_overview(self.conn, status_map)
+        self.assertEqual(data['vm_count'], 2)
+        self.assertEqual(data['vm_running_count'], 1)
+        self.assertEqual(data['state_counts']['running'], 1)
+        self.assertEqual(data['state_counts']['shut off'], 1)
+        self.assertEqual((data['total_cpu'], data['total_mem'], data['balloon_mem'], data['rss_mem']),
+                         (3, 5120, 2048, 1024))
+        self.assertEqual((data['disk_allocation'], data['disk_capacity']), (16, 170))
+        self.assertEqual(self.conn.flags, [OVERVIEW_STATS])
+
+    def test_cached_states(self):
+        # 缓存中 a 已暂停, b 不在缓存中
+        data = build_overview(self.conn, status_map, lambda uuids: {'a': 3})
+        self.assertEqual(self.conn.flags, [RESOURCE_STATS])
+        self.assertEqual(data['vm_running_count'], 0)
+        self.assertEqual(data['state_counts']['paused by user'], 1)
+        self.assertEqual(data['state_counts']['no state'], 1)
+        self.assertEqual(data['total_mem'], 5120)
+
+
+@override_settings(LIBVIRT_URI='test:///default')
+class OverviewViewTest(BaseTest):
+    def test_matches_domains(self):
+        user = User.objects.create_user('tester', password='123456')
+        self.client.force_login(user)
+        cache.delete(OverviewView.cache_key)
+        data = self.get('/host/overview/').json()
+        with libvirt_connection() as conn:
+            infos = [x.info() for x in conn.listAllDomains()]
+        self.assertEqual(data['vm_count'], len(infos))
+        self.assertEqual(data['vm_running_count'], len([x for x in infos if x[0] == libvirt.VIR_DOMAIN_RUNNING]))
+        for state, name in status_map.items():
+            self.assertEqual(data['state_counts'][name], len([x for x in infos if x[0] == state]))
+        self.assertEqual(data['total_mem'], sum(x[1] for x in infos))
+        self.assertEqual(data['total_cpu'], sum(x[3] for x in infos))
+        self.assertLessEqual(data['disk_allocation'], data['disk_capacity'])
+
+
+class LoadTaskResultsTest(BaseTest):
+    def test_one_query(self):
+        done_id = gen_uuid()
+        failed_id = gen_uuid()
+        missing_id = gen_uuid()
+        current_app.backend.store_result(done_id, {"value": 1}, task_states.SUCCESS)
+        current_app.backend.store_result(failed_id, ValueError('bad'), task_states.FAILURE)
+        with self.assertNumQueries(1):
+            results = load_task_results([done_id, failed_id, missing_id, None, ''])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[done_id], {"state": task_states.SUCCESS, "result": {"value": 1}})
+        self.assertEqual(results[failed_id]['state'], task_states.FAILURE)
+        self.assertIsInstance(results[failed_id]['result'], ValueError)
+        self.assertEqual(results[missing_id], {"state": task_states.PENDING, "result": None})
+
+    def test_empty(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(load_task_results([None]), {})
+
+
+class FakeConnectionError(libvirt.libvirtError):
+    def __init__(self, code):
+        super(FakeConnectionError, self).__init__('connection error')
+        self.code = code
+
+    def get_error_code(self):
+        return self.code
+
+
+class LibvirtConnectionPoolTest(SimpleTestCase):
+    uri = 'test:///default'
+
+    def setUp(self):
+        self.pool = LibvirtConnectionPool()
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def test_reuse_and_discard(self):
+        conn = self.pool.get(self.uri)
+        self.assertIs(self.pool.get(self.uri), conn)
+        # 已被替换的旧连接不影响当前连接
+        self.pool.discard(self.uri, object())
+        self.assertIs(self.pool.get(self.uri), conn)
+        self.pool.discard(self.uri, conn)
+        self.assertIsNot(self.pool.get(self.uri), conn)
+
+    def test_reset_after_fork(self):
+        conn = self.pool.get(self.uri)
+        # 模拟 prefork 子进程: pid 与创建连接时不同
+        self.pool._pid = -1
+        self.assertIsNot(self.pool.get(self.uri), conn)
+
+    def test_discard_on_connection_error(self):
+        with libvirt_connection(self.uri) as conn:
+            pass
+        with self.assertRaises(FakeConnectionError):
+            with libvirt_connection(self.uri) as same:
+                self.assertIs(same, conn)
+                raise FakeConnectionError(libvirt.VIR_ERR_OPERATION_INVALID)
+        with self.assertRaises(FakeConnectionError):
+            with libvirt_connection(self.uri) as same:
+                self.assertIs(same, conn)
+                raise FakeConnectionError(CONNECTION_ERROR_CODES[0])
+        with libvirt_connection(self.uri) as new_conn:
+            self.assertIsNot(new_conn, conn)
+        pool.discard(self.uri, new_conn)
+
+
+class DomainEventListenerTest(BaseTest):
+    uri = 'test:///default'
+
+    def setUp(self):
+        self.listener = events.DomainEventListener(self.uri, heartbeat_interval=1)
+        self.listener.start()
+        self.wait_for(events.is_listening)
+
+    def tearDown(self):
+        self.listener.stop()
+
+    def wait_for(self, func, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if func():
+                return
+            time.sleep(0.05)
+        self.fail('timeout waiting for libvirt event')
+
+    def test_lifecycle_updates_state_cache(self):
+        with libvirt_connection(self.uri) as conn:
+            domain = conn.lookupByName('test')
+            instance_uuid = domain.UUIDString()
+            self.assertEqual(events.get_domain_state(instance_uuid), libvirt.VIR_DOMAIN_RUNNING)
+            generation = events.get_state_generation()
+
+            domain.suspend()
+            self.wait_for(lambda: events.get_domain_state(instance_uuid) == libvirt.VIR_DOMAIN_PAUSED)
+            self.assertGreater(events.get_state_generation(), generation)
+
+            domain.resume()
+            self.wait_for(lambda: events.get_domain_state(instance_uuid) == libvirt.VIR_DOMAIN_RUNNING)
+
+
+class DomainStateCacheTest(SimpleTestCase):
+    def test_per_domain_keys(self):
+        listener = events.DomainEventListener('test:///default')
+        first, second = gen_uuid(), gen_uuid()
+        generation = events.get_state_generation()
+        listener._set_state(first, libvirt.VIR_DOMAIN_RUNNING)
+        listener._set_state(second, libvirt.VIR_DOMAIN_SHUTOFF)
+        self.assertGreater(events.get_state_generation(), generation)
+        self.assertEqual(events.get_domain_states([first, second, gen_uuid()]),
+                         {first: libvirt.VIR_DOMAIN_RUNNING, second: libvirt.VIR_DOMAIN_SHUTOFF})
+        listener._set_state(first, None)
+        self.assertEqual(events.get_domain_states([first, second]), {second: libvirt.VIR_DOMAIN_SHUTOFF})
+        self.assertIsNone(events.get_domain_state(first))
+
+
+class EventStreamTest(BaseTest):
+    def setUp(self):
+        super(EventStreamTest, self).setUp()
+        instance_uuid = gen_uuid()
+        self.task_id = gen_uuid()
+        self.host = Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                        cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024,
+                                        last_task_id=self.task_id, last_task_name='开机')
+        self.state_key = events.DOMAIN_STATE_KEY.format(instance_uuid)
+        cache.set(self.state_key, libvirt.VIR_DOMAIN_SHUTOFF)
+        cache.set(events.LISTENER_KEY, 'test:///default', timeout=60)
+
+    def tearDown(self):
+        cache.delete_many([self.state_key, events.LISTENER_KEY])
+
+    def read_round(self, stream):
+        """
+        读取一轮推送, 到 keepalive 为止
+        :return: [(event, data)]
+        """
+        items = []
+        for chunk in stream:
+            if chunk.startswith(': keepalive'):
+                return items
+            event, data = chunk.strip().split('\n')
+            items.append((event[len('event: '):], json.loads(data[len('data: '):])))
+        self.fail('stream ended')
+
+    def test_snapshot_then_changes(self):
+        current_app.backend.store_result(self.task_id, None, task_states.STARTED)
+        stream = event_stream(status_map, timeout=10, interval=0.01)
+        self.assertEqual(next(stream), 'retry: 3000\n\n')
+        first = self.read_round(stream)
+        self.assertEqual([x[0] for x in first], ['task', 'domain'])
+        self.assertEqual(first[0][1]['state'], task_states.STARTED)
+        self.assertEqual(first[0][1]['host_ids'], [self.host.id])
+        self.assertEqual(first[1][1]['state'], 'shut off')
+        self.assertEqual(self.read_round(stream), [])
+
+        current_app.backend.store_result(self.task_id, None, task_states.SUCCESS)
+        self.assertEqual([(x[0], x[1]['state']) for x in self.read_round(stream)], [('task', task_states.SUCCESS)])
+        cache.set(self.state_key, libvirt.VIR_DOMAIN_RUNNING)
+        events.bump_state_generation()
+        self.assertEqual([(x[0], x[1]['state']) for x in self.read_round(stream)], [('domain', 'running')])
+        self.assertEqual(self.read_round(stream), [])
+
+        # 监听停止后结束, 客户端重连时改为轮询
+        cache.delete(events.LISTENER_KEY)
+        self.assertEqual(list(stream), [])
+
+    def test_requires_listener(self):
+        cache.delete(events.LISTENER_KEY)
+        user = User.objects.create_user('tester', password='123456')
+        self.client.force_login(user)
+        self.assertEqual(self.get('/host/events/').status_code, 503)
+
+
+class RingBufferTest(SimpleTestCase):
+    def test_wrap_and_since(self):
+        buf = RingBuffer(3, 2)
+        for i in range(5):
+            buf.append(i * 10, [i, i * 2])
+        self.assertEqual(len(buf), 3)
+        self.assertEqual([(t, list(v)) for t, v in buf.rows()], [(20, [2, 4]), (30, [3, 6]), (40, [4, 8])])
+        self.assertEqual([t for t, v in buf.rows(since=25)], [30, 40])
+
+    def test_bytes(self):
+        buf = RingBuffer(3, 2)
+        for i in range(4):
+            buf.append(i, [i, -i])
+        same = RingBuffer.from_bytes(buf.to_bytes(), 3, 2)
+        self.assertEqual(list(same.rows()), list(buf.rows()))
+        # 容量和字段数变化时保留最新的点, 新字段补 0
+        resized = RingBuffer.from_bytes(buf.to_bytes(), 2, 3)
+        self.assertEqual([(t, list(v)) for t, v in resized.rows()], [(2, [2, -2, 0]), (3, [3, -3, 0])])
+        self.assertEqual(len(RingBuffer.from_bytes(None, 2, 3)), 0)
+
+
+def make_counters(cpu_time, rd_bytes, vcpus=2, mem_kb=1024):
+    return {'cpu_time': cpu_time, 'vcpus': vcpus, 'mem_kb': mem_kb, 'rd_bytes': rd_bytes, 'wr_bytes': 0,
+            'rx_bytes': 0, 'tx_bytes': 0}
+
+
+class MetricSeriesTest(SimpleTestCase):
+    def test_derive_rates(self):
+        values = derive_rates(make_counters(0, 0), make_counters(10 * 10 ** 9, 1000), 10)
+        self.assertEqual(values, [50, 1024, 100, 0, 0, 0])
+        # 计数器回退(虚拟机重启)或时间没有前进时不计算
+        self.assertIsNone(derive_rates(make_counters(10, 0), make_counters(5, 0), 10))
+        self.assertIsNone(derive_rates(make_counters(0, 0), make_counters(10, 0), 0))
+
+    def test_rollup(self):
+        series = MetricSeries(HostMetrics())
+        for i in range(6):
+            series.record(600 + i * 10, make_counters(0, i * 100))
+        # 第一个点只用于计算差值
+        self.assertEqual(len(series.buffers['raw']), 5)
+        self.assertEqual(len(series.buffers['minute']), 0)
+        self.assertEqual(series.dirty, {'raw'})
+        series.record(660, make_counters(0, 600))
+        rows = list(series.buffers['minute'].rows())
+        self.assertEqual([t for t, v in rows], [600])
+        self.assertEqual(rows[0][1][2], 10)
+        self.assertEqual(series.dirty, {'raw', 'minute'})
+        # 超过 max_gap 的间隔不产生点
+        series.record(1000, make_counters(0, 700), max_gap=30)
+        self.assertEqual(len(series.buffers['raw']), 6)
+
+
+@override_settings(METRICS_CAPACITY={'raw': 10, 'minute': 10, 'hour': 10})
+class MetricSeriesSaveTest(BaseTest):
+    def test_save_dirty_fields(self):
+        instance_uuid = gen_uuid()
+        host = Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                   cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024)
+        series = MetricSeries(HostMetrics(host=host))
+        series.record(600, make_counters(0, 0))
+        series.save()
+        series = MetricSeries(HostMetrics.objects.get(host=host))
+        series.record(610, make_counters(0, 100))
+        with CaptureQueriesContext(connection) as context:
+            series.save()
+        sql = context.captured_queries[-1]['sql']
+        self.assertIn('raw_data', sql)
+        self.assertNotIn('minute_data', sql)
+        self.assertNotIn('hour_data', sql)
+        self.assertEqual(len(MetricSeries(HostMetrics.objects.get(host=host)).buffers['raw']), 1)
+
+
+class BaseDiskTest(BaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        user = User.objects.create_user('tester', password='123456')
+        self.client.force_login(user)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    @unittest.skipUnless(find_executable('qemu-img'), 'qemu-img not installed')
+    def test_create_linked_clone(self):
+        base_path = os.path.join(self.dir, 'base.qcow2')
+        path = os.path.join(self.dir, 'vm.qcow2')
+        qemu_img.create(base_path, '64M')
+        create_linked_clone(base_path, path)
+        info = qemu_img.info(path)
+        self.assertEqual(info['format'], 'qcow2')
+        self.assertEqual(info['backing-filename'], base_path)
+        self.assertEqual(info['virtual-size'], 64 * 1024 * 1024)
+
+    def test_delete_base_in_use(self):
+        base_path = os.path.join(self.dir, 'base.qcow2')
+        with open(base_path, 'w') as f:
+            f.write('base')
+        instance_uuid = gen_uuid()
+        host = Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                   cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024)
+        storage = HostStorage.objects.create(host=host, device=HOST_STORAGE_DEVICE_DISK, dev='vda', bus='virtio',
+                                             path=os.path.join(self.dir, 'vm.qcow2'), backing_path=base_path)
+        with self.settings(VM_BASE_DISKS_DIR=self.dir):
+            self.assertEqual(self.delete('/host/base_disks/', {"name": "base.qcow2"}).status_code, 400)
+            self.assertTrue(os.path.exists(base_path))
+            storage.is_delete = True
+            storage.save()
+            self.assertEqual(self.delete('/host/base_disks/', {"name": "base.qcow2"}).status_code, 200)
+            self.assertFalse(os.path.exists(base_path))
+
+
+class FakeQemuImgProcess(object):
+    """
+    代替 subprocess.Popen, 按子命令返回预设的 (returncode, stdout, stderr), returncode 为 None 时一直运行到被结束
+    """
+    def __init__(self, args, outputs):
+        self.expected_returncode, self.output, self.error = outputs.get(args[1], (0, '', ''))
+        self.returncode = None
+        self.killed = threading.Event()
+        read_fd, write_fd = os.pipe()
+        os.write(write_fd, self.output.encode('utf-8'))
+        os.close(write_fd)
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self.stderr = io.StringIO(self.error)
+
+    def wait(self):
+        if self.expected_returncode is None:
+            self.killed.wait(5)
+            self.returncode = -9
+        else:
+            self.returncode = self.expected_returncode
+        self.stdout.close()
+        return self.returncode
+
+    def communicate(self):
+        self.wait()
+        return self.output, self.error
+
+    def kill(self):
+        self.killed.set()
+
+
+@contextlib.contextmanager
+def fake_qemu_img(outputs=None):
+    """
+    :return: 记录每次调用 qemu-img 之后参数的列表
+    """
+    calls = []
+
+    def popen(args, **kwargs):
+        calls.append(args[1:])
+        return FakeQemuImgProcess(args, outputs or {})
+
+    with replace_attr(qemu_img.subprocess, 'Popen', popen):
+        yield calls
+
+
+class QemuImgTest(SimpleTestCase):
+    def test_create_args(self):
+        with fake_qemu_img({'info': (0, json.dumps({'format': 'raw'}), '')}) as calls:
+            qemu_img.create('/tmp/vm.qcow2', '10G', options={'preallocation': 'metadata', 'cluster_size': '64k'})
+            qemu_img.create('/tmp/clone.qcow2', backing_file='/tmp/base.img')
+        self.assertEqual(calls, [
+            ['create', '-f', 'qcow2', '-o', 'cluster_size=64k,preallocation=metadata', '/tmp/vm.qcow2', '10G'],
+            ['info', '--output=json', '/tmp/base.img'],
+            ['create', '-f', 'qcow2', '-b', '/tmp/base.img', '-F', 'raw', '/tmp/clone.qcow2'],
+        ])
+
+    def test_error_stderr(self):
+        with fake_qemu_img({'check': (2, '', 'Could not open /tmp/vm.qcow2\n')}):
+            with self.assertRaises(qemu_img.QemuImgError) as context:
+                qemu_img.check('/tmp/vm.qcow2')
+        self.assertNotIsInstance(context.exception, qemu_img.QemuImgTimeout)
+        self.assertEqual(context.exception.returncode, 2)
+        self.assertEqual(context.exception.stderr, 'Could not open /tmp/vm.qcow2\n')
+        self.assertIn('Could not open /tmp/vm.qcow2', str(context.exception))
+
+    def test_timeout(self):
+        with fake_qemu_img({'info': (None, '', ''), 'convert': (None, '(10.00/100%)\r', '')}):
+            with self.assertRaises(qemu_img.QemuImgTimeout) as context:
+                qemu_img.run(['info', '/tmp/vm.qcow2'], timeout=0.05)
+            self.assertEqual(context.exception.timeout, 0.05)
+            with self.assertRaises(qemu_img.QemuImgTimeout):
+                qemu_img.run(['convert', '/tmp/vm.qcow2', '/tmp/copy.qcow2'], timeout=0.05, on_output=lambda x: None)
+
+    def test_convert_progress(self):
+        outputs = {
+            'info': (0, json.dumps({'virtual-size': 1000}), ''),
+            'convert': (0, '    (25.00/100%)\r    (50.50/100%)\r', ''),
+        }
+        progress = []
+        with fake_qemu_img(outputs) as calls:
+            qemu_img.convert('/tmp/vm.qcow2', '/tmp/copy.qcow2', compress=True,
+                             progress=lambda done, total: progress.append((done, total)))
+        self.assertEqual(calls[-1], ['convert', '-O', 'qcow2', '-c', '-p', '/tmp/vm.qcow2', '/tmp/copy.qcow2'])
+        self.assertEqual(progress[-1], (505, 1000))
+
+    def test_run_batch(self):
+        with fake_qemu_img({'check': (1, '', 'corrupt')}) as calls:
+            results = qemu_img.run_batch([
+                (qemu_img.create, ('/tmp/a.qcow2', '1G')),
+                (qemu_img.check, ('/tmp/b.qcow2',)),
+                (qemu_img.create, ('/tmp/c.qcow2', '1G')),
+            ], max_workers=2)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(results[0], (None, None))
+        self.assertEqual(results[2], (None, None))
+        self.assertIsNone(results[1][0])
+        self.assertIsInstance(results[1][1], qemu_img.QemuImgError)
+
+
+class DiskProfileTest(SimpleTestCase):
+    def create(self, disk_profile):
+        calls = []
+        with replace_attr(qemu_img, 'run', lambda args, **kwargs: calls.append(args)):
+            create_blank_disk('/tmp/vm.qcow2', '10G', disk_profile)
+        self.assertEqual(len(calls), 1)
+        return calls[0]
+
+    def test_profile_options(self):
+        self.assertEqual(self.create(DISK_PROFILE_THIN), ['create', '-f', 'qcow2', '/tmp/vm.qcow2', '10G'])
+        self.assertEqual(self.create(DISK_PROFILE_METADATA_PREALLOC),
+                         ['create', '-f', 'qcow2', '-o', 'lazy_refcounts=on,preallocation=metadata',
+                          '/tmp/vm.qcow2', '10G'])
+        self.assertEqual(self.create(DISK_PROFILE_FULL_FALLOC),
+                         ['create', '-f', 'qcow2', '-o', 'lazy_refcounts=on,preallocation=falloc',
+                          '/tmp/vm.qcow2', '10G'])
+        self.assertEqual(self.create(DISK_PROFILE_LARGE_CLUSTER),
+                         ['create', '-f', 'qcow2', '-o', 'cluster_size=2M,lazy_refcounts=on', '/tmp/vm.qcow2', '10G'])
+
+    def test_default_profile(self):
+        with self.settings(DEFAULT_DISK_PROFILE=DISK_PROFILE_LARGE_CLUSTER):
+            self.assertEqual(self.create(None), self.create(DISK_PROFILE_LARGE_CLUSTER))
+        with self.settings(DEFAULT_DISK_PROFILE=DISK_PROFILE_THIN):
+            self.assertEqual(self.create(None), ['create', '-f', 'qcow2', '/tmp/vm.qcow2', '10G'])
+
+
+class SparseCopyTest(SimpleTestCase):
+    size = 16 * 1024 * 1024
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src.img')
+        with open(self.src, 'wb') as f:
+            f.write(b'a' * 4096)
+            f.seek(8 * 1024 * 1024)
+            f.write(b'b' * 4096)
+            f.truncate(self.size)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def is_sparse(self, path):
+        return os.stat(path).st_blocks * 512 < self.size // 2
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def check_copy(self, dst):
+        self.assertEqual(self.read(dst), self.read(self.src))
+        # 文件系统不支持空洞时源文件本身也不是稀疏的
+        if self.is_sparse(self.src):
+            self.assertTrue(self.is_sparse(dst))
+
+    def test_data_segments(self):
+        if not self.is_sparse(self.src):
+            self.skipTest('filesystem does not support holes')
+        fd = os.open(self.src, os.O_RDONLY)
+        try:
+            segments = data_segments(fd, self.size)
+        finally:
+            os.close(fd)
+        self.assertEqual(len(segments), 2)
+        self.assertEqual(segments[0][0], 0)
+        self.assertLessEqual(segments[1][0], 8 * 1024 * 1024)
+        self.assertLess(segments[0][1], segments[1][0])
+
+    def test_copy_file(self):
+        dst = os.path.join(self.dir, 'dst.img')
+        progress = []
+        copy_file(self.src, dst, lambda done, total: progress.append((done, total)))
+        self.check_copy(dst)
+        self.assertEqual(progress[-1], (self.size, self.size))
+
+    def test_sparse_copy(self):
+        # 不经过 FICLONE, 直接测试不支持 reflink 时的复制
+        dst = os.path.join(self.dir, 'dst.img')
+        src_fd = os.open(self.src, os.O_RDONLY)
+        dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            _sparse_copy(src_fd, dst_fd, self.size)
+        finally:
+            os.close(src_fd)
+            os.close(dst_fd)
+        self.check_copy(dst)
+
+
+class FakeExportDomain(object):
+    def __init__(self):
+        self.calls = []
+
+    def snapshotCreateXML(self, xml, flags):
+        self.calls.append(('snapshot', ET.fromstring(xml), flags))
+        # 与 libvirt 一样创建 overlay 文件
+        overlay_path = ET.fromstring(xml).find("./disks/disk[@snapshot='external']/source").get('file')
+        open(overlay_path, 'w').close()
+
+    def blockCommit(self, disk, base, top, bandwidth, flags):
+        self.calls.append(('commit', disk, base, top, flags))
+
+    def blockJobInfo(self, disk, flags):
+        return {'cur': 10, 'end': 10}
+
+    def blockJobAbort(self, disk, flags):
+        self.calls.append(('abort', disk, flags))
+
+
+class ExportRunningDiskTest(BaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        instance_uuid = gen_uuid()
+        self.host = Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                        cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024)
+        self.disk = HostStorage.objects.create(host=self.host, device=HOST_STORAGE_DEVICE_DISK, dev='vda',
+                                               bus='virtio', path=os.path.join(self.dir, 'vm.qcow2'),
+                                               backing_path=os.path.join(self.dir, 'base.qcow2'))
+        HostStorage.objects.create(host=self.host, device=HOST_STORAGE_DEVICE_DISK, dev='vdb', bus='virtio',
+                                   path=os.path.join(self.dir, 'data.qcow2'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_commit_into_own_disk_only(self):
+        domain = FakeExportDomain()
+        exported = []
+        export_running_disk(domain, self.host, self.disk, exported.append)
+        self.assertEqual(exported, [self.disk.path])
+        (_, snapshot, snapshot_flags), commit, abort = domain.calls
+        self.assertEqual(snapshot.find("./disks/disk[@name='vdb']").get('snapshot'), 'no')
+        self.assertTrue(snapshot_flags & libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY)
+        # 链接克隆的 backing chain 为 base <- vm.qcow2 <- overlay, 只能合并到 vm.qcow2
+        self.assertEqual(commit[:4], ('commit', 'vda', None, None))
+        self.assertTrue(commit[4] & libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+        self.assertTrue(commit[4] & libvirt.VIR_DOMAIN_BLOCK_COMMIT_SHALLOW)
+        self.assertEqual(abort, ('abort', 'vda', libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT))
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_commit_after_failed_export(self):
+        domain = FakeExportDomain()
+
+        def export(path):
+            raise IOError('disk full')
+
+        self.assertRaises(IOError, export_running_disk, domain, self.host, self.disk, export)
+        self.assertEqual([x[0] for x in domain.calls], ['snapshot', 'commit', 'abort'])
+
+
+@override_settings(VM_DATA_DIR='/data', VM_BASE_DISKS_DIR='/base', VM_ISO_DIR='/iso')
+class ProvisionBuildTest(SimpleTestCase):
+    def setUp(self):
+        self.host = Host(instance_uuid=gen_uuid(), instance_name='instance_1', cpu_core=1, vnc_port=5900,
+                         mem_size_kb=1024 * 1024)
+
+    def test_linked_clone(self):
+        storages = build_storages(self.host, False, 'centos.img', [], 'linked')
+        self.assertEqual(len(storages), 1)
+        self.assertEqual(storages[0].path, '/data/instance_1/centos.qcow2')
+        self.assertEqual(storages[0].backing_path, '/base/centos.img')
+        self.assertEqual(storages[0].dev, 'vda')
+
+    def test_full_copy(self):
+        storage = build_storages(self.host, False, 'centos.img', [], 'full', 'full-falloc')[0]
+        self.assertEqual(storage.path, '/data/instance_1/centos.img')
+        self.assertIsNone(storage.backing_path)
+        # 完整复制基础镜像, 不使用新建硬盘的配置
+        self.assertIsNone(storage.disk_profile)
+
+    @override_settings(DEFAULT_DISK_PROFILE='metadata-prealloc')
+    def test_iso(self):
+        storages = build_storages(self.host, True, None, ['a.iso', 'b.iso'])
+        self.assertEqual(storages[0].path, '/data/instance_1/root_disk0.qcow2')
+        self.assertEqual(storages[0].disk_profile, 'metadata-prealloc')
+        self.assertEqual([(x.dev, x.path) for x in storages[1:]], [('hda', '/iso/a.iso'), ('hdb', '/iso/b.iso')])
+
+    def test_full_copy_detection(self):
+        linked = build_storages(self.host, False, 'centos.img', [], 'linked')[0]
+        full = build_storages(self.host, False, 'centos.img', [], 'full')[0]
+        blank = build_storages(self.host, True, None, [])[0]
+        self.assertFalse(is_full_copy(linked, False))
+        self.assertTrue(is_full_copy(full, False))
+        self.assertFalse(is_full_copy(blank, True))
+        self.assertFalse(is_full_copy(None, False))
+
+    def test_networks(self):
+        networks = build_networks(self.host, ['default', 'lan'])
+        self.assertEqual([x.network_name for x in networks], ['default', 'lan'])
+        self.assertEqual(len(set(x.mac for x in networks)), 2)
+
+
+@override_settings(VNC_PORT_CHECK_IN_USE=False, BULK_CREATE_MAX_COUNT=5, BULK_CREATE_PARALLELISM=2)
+class BulkHostViewTest(BaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        user = User.objects.create_user('tester', password='123456')
+        self.client.force_login(user)
+        # 在当前进程执行创建任务, 基础镜像不存在, 每台都会失败并记录到各自的任务上
+        current_app.conf.task_always_eager = True
+
+    def tearDown(self):
+        current_app.conf.task_always_eager = False
+        shutil.rmtree(self.dir)
+
+    def test_create_and_progress(self):
+        data = {"name": "web", "count": 3, "cpu_core": 1, "mem_size_kb": 1024 * 1024, "base_disk_name": "base.img",
+                "network_names": ["default", ""], "parallelism": 4}
+        with self.settings(VM_DATA_DIR=self.dir, VM_BASE_DISKS_DIR=self.dir):
+            response = self.post('/host/host/bulk/', data)
+        self.assertEqual(response.status_code, 200)
+        batch_id = response.json()['batch_id']
+        hosts = Host.objects.filter(batch_id=batch_id)
+        self.assertEqual(sorted(x.name for x in hosts), ['web-1', 'web-2', 'web-3'])
+        self.assertEqual(len(set(x.vnc_port for x in hosts)), 3)
+        self.assertEqual(HostStorage.objects.filter(host__in=hosts, dev='vda').count(), 3)
+        self.assertEqual(HostNetwork.objects.filter(host__in=hosts, network_name='default').count(), 3)
+
+        progress = self.get('/host/host/bulk/{}/'.format(batch_id)).json()
+        self.assertEqual(progress['total'], 3)
+        self.assertEqual(progress['finished'], 3)
+        self.assertEqual(progress['states'], {task_states.FAILURE: 3})
+
+    def test_validation(self):
+        data = {"name": "web", "count": 6, "cpu_core": 1, "mem_size_kb": 1024 * 1024, "base_disk_name": "base.img"}
+        self.assertEqual(self.post('/host/host/bulk/', data).status_code, 400)
+        data['count'] = 2
+        del data['base_disk_name']
+        self.assertEqual(self.post('/host/host/bulk/', data).status_code, 400)
+        self.assertFalse(Host.objects.exists())
+
+
+class BulkActionTest(BaseTest):
+    def test_staggered_starts(self):
+        starts = []
+        active = {"now": 0, "max": 0}
+        lock = threading.Lock()
+
+        def action(host_id):
+            with lock:
+                starts.append(time.time())
+                active['now'] += 1
+                active['max'] = max(active['max'], active['now'])
+            time.sleep(0.3)
+            with lock:
+                active['now'] -= 1
+            if host_id == 'bad':
+                raise ValueError('start failed')
+
+        host_tasks = [(x, gen_uuid()) for x in ('a', 'b', 'bad', 'c', 'd')]
+        outcomes = run_bulk_action(current_app.backend, host_tasks, action, 3, delay=0.1)
+        starts.sort()
+        gaps = [y - x for x, y in zip(starts, starts[1:])]
+        # 第一批也要错开, 而不是 max_in_flight 台同时开始
+        self.assertGreaterEqual(min(gaps), 0.09)
+        self.assertLessEqual(active['max'], 3)
+        self.assertEqual(outcomes['bad'], {"state": task_states.FAILURE, "result": 'start failed'})
+        self.assertEqual(outcomes['a']['state'], task_states.SUCCESS)
+        results = load_task_results([x[1] for x in host_tasks])
+        self.assertEqual(sorted(x['state'] for x in results.values()),
+                         sorted([task_states.SUCCESS] * 4 + [task_states.FAILURE]))
+
+    def test_queue_error_recorded(self):
+        host_tasks = [(x, gen_uuid()) for x in ('a', 'b', 'c')]
+        broken_id = host_tasks[1][1]
+
+        def wait_for_turn(task_id):
+            if task_id == broken_id:
+                raise ValueError('queue unavailable')
+
+        with replace_attr(tasks, 'wait_for_turn', wait_for_turn):
+            outcomes = run_bulk_action(current_app.backend, host_tasks, lambda host_id: None, 2)
+        self.assertEqual(outcomes['b'], {"state": task_states.FAILURE, "result": 'queue unavailable'})
+        self.assertEqual(outcomes['a']['state'], task_states.SUCCESS)
+        self.assertEqual(outcomes['c']['state'], task_states.SUCCESS)
+        self.assertEqual(load_task_results([broken_id])[broken_id]['state'], task_states.FAILURE)
+
+
+class HostQueueTest(BaseTest):
+    def setUp(self):
+        super(HostQueueTest, self).setUp()
+        self.now = timezone.now()
+        self.host = self.create_host()
+
+    def create_host(self):
+        instance_uuid = gen_uuid()
+        return Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                   cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024)
+
+    def add(self, seconds_ago, host=None, heartbeat_ago=None):
+        task_id = gen_uuid()
+        heartbeat_time = None if heartbeat_ago is None else self.now - datetime.timedelta(seconds=heartbeat_ago)
+        HostTask.objects.create(host=host or self.host, task_id=task_id, name='test',
+                                create_time=self.now - datetime.timedelta(seconds=seconds_ago),
+                                heartbeat_time=heartbeat_time)
+        return task_id
+
+    def test_order(self):
+        first, second, third = self.add(3), self.add(2), self.add(1)
+        other = self.add(4, host=self.create_host())
+        self.assertTrue(is_turn(first))
+        self.assertFalse(is_turn(second))
+        self.assertFalse(is_turn(third))
+        # 其它虚拟机的队列互不影响
+        self.assertTrue(is_turn(other))
+        self.assertEqual(queue_depth(self.host.id), 3)
+        finish(first)
+        self.assertTrue(is_turn(second))
+        self.assertFalse(is_turn(third))
+        self.assertTrue(is_turn(gen_uuid()))
+
+    def test_ready_entry_ahead(self):
+        first, second = self.add(2), self.add(1)
+        current_app.backend.store_result(first, None, task_states.SUCCESS)
+        self.assertTrue(is_turn(second))
+        self.assertFalse(HostTask.objects.filter(task_id=first).exists())
+
+    @override_settings(HOST_QUEUE_HEARTBEAT_TIMEOUT=60, HOST_QUEUE_ENTRY_TIMEOUT=3600)
+    def test_dead_entry_ahead(self):
+        alive = self.add(7200, heartbeat_ago=10)
+        waiting = self.add(1)
+        self.assertFalse(is_turn(waiting))
+        HostTask.objects.filter(task_id=alive).update(heartbeat_time=self.now - datetime.timedelta(seconds=120))
+        self.assertTrue(is_turn(waiting))
+        self.assertFalse(HostTask.objects.filter(task_id=alive).exists())
+        finish(waiting)
+        # 从未开始执行的记录只在超过 HOST_QUEUE_ENTRY_TIMEOUT 后清除
+        queued = self.add(600)
+        last = self.add(0)
+        self.assertFalse(is_turn(last))
+        HostTask.objects.filter(task_id=queued).update(create_time=self.now - datetime.timedelta(seconds=7200))
+        self.assertTrue(is_turn(last))
+
+    @override_settings(HOST_QUEUE_HEARTBEAT_INTERVAL=0.05)
+    def test_heartbeat(self):
+        task_id = self.add(0)
+        with heartbeat(task_id):
+            time.sleep(0.2)
+            beat_time = HostTask.objects.get(task_id=task_id).heartbeat_time
+            self.assertIsNotNone(beat_time)
+            time.sleep(0.2)
+            self.assertGreater(HostTask.objects.get(task_id=task_id).heartbeat_time, beat_time)
+
+
+class TaskRouteTest(BaseTest):
+    def test_create_host_route(self):
+        name = 'host_manager.tasks.create_host'
+        interactive = {'queue': INTERACTIVE_QUEUE, 'priority': MAX_PRIORITY}
+        bulk_io = {'queue': BULK_IO_QUEUE, 'priority': 0}
+        self.assertEqual(route_task(name, [gen_uuid(), False, 'base.qcow2', [], 10, [], 'linked'], {}, {}), interactive)
+        self.assertEqual(route_task(name, [gen_uuid(), True, None, ['a.iso'], 10, []], {}, {}), interactive)
+        self.assertEqual(route_task(name, [gen_uuid(), False, 'base.qcow2', [], 10, [], 'full'], {}, {}), bulk_io)
+        self.assertEqual(route_task(name, [gen_uuid(), False, 'base.qcow2', [], 10, []], {'clone_mode': 'linked'}, {}),
+                         interactive)
+        with self.settings(DEFAULT_CLONE_MODE='full'):
+            self.assertEqual(route_task(name, [gen_uuid(), False, 'base.qcow2', [], 10, []], {}, {}), bulk_io)
+        self.assertEqual(route_task('host_manager.tasks.host_action', [gen_uuid(), 'start'], {}, {}), interactive)
+        self.assertEqual(route_task('host_manager.tasks.save_disk_to_base', [], {}, {}), bulk_io)
+        self.assertIsNone(route_task('host_manager.tasks.collect_metrics', [], {}, {}))
+
+    def retry(self, task, args, delivery_info):
+        """
+        排在其它任务之后的 task 重试一次
+        :return: 重试消息经过路由后的参数
+        """
+        host = Host.objects.get(id=args[0])
+        HostTask.objects.create(host=host, task_id=gen_uuid(), name='test')
+        task_id = gen_uuid()
+        HostTask.objects.create(host=host, task_id=task_id, name='test')
+        app = task._get_app()
+        sent = []
+
+        def send_task(name, args=None, kwargs=None, **options):
+            sent.append(app.amqp.router.route(options, name, args, kwargs))
+
+        task.push_request(id=task_id, args=args, kwargs={}, delivery_info=delivery_info, called_directly=False)
+        try:
+            with replace_attr(app, 'send_task', send_task):
+                with self.assertRaises(Retry):
+                    task(*args)
+        finally:
+            task.pop_request()
+        self.assertEqual(len(sent), 1)
+        return sent[0]
+
+    def test_retry_keeps_queue(self):
+        instance_uuid = gen_uuid()
+        host = Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                   cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024)
+        options = self.retry(tasks.host_action, [host.id, 'start'],
+                             {'exchange': INTERACTIVE_QUEUE, 'routing_key': INTERACTIVE_QUEUE,
+                              'priority': MAX_PRIORITY})
+        self.assertEqual(options['queue'].name, INTERACTIVE_QUEUE)
+        self.assertEqual(options['routing_key'], INTERACTIVE_QUEUE)
+        self.assertEqual(options['priority'], MAX_PRIORITY)
+
+        options = self.retry(tasks.create_host, [host.id, False, 'base.qcow2', [], 10, [], 'full'],
+                             {'exchange': '', 'routing_key': BULK_IO_QUEUE, 'priority': 0})
+        self.assertEqual(options['queue'].name, BULK_IO_QUEUE)
+        self.assertEqual(options['priority'], 0)
+
+
+class NumaPlacementTest(SimpleTestCase):
+    def setUp(self):
+        self.topology = NodeTopology.from_capabilities(load_test_data('capabilities_2socket.xml'))
+
+    def test_cpuset(self):
+        self.assertEqual(parse_cpuset('0-3,8,10-11'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(format_cpuset([11, 0, 1, 2, 3, 8, 10]), '0-3,8,10-11')
+        self.assertEqual(parse_cpuset(''), [])
+
+    def test_parse_topology(self):
+        self.assertEqual([x.id for x in self.topology.cells], [0, 1])
+        self.assertEqual(self.topology.cells[0].cpus, [0, 1, 2, 3, 8, 9, 10, 11])
+        self.assertEqual(self.topology.cells[1].cores[0], [4, 12])
+        self.assertEqual(self.topology.cells[1].memory_kb, 32 * 1024 * 1024)
+        single = NodeTopology.from_capabilities(load_test_data('capabilities_1node.xml'))
+        self.assertEqual(single.cells[0].cores, [[0], [1], [2], [3]])
+
+    def test_place_in_one_cell_on_whole_cores(self):
+        placement = place(self.topology, 4, 1024 * 1024, [])
+        self.assertEqual(placement.nodes, [0])
+        self.assertEqual(placement.cpus, [0, 1, 8, 9])
+
+    def test_place_skips_used_cpus_and_memory(self):
+        placement = place(self.topology, 4, 1024 * 1024, [([0, 1, 8, 9], [0], 1024 * 1024)])
+        self.assertEqual(placement.nodes, [1])
+        placement = place(self.topology, 2, 1024 * 1024, [([0, 8], [0], 1024 * 1024), ([4, 12], [1], 1024)])
+        self.assertEqual(placement.nodes, [1])
+        self.assertFalse({4, 12}.intersection(placement.cpus))
+
+    def test_place_across_cells(self):
+        placement = place(self.topology, 12, 1024 * 1024, [])
+        self.assertEqual(placement.nodes, [0, 1])
+        self.assertEqual(len(set(placement.cpus)), 12)
+        self.assertIsNone(place(self.topology, 17, 1024 * 1024, []))
+
+    def test_render(self):
+        placement = place(self.topology, 2, 1024 * 1024, [])
+        host = Host(instance_uuid=gen_uuid(), instance_name='numa', cpu_core=2, mem_size_kb=1024 * 1024,
+                    vnc_port=5900)
+        root = ET.fromstring(render_domain_xml(host, [], [], placement))
+        self.assertEqual([(x.get('vcpu'), x.get('cpuset')) for x in root.findall('./cputune/vcpupin')],
+                         [('0', '0'), ('1', '8')])
+        self.assertEqual(root.find('./cputune/emulatorpin').get('cpuset'), '0,8')
+        self.assertEqual(root.find('./numatune/memory').attrib, {'mode': 'strict', 'nodeset': '0'})
+
+
+class AssignPlacementTest(BaseTest):
+    def create_host(self, cpu_core):
+        instance_uuid = gen_uuid()
+        return Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                   cpu_core=cpu_core, vnc_port=5900, mem_size_kb=1024 * 1024)
+
+    def test_assign_is_exclusive_and_stable(self):
+        topology = NodeTopology.from_capabilities(load_test_data('capabilities_2socket.xml'))
+        first = self.create_host(4)
+        second = self.create_host(4)
+        first_cpus = assign_placement(first, topology).cpus
+        second_cpus = assign_placement(second, topology).cpus
+        self.assertFalse(set(first_cpus).intersection(second_cpus))
+        first = Host.objects.get(id=first.id)
+        self.assertEqual(parse_cpuset(first.cpuset), first_cpus)
+        self.assertEqual(assign_placement(first, topology).cpus, first_cpus)
+
+
+class FakeHugepageConnection(object):
+    def __init__(self, free):
+        self.free = free
+
+    def getInfo(self):
+        return ['x86_64', 65536, 16, 2400, len(self.free), 1, 8, 1]
+
+    def getFreePages(self, pages, start_cell, cell_count):
+        return dict((cell, {pages[0]: count}) for cell, count in enumerate(self.free))
+
+
+class HugepagesTest(SimpleTestCase):
+    def test_check_free_pages(self):
+        conn = FakeHugepageConnection([512, 2048])
+        self.assertIsNone(check_hugepages(conn, 4 * 1024 * 1024, 2048))
+        self.assertIsNone(check_hugepages(conn, 4 * 1024 * 1024, 2048, [1]))
+        self.assertIsNotNone(check_hugepages(conn, 4 * 1024 * 1024, 2048, [0]))
+        self.assertIsNotNone(check_hugepages(conn, 6 * 1024 * 1024, 2048))
+
+    def test_render(self):
+        host = Host(instance_uuid=gen_uuid(), instance_name='hugepages', cpu_core=2, mem_size_kb=1024 * 1024,
+                    vnc_port=5900, hugepage_size_kb=2048)
+        topology = NodeTopology.from_capabilities(load_test_data('capabilities_2socket.xml'))
+        # 节点 0 已被占用, 放到宿主机节点 1; 大页从哪个节点分配只由 numatune 决定
+        placement = place(topology, 2, 1024 * 1024, [([0, 1, 8, 9], [0], 1024 * 1024)])
+        self.assertEqual(placement.nodes, [1])
+        root = ET.fromstring(render_domain_xml(host, [], [], placement))
+        self.assertEqual(root.find('./memoryBacking/hugepages/page').attrib, {'size': '2048', 'unit': 'KiB'})
+        self.assertEqual(root.find('./numatune/memory').get('nodeset'), '1')
+
+
+class FakeDiskTuningConnection(object):
+    def __init__(self, lib_version=version_number(8, 0), qemu_version=version_number(6, 2), iothreads=None):
+        self.lib_version = lib_version
+        self.qemu_version = qemu_version
+        self.iothreads = iothreads
+
+    def getLibVersion(self):
+        return self.lib_version
+
+    def getVersion(self):
+        return self.qemu_version
+
+    def getDomainCapabilities(self):
+        if self.iothreads is None:
+            return '<domainCapabilities/>'
+        return '<domainCapabilities><iothreads supported="{}"/></domainCapabilities>'.format(self.iothreads)
+
+
+class FakeHotplugDomain(object):
+    def __init__(self, iothread_ids):
+        self.iothread_ids = iothread_ids
+        self.added = []
+        self.attached = []
+
+    def ioThreadInfo(self):
+        return [(x, [True]) for x in self.iothread_ids]
+
+    def addIOThread(self, iothread_id, flags):
+        self.added.append(iothread_id)
+
+    def attachDevice(self, xml):
+        self.attached.append(ET.fromstring(xml))
+
+
+class DiskTuningTest(SimpleTestCase):
+    def storage(self, dev, iothread=False, device=HOST_STORAGE_DEVICE_DISK):
+        return HostStorage(device=device, dev=dev, bus='virtio', path='/data/{}.qcow2'.format(dev), iothread=iothread)
+
+    def test_check_disk_tuning(self):
+        conn = FakeDiskTuningConnection()
+        self.assertIsNone(check_disk_tuning(conn, 'virtio', 'none', 'native', 'unmap', True))
+        self.assertIsNone(check_disk_tuning(conn, 'ide', None, None, None, False))
+        self.assertIsNotNone(check_disk_tuning(conn, 'virtio', 'bogus', None, None, False))
+        self.assertIsNotNone(check_disk_tuning(conn, 'virtio', 'writeback', 'native', None, False))
+        self.assertIsNone(check_disk_tuning(conn, 'virtio', 'directsync', 'native', None, False))
+        self.assertIsNotNone(check_disk_tuning(conn, 'ide', None, None, None, True))
+
+    def test_check_versions(self):
+        old_qemu = FakeDiskTuningConnection(qemu_version=version_number(2, 0))
+        self.assertIsNotNone(check_disk_tuning(old_qemu, 'virtio', None, 'io_uring', None, False))
+        self.assertIsNotNone(check_disk_tuning(old_qemu, 'virtio', None, None, None, True))
+        self.assertIsNone(check_disk_tuning(old_qemu, 'virtio', None, None, 'unmap', False))
+        old_libvirt = FakeDiskTuningConnection(lib_version=version_number(1, 0))
+        self.assertIsNotNone(check_disk_tuning(old_libvirt, 'virtio', None, None, 'unmap', False))
+        unsupported = FakeDiskTuningConnection(iothreads='no')
+        self.assertIsNotNone(check_disk_tuning(unsupported, 'virtio', None, None, None, True))
+        self.assertIsNone(check_disk_tuning(FakeDiskTuningConnection(iothreads='yes'), 'virtio', None, None, None,
+                                            True))
+
+    def test_assign_iothreads(self):
+        storages = [self.storage('vda', True), self.storage('vdb'),
+                    self.storage('hda', True, HOST_STORAGE_DEVICE_CDROM), self.storage('vdc', True)]
+        self.assertEqual(assign_iothreads(storages), {'vda': 1, 'vdc': 2})
+
+    def test_hotplug_keeps_iothread(self):
+        domain = FakeHotplugDomain([1])
+        hotplug_disk(domain, self.storage('vdc', True), [self.storage('vda', True), self.storage('vdb')])
+        self.assertEqual(domain.added, [2])
+        self.assertEqual(domain.attached[0].find('./driver').get('iothread'), '2')
+        self.assertEqual(domain.attached[0].find('./target').get('dev'), 'vdc')
+
+        domain = FakeHotplugDomain([1])
+        hotplug_disk(domain, self.storage('vdc'), [self.storage('vda', True)])
+        self.assertEqual(domain.added, [])
+        self.assertIsNone(domain.attached[0].find('./driver').get('iothread'))
+
+
+class FakeDomainCapsConnection(object):
+    def getDomainCapabilities(self):
+        return load_test_data('domain_capabilities.xml')
+
+
+class CpuModeTest(SimpleTestCase):
+    def test_check_cpu_mode(self):
+        conn = FakeDomainCapsConnection()
+        self.assertIsNone(check_cpu_mode(conn, 'legacy'))
+        self.assertIsNone(check_cpu_mode(conn, 'host-passthrough'))
+        self.assertIsNotNone(check_cpu_mode(conn, 'host-model'))
+        self.assertIsNone(check_cpu_mode(conn, 'custom', 'SandyBridge'))
+        self.assertIsNotNone(check_cpu_mode(conn, 'custom', 'Skylake-Server'))
+        self.assertIsNotNone(check_cpu_mode(conn, 'custom'))
+        self.assertIsNotNone(check_cpu_mode(conn, 'unknown'))
+
+    def test_render(self):
+        host = Host(instance_uuid=gen_uuid(), instance_name='cpu-mode', cpu_core=2, mem_size_kb=1024 * 1024,
+                    vnc_port=5900)
+        root = ET.fromstring(render_domain_xml(host, [], []))
+        self.assertEqual(root.find('./cpu/model').text, 'IvyBridge')
+        root = ET.fromstring(render_domain_xml(host, [], [], cpu=build_cpu_element('host-passthrough')))
+        self.assertEqual(len(root.findall('./cpu')), 1)
+        self.assertEqual(root.find('./cpu').attrib, {'mode': 'host-passthrough', 'check': 'none'})
+        root = ET.fromstring(render_domain_xml(host, [], [], cpu=build_cpu_element('custom', 'SandyBridge')))
+        self.assertEqual(root.find('./cpu/model').text, 'SandyBridge')
+        self.assertEqual(root.find('./cpu/model').get('fallback'), 'forbid')
+
+
+class SpareClaimTest(BaseTest):
+    def create_spare(self, cpu_core, ready=True):
+        instance_uuid = gen_uuid()
+        return Host.objects.create(name=gen_uuid(), instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                   cpu_core=cpu_core, vnc_port=5900, mem_size_kb=1024 * 1024,
+                                   xml='<domain/>' if ready else None, spare_pool=pool_key('base.qcow2', 'linked'))
+
+    def test_claim(self):
+        self.create_spare(2, ready=False)
+        other = self.create_spare(2)
+        same = self.create_spare(4)
+        old_time = timezone.now() - datetime.timedelta(days=1)
+        Host.objects.filter(id=same.id).update(create_time=old_time)
+        claimed = claim_spare('base.qcow2', 'linked', 4, 1024 * 1024)
+        self.assertEqual(claimed.id, same.id)
+        # 领用后按新建的虚拟机排序
+        self.assertGreater(claimed.create_time, old_time)
+        self.assertEqual(claim_spare('base.qcow2', 'linked', 4, 1024 * 1024).id, other.id)
+        self.assertIsNone(claim_spare('base.qcow2', 'linked', 4, 1024 * 1024))
+        self.assertIsNone(Host.objects.get(id=same.id).spare_pool)
+
+
+@override_settings(VNC_PORT_MIN=7000, VNC_PORT_MAX=7009, VNC_PORT_CHECK_IN_USE=False, SPARE_POOL=[
+    {"base_disk_name": "base.qcow2", "clone_mode": "linked", "cpu_core": 1, "mem_size_kb": 1024 * 1024, "count": 2}])
+class SpareRefillTest(BaseTest):
+    def test_rollback_releases_port(self):
+        def enqueue_on_commit(*args):
+            raise ValueError('broker unavailable')
+
+        with replace_attr(tasks, 'enqueue_on_commit', enqueue_on_commit):
+            self.assertRaises(ValueError, tasks.refill_spare_pool)
+        self.assertFalse(Host.objects.exists())
+        self.assertFalse(VncPorts.objects.filter(allocated=True).exists())
+
+    def test_refill(self):
+        sent = []
+
+        def enqueue_on_commit(host_id, task, *args):
+            sent.append(host_id)
+            return gen_uuid()
+
+        with replace_attr(tasks, 'enqueue_on_commit', enqueue_on_commit):
+            tasks.refill_spare_pool()
+            tasks.refill_spare_pool()
+        spares = Host.objects.filter(spare_pool=pool_key('base.qcow2', 'linked'))
+        self.assertEqual(sorted(x.id for x in spares), sorted(sent))
+        self.assertEqual(VncPorts.objects.filter(allocated=True).count(), 2)
+
+
+@override_settings(LIBVIRT_URI='test:///default', VNC_PORT_CHECK_IN_USE=False, SPARE_POOL=[
+    {"base_disk_name": "base.qcow2", "clone_mode": "linked", "cpu_core": 1, "mem_size_kb": 1024 * 1024}])
+class SpareClaimViewTest(BaseTest):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        user = User.objects.create_user('tester', password='123456')
+        self.client.force_login(user)
+        # 在当前进程执行创建/定义任务, 基础镜像不存在时任务失败, 只检查是否领用了备用虚拟机
+        current_app.conf.task_always_eager = True
+        instance_uuid = gen_uuid()
+        self.spare = Host.objects.create(name='spare', instance_uuid=instance_uuid, instance_name=instance_uuid,
+                                         cpu_core=1, vnc_port=5900, mem_size_kb=1024 * 1024, xml='<domain/>',
+                                         spare_pool=pool_key('base.qcow2', 'linked'))
+
+    def tearDown(self):
+        current_app.conf.task_always_eager = False
+        shutil.rmtree(self.dir)
+
+    def create(self, **extra):
+        data = dict({"name": gen_uuid(), "cpu_core": 1, "mem_size_kb": 1024 * 1024, "base_disk_name": "base.qcow2",
+                     "clone_mode": "linked", "network_names": ["default"]}, **extra)
+        with self.settings(VM_DATA_DIR=self.dir, VM_BASE_DISKS_DIR=self.dir):
+            response = self.post('/host/host/', data)
+        self.assertEqual(response.status_code, 201)
+        return response.json()['id']
+
+    def test_claim(self):
+        self.assertEqual(self.create(), self.spare.id)
+        self.assertIsNone(Host.objects.get(id=self.spare.id).spare_pool)
+
+    def test_fallback_for_custom_disk(self):
+        for extra in ({"init_disk_size_gb": 20}, {"disk_profile": "full-falloc"}, {"iso_names": ["a.iso"]}):
+            self.assertNotEqual(self.create(**extra), self.spare.id)
+        self.assertEqual(Host.objects.get(id=self.spare.id).spare_pool, pool_key('base.qcow2', 'linked'))
+
+
+@override_settings(VNC_PORT_MIN=7000, VNC_PORT_MAX=7199, VNC_PORT_CHECK_IN_USE=False)
+class VncPortsTest(BaseTest):
+    def test_reuse_released(self):
+        with self.settings(VNC_PORT_MAX=7002):
+            ports = [new_vnc_port() for _ in range(3)]
+            self.assertEqual(sorted(ports), [7000, 7001, 7002])
+            self.assertRaises(VncPortsExhausted, new_vnc_port)
+            release_vnc_port(7001)
+            self.assertEqual(new_vnc_port(), 7001)
+
+    def test_skip_in_use(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('0.0.0.0', 0))
+        sock.listen(1)
+        port = sock.getsockname()[1]
+        with self.settings(VNC_PORT_MIN=port, VNC_PORT_MAX=port, VNC_PORT_CHECK_IN_USE=True):
+            try:
+                self.assertRaises(VncPortsExhausted, new_vnc_port)
+            finally:
+                sock.close()
+            self.assertEqual(new_vnc_port(), port)
+
+    def test_concurrent(self):
+        results = []
+        errors = []
+
+        def allocate():
+            try:
+                for _ in range(10):
+                    results.append(new_vnc_port())
+            except Exception as ex:
+                errors.append(ex)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=allocate) for _ in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 160)
+        self.assertEqual(len(set(results)), 160)
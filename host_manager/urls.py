@@ -18,16 +18,23 @@ from . import views
 
 urlpatterns = [
     url(r'^host/$', views.HostViewSet.as_list()),
+    url(r'^host/bulk/$', views.BulkHostView.as_view()),
+    url(r'^host/bulk/action/$', views.BulkHostActionView.as_view()),
+    url(r'^host/bulk/action/(?P<task_id>[\w\-]+)/$', views.BulkHostActionView.as_view()),
+    url(r'^host/bulk/(?P<batch_id>[\w\-]+)/$', views.BulkHostView.as_view()),
     url(r'^host/(?P<pk>[\w\-]+)/$', views.HostViewSet.as_detail()),
     url(r'^host/(?P<pk>[\w\-]+)/action/$', views.HostActionView.as_view()),
     url(r'^host/(?P<uuid>[\w\-]+)/xml/$', views.DomainsXmlView.as_view()),
     url(r'^host/(?P<pk>[\w\-]+)/attach_disk/$', views.AttachDiskView.as_view()),
+    url(r'^host/(?P<pk>[\w\-]+)/metrics/$', views.HostMetricsView.as_view()),
     url(r'^host/(?P<pk>[\w\-]+)/disk/(?P<disk_id>[\w\-]+)/detach/$', views.DetachDiskView.as_view()),
+    url(r'^host/(?P<pk>[\w\-]+)/disk/(?P<disk_id>[\w\-]+)/tuning/$', views.DiskTuningView.as_view()),
     url(r'^host/(?P<pk>[\w\-]+)/disk/(?P<disk_id>[\w\-]+)/save/$', views.SaveDiskView.as_view()),
     url(r'^host/(?P<host_id>[\w\-]+)/snapshot/$', views.SnapshotViewSet.as_list()),
     url(r'^host/(?P<host_id>[\w\-]+)/snapshot/(?P<pk>[\w\-]+)/$', views.SnapshotViewSet.as_detail()),
     url(r'^host/(?P<host_id>[\w\-]+)/snapshot/(?P<pk>[\w\-]+)/revert/$', views.SnapshotRevertView.as_view()),
     url(r'^overview/$', views.OverviewView.as_view()),
+    url(r'^events/$', views.EventStreamView.as_view()),
     url(r'^base_disks/$', views.BaseDisksView.as_view()),
     url(r'^networks/$', views.NetworksView.as_view()),
     url(r'^iso/$', views.IsoView.as_view()),
@@ -7,17 +7,48 @@ import uuid
 from xml.etree import ElementTree as ET
 
 import libvirt
+from celery import group, states as task_states
 from django.conf import settings
+from django.core.cache import cache
 from django.db import transaction
-from rest_framework import exceptions
+from django.db.models import Count, Max, OuterRef, Prefetch, Subquery
+from django.http import StreamingHttpResponse
+from rest_framework import exceptions, status
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from common.viewset import BaseViewSet
-from host_manager.models import Host, new_vnc_port, HostStorage, HOST_STORAGE_DEVICE_CDROM, HostSnapshot
-from host_manager.serializers import HostSerializer, SnapshotSerializer
+from common.task_results import last_task_change_time, load_task_results
+from common.utils import gen_uuid
+from common.viewset import BaseViewSet, make_etag
+from host_manager import events
+from host_manager.disks import CLONE_MODES, base_disks_in_use, check_base_disk_replaceable, check_disk_tuning
+from host_manager.host_queue import add_entry, enqueue
+from host_manager.libvirt_pool import libvirt_connection
+from host_manager.metrics import MetricSeries
+from host_manager.models import Host, HostStorage, HOST_STORAGE_DEVICE_CDROM, \
+    HOST_STORAGE_DEVICE_DISK, HostSnapshot, HostNetwork, HostMetrics, HostTask, DISK_PROFILES
+from host_manager.provision import build_networks, build_storages
+from host_manager.serializers import BulkHostSerializer, HostSerializer, SnapshotSerializer, status_map
+from host_manager.spare_pool import claim_spare
+from host_manager.stats import build_overview
+from host_manager.stream import event_stream
 from host_manager.tasks import host_action, attach_disk, detach_disk, save_disk_to_base, snapshot_revert, \
-    snapshot_delete
+    snapshot_delete, provision_hosts, bulk_host_action, define_host
+from host_manager.vnc_ports import VncPortsExhausted, new_vnc_port, new_vnc_ports
+
+
+def check_disk_profile(disk_profile):
+    if disk_profile and disk_profile not in dict(DISK_PROFILES):
+        raise exceptions.ValidationError("disk_profile应为{}".format("/".join(dict(DISK_PROFILES).keys())))
+
+
+HOST_ACTIONS = {
+    "shutdown": "关机",
+    "destroy": "强制关机",
+    "reboot": "重启",
+    "start": "开机",
+    "sync": "同步XML配置",
+}
 
 
 class HostViewSet(BaseViewSet):
@@ -26,25 +57,141 @@ class HostViewSet(BaseViewSet):
     check_unique_fields = [('name', '名称')]
 
     def create(self, request, *args, **kwargs):
+        clone_mode = self.request.data.get("clone_mode")
+        if clone_mode and clone_mode not in dict(CLONE_MODES):
+            raise exceptions.ValidationError("clone_mode应为{}".format("/".join(dict(CLONE_MODES).keys())))
+        check_disk_profile(self.request.data.get("disk_profile"))
+        # 备用虚拟机按池的配置创建系统盘, 指定了系统盘大小、硬盘配置或光盘时按常规流程创建
+        custom_disk = any(self.request.data.get(x) for x in ('init_disk_size_gb', 'disk_profile', 'iso_names'))
+        if settings.SPARE_POOL and not self.request.data.get("is_from_iso") and not custom_disk:
+            self._check_unique()
+            instance = self.claim_spare()
+            if instance:
+                return Response(self.get_serializer(instance).data, status=status.HTTP_201_CREATED)
         instance_uuid = str(uuid.uuid4())
         self.request.data['instance_uuid'] = instance_uuid
         self.request.data['instance_name'] = 'instance_' + instance_uuid
-        self.request.data['vnc_port'] = new_vnc_port()
-        return super(HostViewSet, self).create(request, *args, **kwargs)
+        # 创建失败时回滚, 端口不会被占用
+        with transaction.atomic():
+            try:
+                self.request.data['vnc_port'] = new_vnc_port()
+            except VncPortsExhausted as ex:
+                raise exceptions.ValidationError(str(ex))
+            return super(HostViewSet, self).create(request, *args, **kwargs)
+
+    def claim_spare(self):
+        """
+        领用备用虚拟机: 同一事务内改名、修改规格与网络, 提交后重新定义, 无可用的备用虚拟机时返回 None
+        """
+        data = self.request.data
+        with transaction.atomic():
+            instance = claim_spare(data.get("base_disk_name"), data.get("clone_mode"), data.get("cpu_core"),
+                                   data.get("mem_size_kb"))
+            if not instance:
+                return None
+            context = dict(self.get_serializer_context(), task_name="创建虚拟机")
+            serializer = self.get_serializer_class()(instance, data=data, partial=True, context=context)
+            serializer.is_valid(raise_exception=True)
+            return serializer.save()
 
     def perform_destroy(self, instance):
-        task = host_action.delay(instance.id, 'delete')
+        task = enqueue(instance.id, host_action, instance.id, 'delete')
         instance.last_task_id = task.id
         instance.last_task_name = "删除虚拟机"
         instance.save()
 
+    def get_list_etag(self, queryset):
+        # 不监听事件时虚拟机状态只能实时查询, 无法判断是否变化
+        if not events.is_listening():
+            return None
+        summary = queryset.aggregate(count=Count('id'), modify_time=Max('modify_time'))
+        # queue_depth 随排队记录的增删变化
+        queue = HostTask.objects.aggregate(count=Count('id'), create_time=Max('create_time'))
+        return make_etag(self.request.get_full_path(), summary['count'], summary['modify_time'],
+                         last_task_change_time(queryset.values('last_task_id')), events.get_state_generation(),
+                         queue['count'], queue['create_time'])
+
     def get_queryset(self):
-        return Host.objects.filter(is_delete=False)
+        return Host.objects.filter(is_delete=False, spare_pool__isnull=True).annotate(
+            queue_depth=Count('hosttask', distinct=True)
+        ).prefetch_related(
+            Prefetch('hoststorage_set', queryset=HostStorage.objects.filter(is_delete=False)),
+            Prefetch('hostnetwork_set', queryset=HostNetwork.objects.filter(is_delete=False)),
+        )
+
+
+class BulkHostView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        批量创建虚拟机: 一个事务内写入所有记录, 再分成 parallelism 路并行创建磁盘
+        """
+        serializer = BulkHostSerializer(data=self.request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        batch_id = gen_uuid()
+        hosts = []
+        storages = []
+        networks = []
+        with transaction.atomic():
+            try:
+                vnc_ports = new_vnc_ports(data['count'])
+            except VncPortsExhausted as ex:
+                raise exceptions.ValidationError(str(ex))
+            for name, vnc_port in zip(data['names'], vnc_ports):
+                instance_uuid = str(uuid.uuid4())
+                host = Host(name=name, desc=data.get('desc'), cpu_core=data['cpu_core'],
+                            mem_size_kb=data['mem_size_kb'], vnc_port=vnc_port, instance_uuid=instance_uuid,
+                            instance_name='instance_' + instance_uuid, last_task_id=gen_uuid(),
+                            last_task_name="创建虚拟机", batch_id=batch_id)
+                hosts.append(host)
+                storages.extend(build_storages(host, data['is_from_iso'], data.get('base_disk_name'),
+                                               data['iso_names'], data.get('clone_mode'), data.get('disk_profile')))
+                networks.extend(build_networks(host, data['network_names']))
+            Host.objects.bulk_create(hosts)
+            HostStorage.objects.bulk_create(storages)
+            HostNetwork.objects.bulk_create(networks)
+
+            host_ids = [x.id for x in hosts]
+            lanes = [host_ids[i::data['parallelism']] for i in range(data['parallelism'])]
+            job = group(provision_hosts.si(lane, data['is_from_iso'], data.get('base_disk_name'),
+                                           data.get('init_disk_size_gb')) for lane in lanes)
+            transaction.on_commit(job.apply_async)
+        return Response(data={
+            "batch_id": batch_id,
+            "host_ids": host_ids,
+        })
+
+    def get(self, request, *args, **kwargs):
+        """
+        批量创建的整体进度
+        """
+        hosts = list(Host.objects.filter(batch_id=self.kwargs.get("batch_id")).values_list(
+            'id', 'name', 'last_task_id'))
+        if not hosts:
+            raise exceptions.NotFound()
+        task_results = load_task_results([x[2] for x in hosts])
+        states = {}
+        items = []
+        for host_id, name, last_task_id in hosts:
+            result = task_results[last_task_id]
+            states[result['state']] = states.get(result['state'], 0) + 1
+            item = {"id": host_id, "name": name, "state": result['state']}
+            if result['state'] == task_states.FAILURE:
+                item['result'] = str(result['result'])
+            items.append(item)
+        finished = states.get(task_states.SUCCESS, 0) + states.get(task_states.FAILURE, 0)
+        return Response(data={
+            "batch_id": self.kwargs.get("batch_id"),
+            "total": len(hosts),
+            "finished": finished,
+            "states": states,
+            "hosts": items,
+        })
 
 
 class DomainsXmlView(APIView):
     def get(self, request, *args, **kwargs):
-        with libvirt.open(settings.LIBVIRT_URI) as conn:
+        with libvirt_connection() as conn:
             uuid = self.kwargs.get("uuid")
             try:
                 domain = conn.lookupByUUIDString(uuid)
@@ -55,7 +202,7 @@ class DomainsXmlView(APIView):
 
     def put(self, request, *args, **kwargs):
         xml = self.request.data.get("xml")
-        with libvirt.open(settings.LIBVIRT_URI) as conn:
+        with libvirt_connection() as conn:
             uuid = self.kwargs.get("uuid")
             vm_root = ET.fromstring(xml)
             new_uuid = vm_root.find('./uuid').text
@@ -75,42 +222,113 @@ class HostActionView(APIView):
         instance = Host.objects.filter(id=pk).first()
         if not instance:
             raise exceptions.NotFound()
-        action_map = {
-            "shutdown": "关机",
-            "destroy": "强制关机",
-            "reboot": "重启",
-            "start": "开机",
-            "sync": "同步XML配置",
-        }
-        task = host_action.delay(pk, action)
+        task = enqueue(pk, host_action, pk, action)
         instance.last_task_id = task.id
-        instance.last_task_name = action_map[action]
+        instance.last_task_name = HOST_ACTIONS[action]
         instance.save()
         return Response()
 
 
+class BulkHostActionView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        批量执行操作, 对象为 host_ids, 或按 batch_id/search(名称) 过滤的虚拟机
+        max_in_flight 为同时执行的数量(不超过 BULK_ACTION_MAX_IN_FLIGHT_LIMIT), delay 为相邻两台开始执行的间隔秒数
+        """
+        data = self.request.data
+        action = data.get("action")
+        if action not in HOST_ACTIONS:
+            raise exceptions.ValidationError("action应为{}".format("/".join(HOST_ACTIONS.keys())))
+        try:
+            max_in_flight = int(data.get("max_in_flight") or settings.BULK_ACTION_MAX_IN_FLIGHT)
+            delay = float(data.get("delay") or 0)
+        except (TypeError, ValueError):
+            raise exceptions.ValidationError("max_in_flight/delay应为数字")
+        if max_in_flight < 1 or delay < 0:
+            raise exceptions.ValidationError("max_in_flight应大于0, delay不能小于0")
+        max_in_flight = min(max_in_flight, settings.BULK_ACTION_MAX_IN_FLIGHT_LIMIT)
+        queryset = Host.objects.filter(is_delete=False, spare_pool__isnull=True)
+        if data.get("host_ids"):
+            queryset = queryset.filter(id__in=data.get("host_ids"))
+        elif data.get("batch_id"):
+            queryset = queryset.filter(batch_id=data.get("batch_id"))
+        elif data.get("search"):
+            queryset = queryset.filter(name__icontains=data.get("search"))
+        else:
+            raise exceptions.ValidationError("需要 host_ids、batch_id 或 search")
+        host_tasks = [(x, gen_uuid()) for x in queryset.values_list('id', flat=True)]
+        if not host_tasks:
+            raise exceptions.ValidationError("没有匹配的虚拟机")
+        with transaction.atomic():
+            for host_id, task_id in host_tasks:
+                Host.objects.filter(id=host_id).update(last_task_id=task_id, last_task_name=HOST_ACTIONS[action])
+                add_entry(host_id, task_id, bulk_host_action.name)
+        task = bulk_host_action.delay(host_tasks, action, min(max_in_flight, len(host_tasks)), delay)
+        return Response(data={
+            "task_id": task.id,
+            "host_ids": [x[0] for x in host_tasks],
+        })
+
+    def get(self, request, *args, **kwargs):
+        """
+        批量操作的进度及每台虚拟机的结果
+        """
+        task_id = self.kwargs.get("task_id")
+        result = load_task_results([task_id])[task_id]
+        data = {"task_id": task_id, "state": result['state']}
+        if result['state'] == task_states.FAILURE:
+            data['result'] = str(result['result'])
+        else:
+            data['result'] = result['result']
+        return Response(data=data)
+
+
 class OverviewView(APIView):
+    cache_key = 'host_overview'
+
     def get(self, request, *args, **kwargs):
-        vm_count = 0
-        total_cpu = 0
-        total_mem = 0
-        vm_running_count = 0
-        with libvirt.open(settings.LIBVIRT_URI) as conn:
-            domains = conn.listAllDomains()
-            for domain in domains:
-                vm_count += 1
-                info = domain.info()
-                if info[0] == 1:
-                    vm_running_count += 1
-                total_cpu += info[3]
-                total_mem += info[1]
+        data = cache.get(self.cache_key)
+        if data is None:
+            # 事件监听运行时状态直接读缓存
+            load_states = events.get_domain_states if events.is_listening() else None
+            with libvirt_connection() as conn:
+                data = build_overview(conn, status_map, load_states)
+            # 仪表盘每隔几秒轮询一次, 短时间内直接返回缓存结果
+            cache.set(self.cache_key, data, settings.OVERVIEW_CACHE_TTL)
+        return Response(data=data)
+
+
+class HostMetricsView(APIView):
+    def get(self, request, *args, **kwargs):
+        pk = self.kwargs.get("pk")
+        if not Host.objects.filter(id=pk, is_delete=False).exists():
+            raise exceptions.NotFound()
+        try:
+            since = self.request.query_params.get("since")
+            since = float(since) if since else None
+            step = self.request.query_params.get("step")
+            step = float(step) if step else None
+        except ValueError:
+            raise exceptions.ValidationError("since/step应为数字")
+        instance = HostMetrics.objects.filter(host_id=pk).first() or HostMetrics(host_id=pk)
+        return Response(data=MetricSeries(instance).series(since, step))
 
-        return Response(data={
-            "vm_count": vm_count,
-            "total_cpu": total_cpu,
-            "total_mem": total_mem,
-            "vm_running_count": vm_running_count,
-        })
+
+class EventStreamView(APIView):
+    def get(self, request, *args, **kwargs):
+        """
+        SSE 推送任务与虚拟机状态变化, 每个连接在 EVENT_STREAM_TIMEOUT 内一直占用一个 worker,
+        需以 gevent 等异步 worker 部署(如 gunicorn -k gevent), 同步 worker 会被连接数耗尽
+        没有运行 run_event_listener 时返回 503, 客户端应改为轮询列表接口
+        """
+        if not events.is_listening():
+            return Response(data={"detail": "事件监听未运行, 请轮询列表接口"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        task_ids = self.request.query_params.get("task_ids")
+        task_ids = [x for x in task_ids.split(",") if x] if task_ids else None
+        response = StreamingHttpResponse(event_stream(status_map, task_ids), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 class BaseDisksView(APIView):
@@ -118,21 +336,39 @@ class BaseDisksView(APIView):
         path = settings.VM_BASE_DISKS_DIR
 
         files = []
+        in_use = []
+        used_paths = base_disks_in_use()
 
         for n in os.listdir(path):
             if os.path.isfile(os.path.join(path, n)):
                 files.append(n)
+                if os.path.join(path, n) in used_paths:
+                    in_use.append(n)
 
         return Response(data={
-            "files": files
+            "files": files,
+            "in_use": in_use,
         })
 
+    def delete(self, request, *args, **kwargs):
+        name = self.request.data.get("name")
+        if not name or os.path.basename(name) != name:
+            raise exceptions.ValidationError("name无效")
+        path = os.path.join(settings.VM_BASE_DISKS_DIR, name)
+        if not os.path.isfile(path):
+            raise exceptions.NotFound()
+        error = check_base_disk_replaceable(path)
+        if error:
+            raise exceptions.ValidationError(error)
+        os.remove(path)
+        return Response()
+
 
 class NetworksView(APIView):
     def get(self, request, *args, **kwargs):
         results = []
 
-        with libvirt.open(settings.LIBVIRT_URI) as conn:
+        with libvirt_connection() as conn:
             for net in conn.listAllNetworks():
                 results.append(net.name())
 
@@ -205,7 +441,15 @@ class AttachDiskView(APIView):
             raise exceptions.ValidationError("size应为数字")
         if size < 0:
             raise exceptions.ValidationError("size应为大于0的数字")
-        task = attach_disk.delay(pk, size)
+        disk_profile = self.request.data.get("disk_profile")
+        check_disk_profile(disk_profile)
+        iothread = bool(self.request.data.get("iothread"))
+        if iothread:
+            with libvirt_connection() as conn:
+                error = check_disk_tuning(conn, 'virtio', None, None, None, iothread)
+            if error:
+                raise exceptions.ValidationError(error)
+        task = enqueue(pk, attach_disk, pk, size, disk_profile, iothread)
         instance.last_task_id = task.id
         instance.last_task_name = '挂载磁盘'
         instance.save()
@@ -213,6 +457,39 @@ class AttachDiskView(APIView):
         return Response()
 
 
+class DiskTuningView(APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        修改硬盘的 cache/io/discard/iothread, 重新定义虚拟机, 运行中的虚拟机在下次启动后生效
+        """
+        pk = self.kwargs.get("pk")
+        disk_id = self.kwargs.get("disk_id")
+        host = Host.objects.filter(id=pk, is_delete=False).first()
+        if not host:
+            raise exceptions.NotFound("not found host")
+        disk = HostStorage.objects.filter(host_id=pk, id=disk_id, is_delete=False).first()
+        if not disk:
+            raise exceptions.NotFound("not found disk")
+        if disk.device != HOST_STORAGE_DEVICE_DISK:
+            raise exceptions.ValidationError("只能修改硬盘")
+        data = self.request.data
+        for name in ('cache', 'io', 'discard'):
+            if name in data:
+                setattr(disk, name, data.get(name) or None)
+        if 'iothread' in data:
+            disk.iothread = bool(data.get('iothread'))
+        with libvirt_connection() as conn:
+            error = check_disk_tuning(conn, disk.bus, disk.cache, disk.io, disk.discard, disk.iothread)
+        if error:
+            raise exceptions.ValidationError(error)
+        disk.save()
+        task = enqueue(pk, define_host, pk)
+        host.last_task_id = task.id
+        host.last_task_name = '修改硬盘配置'
+        host.save()
+        return Response()
+
+
 class DetachDiskView(APIView):
     def post(self, request, *args, **kwargs):
         pk = self.kwargs.get("pk")
@@ -223,7 +500,7 @@ class DetachDiskView(APIView):
         disk = HostStorage.objects.filter(host_id=pk, id=disk_id).first()
         if not disk:
             raise exceptions.NotFound("not found disk")
-        task = detach_disk.delay(pk, disk_id)
+        task = enqueue(pk, detach_disk, pk, disk_id)
         host.last_task_id = task.id
         host.last_task_name = '解挂存储'
         host.save()
@@ -243,7 +520,8 @@ class SaveDiskView(APIView):
             raise exceptions.NotFound("not found disk")
         if disk.device == HOST_STORAGE_DEVICE_CDROM:
             raise exceptions.ValidationError("光盘无须保存")
-        task = save_disk_to_base.delay(pk, disk_id, name)
+        compress = bool(self.request.data.get("compress"))
+        task = enqueue(pk, save_disk_to_base, pk, disk_id, name, compress)
         host.last_task_id = task.id
         host.last_task_name = '保存硬盘'
         host.save()
@@ -261,7 +539,7 @@ class SnapshotViewSet(BaseViewSet):
         return super(SnapshotViewSet, self).create(request, *args, **kwargs)
 
     def perform_destroy(self, instance):
-        task = snapshot_delete.delay(instance.id)
+        task = enqueue(instance.host_id, snapshot_delete, instance.id)
         host_instance = Host.objects.filter(id=instance.host_id).first()
         host_instance.last_task_id = task.id
         host_instance.last_task_name = "删除快照"
@@ -270,9 +548,17 @@ class SnapshotViewSet(BaseViewSet):
         instance.last_task_name = "删除快照"
         instance.save()
 
+    def get_list_etag(self, queryset):
+        summary = queryset.aggregate(count=Count('id'), modify_time=Max('modify_time'))
+        return make_etag(self.request.get_full_path(), summary['count'], summary['modify_time'],
+                         last_task_change_time(queryset.values('last_task_id')))
+
     def get_queryset(self):
         host_id = self.kwargs.get("host_id")
-        return HostSnapshot.objects.filter(is_delete=False, host_id=host_id)
+        parents = HostSnapshot.objects.filter(is_delete=False, host_id=OuterRef('host_id'),
+                                              instance_name=OuterRef('parent_instance_name'))
+        return HostSnapshot.objects.filter(is_delete=False, host_id=host_id).annotate(
+            parent_name=Subquery(parents.values('name')[:1]))
 
 
 class SnapshotRevertView(APIView):
@@ -286,7 +572,7 @@ class SnapshotRevertView(APIView):
             raise exceptions.NotFound('not found snap')
 
         def callback():
-            task = snapshot_revert.delay(pk)
+            task = enqueue(host_id, snapshot_revert, pk)
             host_instance = Host.objects.filter(id=host_id).first()
             host_instance.last_task_id = task.id
             host_instance.last_task_name = "恢复快照"
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+import socket
+
+import django
+from django.conf import settings
+from django.db import transaction
+
+from host_manager.models import VncPorts
+
+# 每次从最小的若干个空闲端口中随机选择, 并发分配时不会都去抢同一个端口
+CLAIM_WINDOW = 32
+
+
+class VncPortsExhausted(Exception):
+    pass
+
+
+def port_in_use(port):
+    """
+    本机是否已有进程监听该端口(VNC 监听 0.0.0.0)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(('0.0.0.0', port))
+        return False
+    except socket.error:
+        return True
+    finally:
+        sock.close()
+
+
+def ensure_vnc_ports():
+    """
+    为 VNC_PORT_MIN ~ VNC_PORT_MAX 中还没有记录的端口写入空闲记录
+    """
+    existing = set(VncPorts.objects.filter(
+        value__gte=settings.VNC_PORT_MIN, value__lte=settings.VNC_PORT_MAX).values_list('value', flat=True))
+    missing = [VncPorts(value=x) for x in range(settings.VNC_PORT_MIN, settings.VNC_PORT_MAX + 1)
+               if x not in existing]
+    try:
+        # 单独的保存点, 冲突时不影响外层事务
+        with transaction.atomic():
+            VncPorts.objects.bulk_create(missing)
+    except django.db.IntegrityError:
+        # 其它进程同时写入, 逐个补齐
+        for port in missing:
+            VncPorts.objects.get_or_create(value=port.value)
+
+
+def claim_vnc_port():
+    """
+    :return: 领用到的端口, 没有空闲端口时返回 None
+    """
+    free = VncPorts.objects.filter(
+        allocated=False, value__gte=settings.VNC_PORT_MIN, value__lte=settings.VNC_PORT_MAX).order_by('value')
+    busy = set()
+    while True:
+        candidates = list(free.exclude(value__in=busy).values_list('value', flat=True)[:CLAIM_WINDOW])
+        if not candidates:
+            return None
+        random.shuffle(candidates)
+        for port in candidates:
+            # 带条件的 update 即领用, 返回 0 表示已被其它请求领走
+            if not VncPorts.objects.filter(value=port, allocated=False).update(allocated=True):
+                continue
+            if settings.VNC_PORT_CHECK_IN_USE and port_in_use(port):
+                # 被其它程序占用, 放回空闲列表, 本次不再选择
+                release_vnc_port(port)
+                busy.add(port)
+                continue
+            return port
+
+
+def new_vnc_port():
+    """
+    在 VNC_PORT_MIN ~ VNC_PORT_MAX 中分配一个端口, 优先复用已释放的端口
+    """
+    port = claim_vnc_port()
+    if port is None:
+        ensure_vnc_ports()
+        port = claim_vnc_port()
+    if port is None:
+        raise VncPortsExhausted("没有空闲的VNC端口({}-{})".format(settings.VNC_PORT_MIN, settings.VNC_PORT_MAX))
+    return port
+
+
+def new_vnc_ports(count):
+    """
+    分配 count 个端口, 不足时释放已分配的并抛出 VncPortsExhausted
+    """
+    ports = []
+    try:
+        for _ in range(count):
+            ports.append(new_vnc_port())
+    except VncPortsExhausted:
+        release_vnc_ports(ports)
+        raise
+    return ports
+
+
+def release_vnc_port(port):
+    VncPorts.objects.filter(value=port).update(allocated=False)
+
+
+def release_vnc_ports(ports):
+    VncPorts.objects.filter(value__in=ports).update(allocated=False)
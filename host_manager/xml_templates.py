@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+from xml.etree import ElementTree as ET
+
+from django.conf import settings
+
+from host_manager.models import HOST_STORAGE_DEVICE_DISK, HOST_STORAGE_DEVICE_CDROM, CPU_MODE_HOST_PASSTHROUGH, \
+    CPU_MODE_HOST_MODEL, CPU_MODE_CUSTOM, CPU_MODE_BASELINE
+
+TEMPLATE_DIR = 'assets/xml_templete'
+
+STORAGE_TEMPLATES = {
+    HOST_STORAGE_DEVICE_DISK: 'storage/disk.xml',
+    HOST_STORAGE_DEVICE_CDROM: 'storage/cdrom.xml',
+}
+
+_templates = {}
+
+
+def clone_element(element):
+    """
+    复制元素树, 比 copy.deepcopy 和重新解析 XML 都快得多
+    """
+    new_element = element.makeelement(element.tag, dict(element.attrib))
+    new_element.text = element.text
+    new_element.tail = element.tail
+    for child in element:
+        new_element.append(clone_element(child))
+    return new_element
+
+
+def get_template(name):
+    """
+    返回模板的新副本, 每个进程只读取并解析一次模板文件
+    :param name: 相对 assets/xml_templete 的路径, 如 'storage/disk.xml'
+    :return:
+    """
+    root = _templates.get(name)
+    if root is None:
+        with open(os.path.join(settings.BASE_DIR, TEMPLATE_DIR, name), 'r') as f:
+            root = ET.fromstring(f.read())
+        _templates[name] = root
+    return clone_element(root)
+
+
+def build_storage_element(storage, iothread_id=None):
+    """
+    :param iothread_id: 分配给该硬盘的 IOThread 编号
+    """
+    disk_root = get_template(STORAGE_TEMPLATES[storage.device])
+    disk_root.find("./source").attrib['file'] = storage.path
+    disk_root.find("./target").attrib['dev'] = storage.dev
+    disk_root.find("./target").attrib['bus'] = storage.bus
+    driver = disk_root.find("./driver")
+    if driver is not None:
+        for name in ('cache', 'io', 'discard'):
+            value = getattr(storage, name, None)
+            if value:
+                driver.attrib[name] = value
+        if iothread_id:
+            driver.attrib['iothread'] = str(iothread_id)
+    return disk_root
+
+
+def build_network_element(network):
+    network_root = get_template('network.xml')
+    network_root.find("./mac").attrib['address'] = network.mac
+    network_root.find("./source").attrib['network'] = network.network_name
+    return network_root
+
+
+def render_storage_xml(storage, iothread_id=None):
+    return ET.tostring(build_storage_element(storage, iothread_id))
+
+
+def assign_iothreads(storages):
+    """
+    为需要独立 IOThread 的硬盘按顺序分配编号, 从 1 开始
+    :return: {dev: iothread_id}
+    """
+    iothreads = {}
+    for storage in storages:
+        if storage.device == HOST_STORAGE_DEVICE_DISK and storage.iothread:
+            iothreads[storage.dev] = len(iothreads) + 1
+    return iothreads
+
+
+def build_cputune_element(host_root, placement):
+    """
+    每个 vCPU 绑定一个 pCPU, 模拟器线程绑定在同一组 pCPU 上, 内存只从分配的 NUMA 节点申请
+    """
+    cputune = host_root.makeelement('cputune', {})
+    for vcpu, cpu in enumerate(placement.cpus):
+        ET.SubElement(cputune, 'vcpupin', {'vcpu': str(vcpu), 'cpuset': str(cpu)})
+    ET.SubElement(cputune, 'emulatorpin', {'cpuset': placement.cpuset})
+    numatune = host_root.makeelement('numatune', {})
+    mode = 'strict' if len(placement.nodes) == 1 else 'interleave'
+    ET.SubElement(numatune, 'memory', {'mode': mode, 'nodeset': placement.nodeset})
+    return cputune, numatune
+
+
+def build_cpu_element(mode, model=None, baseline_xml=None):
+    """
+    :param mode: legacy 以外的 CPU 模式, legacy 直接使用 host.xml 模板中的配置
+    :param baseline_xml: baseline 模式下 baselineCPU 的结果
+    """
+    if mode == CPU_MODE_HOST_PASSTHROUGH:
+        return ET.Element('cpu', {'mode': 'host-passthrough', 'check': 'none'})
+    if mode == CPU_MODE_HOST_MODEL:
+        return ET.Element('cpu', {'mode': 'host-model', 'check': 'partial'})
+    if mode == CPU_MODE_CUSTOM:
+        cpu = ET.Element('cpu', {'mode': 'custom', 'match': 'exact', 'check': 'partial'})
+        ET.SubElement(cpu, 'model', {'fallback': 'forbid'}).text = model
+        return cpu
+    if mode == CPU_MODE_BASELINE:
+        cpu = ET.fromstring(baseline_xml)
+        cpu.attrib['check'] = 'partial'
+        return cpu
+    raise ValueError(mode)
+
+
+def render_domain_xml(host, storages, networks, placement=None, cpu=None):
+    """
+    生成虚拟机 XML, 不访问数据库和 libvirt
+    :param host: Host
+    :param storages: 未删除的 HostStorage 列表
+    :param networks: 未删除的 HostNetwork 列表
+    :param placement: host_manager.numa.Placement, 为空时不绑定 pCPU
+    :param cpu: build_cpu_element 生成的 <cpu> 元素, 为空时使用模板中的兼容配置
+    :return:
+    """
+    host_root = get_template('host.xml')
+    host_root.find("./uuid").text = host.instance_uuid
+    host_root.find("./name").text = host.instance_name
+    host_root.find("./memory").attrib['unit'] = 'KiB'
+    host_root.find("./memory").text = str(host.mem_size_kb)
+    host_root.find("./currentMemory").attrib['unit'] = 'KiB'
+    host_root.find("./currentMemory").text = str(host.mem_size_kb)
+    host_root.find("./vcpu").text = str(host.cpu_core)
+    host_root.find("./devices/graphics").attrib['port'] = str(host.vnc_port)
+    if cpu is not None:
+        template_cpu = host_root.find("./cpu")
+        cpu.tail = template_cpu.tail
+        host_root.insert(list(host_root).index(template_cpu), cpu)
+        host_root.remove(template_cpu)
+    iothreads = assign_iothreads(storages)
+    if iothreads:
+        iothreads_element = host_root.makeelement('iothreads', {})
+        iothreads_element.text = str(len(iothreads))
+        iothreads_element.tail = host_root.find("./vcpu").tail
+        host_root.insert(list(host_root).index(host_root.find("./vcpu")) + 1, iothreads_element)
+    if host.hugepage_size_kb:
+        memory_backing = ET.Element('memoryBacking')
+        hugepages = ET.SubElement(memory_backing, 'hugepages')
+        # page 的 nodeset 指的是虚拟机内的 NUMA 节点, 宿主机节点由 numatune 绑定, 这里不指定
+        ET.SubElement(hugepages, 'page', {'size': str(host.hugepage_size_kb), 'unit': 'KiB'})
+        memory_backing.tail = host_root.find("./currentMemory").tail
+        host_root.insert(list(host_root).index(host_root.find("./currentMemory")) + 1, memory_backing)
+    if placement:
+        index = list(host_root).index(host_root.find("./vcpu")) + 1
+        for element in build_cputune_element(host_root, placement):
+            element.tail = host_root.find("./vcpu").tail
+            host_root.insert(index, element)
+            index += 1
+    devices = host_root.find("./devices")
+    for storage in storages:
+        if storage.device in STORAGE_TEMPLATES:
+            devices.append(build_storage_element(storage, iothreads.get(storage.dev)))
+    for network in networks:
+        devices.append(build_network_element(network))
+    return ET.tostring(host_root)
+
+
+def render_snapshot_xml(snapshot_obj, storages, with_memory):
+    """
+    :param storages: 需要做快照的硬盘
+    :param with_memory: 是否同时保存内存(虚拟机运行中)
+    :return:
+    """
+    snapshot_root = get_template('snapshot/snapshot.xml')
+    snapshot_root.find("./memory").attrib['snapshot'] = 'internal' if with_memory else 'no'
+    snapshot_root.find("./name").text = snapshot_obj.instance_name
+    snapshot_root.find("./description").text = snapshot_obj.desc
+    disks = snapshot_root.find("./disks")
+    for storage in storages:
+        disk_root = get_template('snapshot/disk.xml')
+        disk_root.attrib['name'] = storage.dev
+        disks.append(disk_root)
+    return ET.tostring(snapshot_root)
+
+
+def render_export_snapshot_xml(name, storages, storage, overlay_path):
+    """
+    只为 storage 创建外部磁盘快照(写入转到 overlay_path), 其它硬盘不做快照
+    :param storages: 虚拟机所有未删除的硬盘
+    :return:
+    """
+    snapshot_root = get_template('snapshot/snapshot.xml')
+    snapshot_root.find("./name").text = name
+    snapshot_root.find("./description").text = name
+    disks = snapshot_root.find("./disks")
+    for item in storages:
+        disk_root = get_template('snapshot/disk.xml')
+        disk_root.attrib['name'] = item.dev
+        if item.dev == storage.dev:
+            disk_root.attrib['snapshot'] = 'external'
+            ET.SubElement(disk_root, 'source', {'file': overlay_path})
+        else:
+            disk_root.attrib['snapshot'] = 'no'
+        disks.append(disk_root)
+    return ET.tostring(snapshot_root)
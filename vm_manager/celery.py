@@ -1,6 +1,9 @@
+# -*- coding: utf-8 -*-
 from __future__ import absolute_import, unicode_literals
 import os
+
 from celery import Celery
+from kombu import Queue
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'vm_manager.settings')
@@ -13,6 +16,67 @@ app = Celery('vm_manager')
 #   should have a `CELERY_` prefix.
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+# 长时间的磁盘复制/导出与开关机等交互操作分开排队, 各自启动 worker, 例如:
+#   celery -A vm_manager worker -Q interactive,celery -c 8
+#   celery -A vm_manager worker -Q bulk-io -c 2
+# 只启动一个 worker 时需用 -Q interactive,bulk-io,celery 同时消费
+DEFAULT_QUEUE = 'celery'
+INTERACTIVE_QUEUE = 'interactive'
+BULK_IO_QUEUE = 'bulk-io'
+MAX_PRIORITY = 9
+
+INTERACTIVE_TASKS = (
+    'host_manager.tasks.define_host',
+    'host_manager.tasks.host_action',
+    'host_manager.tasks.attach_disk',
+    'host_manager.tasks.detach_disk',
+    'host_manager.tasks.snapshot_create',
+    'host_manager.tasks.snapshot_revert',
+    'host_manager.tasks.snapshot_delete',
+)
+BULK_IO_TASKS = (
+    'host_manager.tasks.save_disk_to_base',
+    'host_manager.tasks.provision_hosts',
+    'host_manager.tasks.bulk_host_action',
+)
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    交互操作进入 interactive 队列并使用高优先级, 磁盘复制类任务进入 bulk-io 队列
+    链接克隆创建虚拟机只需几秒, 按交互操作处理
+    """
+    if name == 'host_manager.tasks.create_host':
+        from django.conf import settings
+        from host_manager.disks import CLONE_MODE_LINKED
+        clone_mode = (args[6] if len(args) > 6 else kwargs.get('clone_mode')) or settings.DEFAULT_CLONE_MODE
+        is_from_iso = args[1] if len(args) > 1 else kwargs.get('is_from_iso')
+        if is_from_iso or clone_mode == CLONE_MODE_LINKED:
+            return {'queue': INTERACTIVE_QUEUE, 'priority': MAX_PRIORITY}
+        return {'queue': BULK_IO_QUEUE, 'priority': 0}
+    if name in INTERACTIVE_TASKS:
+        return {'queue': INTERACTIVE_QUEUE, 'priority': MAX_PRIORITY}
+    if name in BULK_IO_TASKS:
+        return {'queue': BULK_IO_QUEUE, 'priority': 0}
+    return None
+
+
+app.conf.task_queues = [
+    Queue(DEFAULT_QUEUE),
+    Queue(INTERACTIVE_QUEUE, queue_arguments={'x-max-priority': MAX_PRIORITY}),
+    Queue(BULK_IO_QUEUE, queue_arguments={'x-max-priority': MAX_PRIORITY}),
+]
+app.conf.task_default_queue = DEFAULT_QUEUE
+app.conf.task_routes = (route_task,)
+app.conf.task_queue_max_priority = MAX_PRIORITY
+# 每个 worker 进程只预取一个任务, 否则高优先级任务会排在已预取的长任务之后
+app.conf.worker_prefetch_multiplier = 1
+# redis 作为 broker 时按优先级分成多个列表
+app.conf.broker_transport_options = {
+    'priority_steps': list(range(MAX_PRIORITY + 1)),
+    'queue_order_strategy': 'priority',
+}
+
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
 
@@ -97,6 +97,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(VM_DB_DIR, 'db.sqlite3'),
+        # 测试库使用文件而不是内存, 多线程的测试可以各自连接
+        'TEST': {'NAME': os.path.join(VM_DB_DIR, 'test_db.sqlite3')},
     }
 }
 
@@ -152,10 +154,73 @@ REST_FRAMEWORK = {
 # **********************************************************
 CELERY_RESULT_BACKEND = 'django-db'
 CELERY_CACHE_BACKEND = 'django-cache'
+# 资源监控采集间隔(秒), 定时任务与 collect_metrics 判断断点共用
+METRICS_INTERVAL = int(os.environ.get("METRICS_INTERVAL") or 10)
+CELERY_BEAT_SCHEDULE = {
+    'collect-host-metrics': {
+        'task': 'host_manager.tasks.collect_metrics',
+        'schedule': METRICS_INTERVAL,
+    },
+    'refill-spare-pool': {
+        'task': 'host_manager.tasks.refill_spare_pool',
+        'schedule': int(os.environ.get("SPARE_POOL_INTERVAL") or 60),
+    },
+}
 # **********************************************************
 # **                   Customer Config                    **
 # **********************************************************
 LIBVIRT_URI = os.environ.get("LIBVIRT_URI") or 'qemu:///system'
+# 从基础镜像创建虚拟机时默认的磁盘方式: linked 链接克隆(qcow2 backing file), full 完整复制
+DEFAULT_CLONE_MODE = os.environ.get("DEFAULT_CLONE_MODE") or 'full'
+# 新建空白硬盘的默认配置: thin/metadata-prealloc/full-falloc/large-cluster, 见 host_manager.disks
+DEFAULT_DISK_PROFILE = os.environ.get("DEFAULT_DISK_PROFILE") or 'thin'
+# 运行中导出硬盘时等待 overlay 合并回原硬盘的最长秒数
+BLOCK_COMMIT_TIMEOUT = int(os.environ.get("BLOCK_COMMIT_TIMEOUT") or 600)
+# 批量创建虚拟机时单次最大数量, 以及同时执行创建的任务数上限
+BULK_CREATE_MAX_COUNT = int(os.environ.get("BULK_CREATE_MAX_COUNT") or 100)
+BULK_CREATE_PARALLELISM = int(os.environ.get("BULK_CREATE_PARALLELISM") or 4)
+# 批量开关机时默认同时执行的数量, 以及请求中 max_in_flight 的上限
+BULK_ACTION_MAX_IN_FLIGHT = int(os.environ.get("BULK_ACTION_MAX_IN_FLIGHT") or 5)
+BULK_ACTION_MAX_IN_FLIGHT_LIMIT = int(os.environ.get("BULK_ACTION_MAX_IN_FLIGHT_LIMIT") or 20)
+# 同一台虚拟机的任务排队执行: 未轮到时的重试间隔秒数, 以及从未开始执行的排队记录的最长有效秒数(防止丢失的消息一直阻塞队列)
+HOST_QUEUE_RETRY_DELAY = float(os.environ.get("HOST_QUEUE_RETRY_DELAY") or 1)
+HOST_QUEUE_ENTRY_TIMEOUT = int(os.environ.get("HOST_QUEUE_ENTRY_TIMEOUT") or 6 * 3600)
+# 执行中任务的心跳间隔秒数, 心跳超时后认为 worker 已异常退出, 清除其排队记录
+HOST_QUEUE_HEARTBEAT_INTERVAL = int(os.environ.get("HOST_QUEUE_HEARTBEAT_INTERVAL") or 10)
+HOST_QUEUE_HEARTBEAT_TIMEOUT = int(os.environ.get("HOST_QUEUE_HEARTBEAT_TIMEOUT") or 60)
+# qemu-img 命令的默认超时秒数(convert 不限制), 以及批量创建链接克隆/空白硬盘时每路的并发数(完整复制不并发)
+QEMU_IMG_TIMEOUT = int(os.environ.get("QEMU_IMG_TIMEOUT") or 600)
+QEMU_IMG_BATCH_WORKERS = int(os.environ.get("QEMU_IMG_BATCH_WORKERS") or 8)
+# 定义虚拟机时按 NUMA 拓扑为每台虚拟机分配独占的 pCPU 并绑定(vcpupin/emulatorpin/numatune)
+NUMA_PLACEMENT_ENABLED = os.environ.get("NUMA_PLACEMENT_ENABLED") == '1'
+# 虚拟机未指定时的 CPU 模式: legacy(原 IvyBridge 配置)/host-passthrough/host-model/custom/baseline
+DEFAULT_CPU_MODE = os.environ.get("DEFAULT_CPU_MODE") or 'legacy'
+# baseline 模式计算公共 CPU 型号的节点, 逗号分隔的 libvirt URI, 为空时只使用 LIBVIRT_URI
+CPU_BASELINE_URIS = [x for x in (os.environ.get("CPU_BASELINE_URIS") or '').split(',') if x]
+# 备用虚拟机池: 预先创建并定义好(不开机)的虚拟机, 从基础镜像创建虚拟机时直接领用, 在 config.yml 中配置, 如
+#   SPARE_POOL:
+#     - {base_disk_name: centos7.qcow2, count: 5, cpu_core: 2, mem_size_kb: 4194304, network_names: [default]}
+# clone_mode 可省略, 默认为 DEFAULT_CLONE_MODE
+SPARE_POOL = []
+# 备用虚拟机超过该秒数仍未定义成功时视为创建失败, 删除后重新补充
+SPARE_BUILD_TIMEOUT = int(os.environ.get("SPARE_BUILD_TIMEOUT") or 1800)
+# 分配给虚拟机的 VNC 端口范围, 删除虚拟机后端口回收复用
+VNC_PORT_MIN = int(os.environ.get("VNC_PORT_MIN") or 5900)
+VNC_PORT_MAX = int(os.environ.get("VNC_PORT_MAX") or 6899)
+# 分配时检查端口是否已被本机其它程序监听, libvirt 连接远程节点时应关闭
+VNC_PORT_CHECK_IN_USE = os.environ.get("VNC_PORT_CHECK_IN_USE") != '0'
+# 概览接口结果缓存秒数
+OVERVIEW_CACHE_TTL = int(os.environ.get("OVERVIEW_CACHE_TTL") or 3)
+# 事件推送接口(SSE)单次连接的最长秒数及检查间隔秒数, 该接口需要 run_event_listener 及 gevent 等异步 worker
+# 虚拟机列表的 ETag 同样依赖 run_event_listener 维护的状态缓存, 未运行时列表不返回 ETag
+EVENT_STREAM_TIMEOUT = int(os.environ.get("EVENT_STREAM_TIMEOUT") or 300)
+EVENT_STREAM_INTERVAL = float(os.environ.get("EVENT_STREAM_INTERVAL") or 1)
+# 资源监控原始点/分钟汇总/小时汇总各保留的点数, 采集间隔见 METRICS_INTERVAL
+METRICS_CAPACITY = {
+    'raw': 360,
+    'minute': 1440,
+    'hour': 720,
+}
 if not os.path.exists(VM_BASE_DISKS_DIR):
     os.makedirs(VM_BASE_DISKS_DIR)
 if not os.path.exists(VM_ISO_DIR):